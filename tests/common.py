@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+from uresnet.iotools.event_store import EventStore
+
+
+def make_store(lengths, num_classes=3, seed=0):
+    """
+    EventStore of random events with lengths points each (voxels, feature, label)
+    """
+    rng = np.random.RandomState(seed)
+    store = EventStore(capacity=2)
+    for length in lengths:
+        store.append({'voxels' : rng.randint(0, 64, size=(length, 3)).astype(np.int32),
+                      'feature': rng.uniform(1., 100., size=(length, 1)).astype(np.float32),
+                      'label'  : rng.randint(0, num_classes, size=(length, 1)).astype(np.float32)})
+    store.finalize()
+    return store
+
+
+def event_keys(num_entries, runs=None):
+    """
+    (num_entries, 3) keys (run, 0, entry), runs defaulting to all 1
+    """
+    keys = np.zeros((num_entries, 3), dtype=np.int64)
+    keys[:, 0] = 1 if runs is None else runs
+    keys[:, 2] = np.arange(num_entries)
+    return keys
+
+
+class Flags(object):
+    """
+    IO flags (defaults of uresnet.flags.URESNET_FLAGS after update()) for
+    a small synthetic_sparse dataset
+    """
+    IO_TYPE = 'synthetic_sparse'
+    INPUT_FILE = ['']
+    OUTPUT_FILE = ''
+    OUTPUT_FORMAT = ''
+    OUTPUT_FLOAT16 = False
+    OUTPUT_QUEUE = 64
+    DATA_KEYS = ['data', 'label']
+    DATA_DIM = 3
+    SPATIAL_SIZE = 64
+    NUM_CLASS = 3
+    PLANE = 0
+    GPUS = []
+    BATCH_SIZE = 4
+    MINIBATCH_SIZE = 2
+    SHUFFLE = 1
+    SEED = 7
+    LIMIT_NUM_SAMPLE = -1
+    NUM_THREADS = 1
+    PREFETCH_DEPTH = 2
+    READER_PROCESSES = False
+    PARTICLE = False
+    CACHE_DIR = ''
+    INGEST_WORKERS = 1
+    STREAM_WINDOW = 64
+    POINT_BUDGET = 0
+    BUCKET_POOL = 0
+    COMPUTE_WEIGHT = False
+    WEIGHT_OFFSET = 3
+    VERTEX_FACTOR = 3
+    SYNTH_NUM_EVENTS = 40
+    SYNTH_POINTS = '20,200'
+    SYNTH_CLASS_MIX = ''
+    VALUE_WINDOW = ''
+    MIN_POINTS = 1
+    COMPACT_STORAGE = False
+    SELECT = ''
+    WORLD_SIZE = 1
+    RANK = 0
+    CROP = ''
+    LABEL_MAP = ''
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from uresnet.iotools.cache import cache_path, save_cache, load_cache
+from uresnet.iotools.event_index import EventIndex
+from tests.common import make_store, event_keys
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.tmp_dir, 'input.root')
+        with open(self.input_file, 'w') as f:
+            f.write('events')
+        self.config = {'data_keys': ['data', 'label'], 'min_points': 1}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_path(self):
+        path = cache_path(self.tmp_dir, [self.input_file], self.config)
+        self.assertEqual(os.path.dirname(path), self.tmp_dir)
+        self.assertEqual(path, cache_path(self.tmp_dir, [self.input_file], dict(self.config)))
+        # Another preprocessing configuration
+        config = dict(self.config, min_points=2)
+        self.assertNotEqual(path, cache_path(self.tmp_dir, [self.input_file], config))
+        # Modified input: size, then only the modification time
+        with open(self.input_file, 'a') as f:
+            f.write('more events')
+        resized = cache_path(self.tmp_dir, [self.input_file], self.config)
+        self.assertNotEqual(path, resized)
+        stat = os.stat(self.input_file)
+        os.utime(self.input_file, (stat.st_atime, stat.st_mtime + 10))
+        self.assertNotEqual(resized, cache_path(self.tmp_dir, [self.input_file], self.config))
+
+    def test_save_load(self):
+        store = make_store([4, 2, 6])
+        keys = event_keys(3)
+        metas = np.arange(30, dtype=np.float64).reshape([3, 10])
+        index = EventIndex.build(store, keys, label_key='label', num_classes=3)
+        path = cache_path(self.tmp_dir, [self.input_file], self.config)
+        save_cache(path, store, keys, metas, index=index)
+        # A concurrent writer finding the cache already there is not an error
+        save_cache(path, store, keys, metas, index=index)
+        self.assertEqual([name for name in os.listdir(self.tmp_dir) if name.startswith('.tmp_')], [])
+        loaded, loaded_keys, loaded_metas, particles, loaded_index = load_cache(path)
+        for name in store.keys():
+            np.testing.assert_array_equal(loaded.column(name), store.column(name))
+        np.testing.assert_array_equal(loaded.offsets(), store.offsets())
+        np.testing.assert_array_equal(loaded_keys, keys)
+        np.testing.assert_array_equal(loaded_metas, metas)
+        self.assertIsNone(particles)
+        np.testing.assert_array_equal(loaded_index.column('num_points'), [4, 2, 6])
@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from collections import OrderedDict
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import torch
+    import uresnet.checkpoint as checkpoint
+    from uresnet.checkpoint import CheckpointWriter, checkpoint_files, resolve_checkpoint, snapshot_state
+except ImportError:
+    torch = None
+
+
+def make_state(iteration):
+    return {'global_step': iteration,
+            'state_dict': OrderedDict([('weight', torch.full((2, 3), float(iteration)))]),
+            'io_state': {'epoch': 0, 'cursor': iteration}}
+
+
+@unittest.skipIf(torch is None, 'needs torch')
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmp_dir, 'snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_rotation(self):
+        writer = CheckpointWriter(self.prefix, keep=2)
+        for iteration in [10, 20, 30, 40]:
+            writer.put(iteration, make_state(iteration))
+            writer.flush()
+            # .latest points to the newest checkpoint
+            latest = resolve_checkpoint(self.prefix + '.latest')
+            self.assertEqual(latest, '%s-%d.ckpt' % (self.prefix, iteration))
+        writer.close()
+        self.assertEqual(writer.num_written, 4)
+        self.assertEqual([iteration for iteration, _ in checkpoint_files(self.prefix)], [30, 40])
+        state = torch.load(resolve_checkpoint(self.prefix + '.latest'))
+        self.assertEqual(state['global_step'], 40)
+        self.assertTrue(torch.equal(state['state_dict']['weight'], torch.full((2, 3), 40.)))
+        # Nothing left under a temporary name
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['snapshot-30.ckpt', 'snapshot-40.ckpt', 'snapshot.latest'])
+
+    def test_keep_all(self):
+        writer = CheckpointWriter(self.prefix)
+        for iteration in [1, 2, 3]:
+            writer.put(iteration, make_state(iteration))
+        writer.close()
+        self.assertEqual([iteration for iteration, _ in checkpoint_files(self.prefix)], [1, 2, 3])
+
+    def test_atomic(self):
+        filename = self.prefix + '-5.ckpt'
+
+        def write(f):
+            f.write(b'partial')
+            raise IOError('disk full')
+
+        self.assertRaises(IOError, checkpoint._write_atomic, filename, write)
+        # A failed write never leaves a truncated checkpoint
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+        checkpoint._write_atomic(filename, lambda f: f.write(b'complete'))
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), b'complete')
+
+    def test_error(self):
+        # The writer thread fails, the next call of the trainer raises
+        writer = CheckpointWriter(os.path.join(self.tmp_dir, 'missing', 'snapshot'))
+        writer.put(1, make_state(1))
+        self.assertRaises(IOError, writer.flush)
+        # Raised once, later checkpoints are written again
+        writer._prefix = self.prefix
+        writer.put(2, make_state(2))
+        writer.close()
+        writer.close()
+        self.assertEqual([iteration for iteration, _ in checkpoint_files(self.prefix)], [2])
+
+    def test_error_on_close(self):
+        writer = CheckpointWriter(os.path.join(self.tmp_dir, 'missing', 'snapshot'))
+        writer.put(1, make_state(1))
+        self.assertRaises(IOError, writer.close)
+
+    def test_snapshot(self):
+        state = make_state(3)
+        snapshot = snapshot_state(state)
+        state['state_dict']['weight'] += 1.
+        self.assertTrue(torch.equal(snapshot['state_dict']['weight'], torch.full((2, 3), 3.)))
+        self.assertIsInstance(snapshot['state_dict'], OrderedDict)
+        self.assertEqual(snapshot['io_state'], state['io_state'])
@@ -0,0 +1,53 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import unittest
+import numpy as np
+from uresnet.iotools.collate import BatchBuffers, collate
+from tests.common import make_store
+
+
+class BatchBuffersTest(unittest.TestCase):
+
+    def test_ring(self):
+        buffers = BatchBuffers(num_slots=3)
+        arrays = []
+        for k in range(3):
+            buffers.advance()
+            arrays.append(buffers.get('data', 10, 4, np.float32))
+            arrays[-1][...] = k
+        # Slots are distinct until the ring wraps around
+        for k in range(3):
+            self.assertTrue((arrays[k] == k).all())
+        buffers.advance()
+        reused = buffers.get('data', 8, 4, np.float32)
+        self.assertTrue(np.shares_memory(reused, arrays[0]))
+        self.assertFalse(np.shares_memory(reused, arrays[1]))
+
+    def test_keys_per_batch(self):
+        buffers = BatchBuffers(num_slots=1)
+        buffers.advance()
+        first = buffers.get('data', 10, 4, np.float32)
+        second = buffers.get('data', 10, 4, np.float32)
+        self.assertFalse(np.shares_memory(first, second))
+        buffers.advance()
+        self.assertTrue(np.shares_memory(buffers.get('data', 10, 4, np.float32), first))
+        # Too small or of another type: a new array
+        self.assertFalse(np.shares_memory(buffers.get('data', 100, 4, np.float32), second))
+
+    def test_no_slots(self):
+        buffers = BatchBuffers()
+        first = buffers.get('data', 10, 4, np.float32)
+        self.assertFalse(np.shares_memory(buffers.get('data', 10, 4, np.float32), first))
+
+
+class CollateTest(unittest.TestCase):
+
+    def test_collate(self):
+        store = make_store([3, 5, 2, 4])
+        res = collate(store, [2, 0], 'data', ['label'], first_batch_id=4, buffers=BatchBuffers(num_slots=2))
+        self.assertEqual(res['data'].shape, (5, 5))
+        np.testing.assert_array_equal(res['data'][:, 0:3], np.concatenate([store.event('voxels', 2), store.event('voxels', 0)]))
+        np.testing.assert_array_equal(res['data'][:, 3], [4, 4, 5, 5, 5])
+        np.testing.assert_array_equal(res['feature'], np.concatenate([store.event('feature', 2), store.event('feature', 0)]))
+        np.testing.assert_array_equal(res['label'], np.concatenate([store.event('label', 2), store.event('label', 0)]))
@@ -0,0 +1,48 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import torch.distributed as dist
+    from uresnet.distributed import gather_io_states
+except ImportError:
+    dist = None
+
+
+def gather_worker(init_method, rank, world_size, state, results):
+    dist.init_process_group(backend='gloo', init_method=init_method, world_size=world_size, rank=rank)
+    try:
+        results.put((rank, gather_io_states(state, world_size)))
+    finally:
+        dist.destroy_process_group()
+
+
+@unittest.skipIf(dist is None or not dist.is_available(), 'needs torch.distributed')
+class DistributedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_gather_io_states(self):
+        # Two CPU processes of a gloo group, one without IO state
+        init_method = 'file://' + os.path.join(self.tmp_dir, 'rendezvous')
+        states = [{'epoch': 2, 'cursor': 17}, None]
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=gather_worker,
+                                             args=(init_method, rank, 2, states[rank], results))
+                     for rank in range(2)]
+        for process in processes:
+            process.start()
+        gathered = dict([results.get(timeout=60) for _ in processes])
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(gathered, {0: states, 1: states})
@@ -0,0 +1,89 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from uresnet.iotools.event_index import EventIndex
+from uresnet.iotools.iotools_sparse import parse_selection
+from tests.common import make_store, event_keys
+
+
+class EventIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lengths = [5, 1, 8, 3, 12, 2]
+        self.store = make_store(self.lengths)
+        runs = [1, 1, 2, 2, 3, 3]
+        first = EventIndex.build(self.store.slice(0, 3), event_keys(3, runs[0:3]), file_name='a.root',
+                                 label_key='label', num_classes=3)
+        second = EventIndex.build(self.store.slice(3, 6), event_keys(3, runs[3:6]), file_name='b.root',
+                                  label_key='label', num_classes=3)
+        self.index = EventIndex.concatenate([first, second])
+
+    def test_build(self):
+        self.assertEqual(len(self.index), 6)
+        np.testing.assert_array_equal(self.index.column('num_points'), self.lengths)
+        counts = self.index.column('class_counts')
+        np.testing.assert_array_equal(counts.sum(axis=1), self.lengths)
+        label = self.store.column('label')[:, 0]
+        np.testing.assert_array_equal(counts.sum(axis=0), np.bincount(label.astype(np.int64), minlength=3))
+        np.testing.assert_allclose(self.index.column('feature_sum').sum(), self.store.column('feature').sum(),
+                                   rtol=1.e-5)
+
+    def test_select_points(self):
+        np.testing.assert_array_equal(self.index.select(min_points=3), [0, 2, 3, 4])
+        np.testing.assert_array_equal(self.index.select(min_points=3, max_points=8), [0, 2, 3])
+        np.testing.assert_array_equal(self.index.select(min_points=3, limit=2), [0, 2])
+
+    def test_select_runs(self):
+        np.testing.assert_array_equal(self.index.select(runs=[2]), [2, 3])
+        np.testing.assert_array_equal(self.index.select(runs=[1, 3]), [0, 1, 4, 5])
+        np.testing.assert_array_equal(self.index.select(runs=[4]), [])
+
+    def test_select_files(self):
+        self.assertEqual(self.index.files(), ['a.root', 'b.root'])
+        np.testing.assert_array_equal(self.index.select(files=['b.root']), [3, 4, 5])
+        np.testing.assert_array_equal(self.index.select(files=['b.root'], runs=[2]), [3])
+        np.testing.assert_array_equal(self.index.select(files=['c.root']), [])
+
+    def test_select_class(self):
+        counts = self.index.column('class_counts')
+        expected = np.flatnonzero(counts[:, 2] >= 2)
+        np.testing.assert_array_equal(self.index.select(has_class=2, min_class_voxels=2), expected)
+        np.testing.assert_array_equal(self.index.select(has_class=7), [])
+
+    def test_parse_selection(self):
+        kwargs = parse_selection('min_points:3,runs:1/3,limit:2')
+        self.assertEqual(kwargs, {'min_points': 3, 'runs': [1, 3], 'limit': 2})
+        np.testing.assert_array_equal(self.index.select(**kwargs), [0, 4])
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup((2, 0, 0)), 3)
+        self.assertEqual(self.index.lookup((2, 0, 7)), -1)
+        np.testing.assert_array_equal(self.index.lookup([(3, 0, 2), (1, 0, 0), (9, 9, 9)]), [5, 0, -1])
+
+    def test_split(self):
+        first, second = self.index.split(0.5, seed=3)
+        self.assertEqual(len(second), 3)
+        np.testing.assert_array_equal(np.sort(np.concatenate([first, second])), np.arange(6))
+        again = self.index.split(0.5, seed=3)
+        np.testing.assert_array_equal(again[1], second)
+
+    def test_save_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.index.save(directory)
+            loaded = EventIndex.load(directory)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(loaded.files(), self.index.files())
+        for name in ['run', 'entry', 'num_points', 'class_counts']:
+            np.testing.assert_array_equal(loaded.column(name), self.index.column(name))
+        arrays = self.index.to_arrays()
+        np.testing.assert_array_equal(EventIndex.from_arrays(arrays).select(files=['a.root']), [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from uresnet.iotools.event_store import EventStore
+from tests.common import make_store
+
+
+class EventStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lengths = [3, 0, 5, 1, 7]
+        self.store = make_store(self.lengths)
+
+    def test_append(self):
+        store = self.store
+        self.assertEqual(store.num_entries(), 5)
+        self.assertEqual(store.num_points(), 16)
+        np.testing.assert_array_equal(store.lengths(), self.lengths)
+        np.testing.assert_array_equal(store.offsets(), [0, 3, 3, 8, 9, 16])
+        self.assertEqual(store.keys(), ['voxels', 'feature', 'label'])
+        # Events are zero-copy slices of the columns
+        event = store.event('voxels', 2)
+        np.testing.assert_array_equal(event, store.column('voxels')[3:8])
+        self.assertTrue(np.shares_memory(event, store.column('voxels')))
+        np.testing.assert_array_equal(store.event('feature', -1), store.column('feature')[9:])
+        self.assertRaises(IndexError, store.event, 'voxels', 5)
+        self.assertEqual([len(e) for e in store.view('label')], self.lengths)
+
+    def test_append_mismatch(self):
+        store = EventStore()
+        store.append({'a': np.zeros((2, 1)), 'b': np.zeros((2, 3))})
+        self.assertRaises(ValueError, store.append, {'a': np.zeros((2, 1)), 'b': np.zeros((3, 3))})
+        self.assertRaises(KeyError, store.append, {'a': np.zeros((2, 1))})
+        self.assertEqual(store.num_entries(), 1)
+
+    def test_slice(self):
+        part = self.store.slice(1, 4)
+        self.assertEqual(part.num_entries(), 3)
+        np.testing.assert_array_equal(part.lengths(), self.lengths[1:4])
+        for i in range(3):
+            np.testing.assert_array_equal(part.event('voxels', i), self.store.event('voxels', i + 1))
+        self.assertTrue(np.shares_memory(part.column('voxels'), self.store.column('voxels')))
+        copied = self.store.slice(1, 4, copy=True)
+        self.assertFalse(np.shares_memory(copied.column('voxels'), self.store.column('voxels')))
+        np.testing.assert_array_equal(copied.column('label'), part.column('label'))
+
+    def test_concatenate(self):
+        parts = [self.store.slice(0, 2), EventStore(), self.store.slice(2, 5)]
+        store = EventStore.concatenate(parts)
+        np.testing.assert_array_equal(store.offsets(), self.store.offsets())
+        for name in self.store.keys():
+            np.testing.assert_array_equal(store.column(name), self.store.column(name))
+
+    def test_concatenate_empty(self):
+        self.assertRaises(ValueError, EventStore.concatenate, [])
+        empty = self.store.slice(2, 2)
+        self.assertEqual(empty.num_entries(), 0)
+        store = EventStore.concatenate([empty, EventStore()])
+        self.assertEqual(store.num_entries(), 0)
+        self.assertEqual(store.keys(), self.store.keys())
+
+    def test_save_load(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.store.save(tmp_dir)
+            for mmap_mode in ['r', None]:
+                store = EventStore.load(tmp_dir, mmap_mode=mmap_mode)
+                self.assertEqual(store.keys(), self.store.keys())
+                np.testing.assert_array_equal(store.offsets(), self.store.offsets())
+                for name in store.keys():
+                    self.assertEqual(store.column(name).dtype, self.store.column(name).dtype)
+                    np.testing.assert_array_equal(store.column(name), self.store.column(name))
+                self.assertEqual(isinstance(store.column('voxels'), np.memmap), mmap_mode == 'r')
+                del store
+        finally:
+            shutil.rmtree(tmp_dir)
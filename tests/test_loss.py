@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import unittest
+import numpy as np
+
+try:
+    import torch
+    from uresnet.models import SparseSegmentationLoss
+except ImportError:
+    torch = None
+
+
+def reference_loss(segmentation, data, label, weight):
+    """
+    The loss as it was computed before vectorization: one cross-entropy and
+    accuracy per event
+    """
+    cross_entropy = torch.nn.CrossEntropyLoss(reduction='none')
+    total_loss = 0
+    total_acc = 0
+    for i in range(len(segmentation)):
+        batch_ids = data[i][:, -2]
+        for b in batch_ids.unique():
+            batch_index = batch_ids == b
+            event_segmentation = segmentation[i][batch_index]
+            event_label = torch.squeeze(label[i][batch_index], dim=-1).long()
+            loss_seg = cross_entropy(event_segmentation, event_label)
+            if weight is not None:
+                event_weight = torch.squeeze(weight[i][batch_index], dim=-1).float()
+                total_loss += torch.sum(loss_seg * event_weight)
+            else:
+                total_loss += torch.sum(loss_seg)
+            predicted_labels = torch.argmax(event_segmentation, dim=-1)
+            total_acc += (predicted_labels == event_label).sum().item() / float(predicted_labels.nelement())
+    return total_loss, total_acc
+
+
+@unittest.skipIf(torch is None, 'needs torch')
+class SegmentationLossTest(unittest.TestCase):
+
+    def make_inputs(self, seed):
+        # Two minibatches of several events, batch ids not sorted
+        rng = np.random.RandomState(seed)
+        segmentation, data, label, weight = [], [], [], []
+        for num_points, num_events in [(200, 5), (50, 3)]:
+            batch_ids = rng.randint(0, num_events, size=num_points)
+            batch_ids[0:num_events] = np.arange(num_events)
+            d = np.concatenate([rng.randint(0, 64, size=(num_points, 3)), batch_ids[:, None],
+                                rng.uniform(size=(num_points, 1))], axis=1)
+            data.append(torch.as_tensor(d.astype(np.float32)))
+            segmentation.append(torch.as_tensor(rng.normal(size=(num_points, 4)).astype(np.float32)))
+            label.append(torch.as_tensor(rng.randint(0, 4, size=(num_points, 1)).astype(np.float32)))
+            weight.append(torch.as_tensor(rng.uniform(0.5, 3., size=(num_points, 1)).astype(np.float32)))
+        return segmentation, data, label, weight
+
+    def test_reference(self):
+        criterion = SparseSegmentationLoss(None)
+        for seed in range(3):
+            segmentation, data, label, weight = self.make_inputs(seed)
+            for w in [weight, None]:
+                loss, acc = criterion(segmentation, data, label, w)
+                expected_loss, expected_acc = reference_loss(segmentation, data, label, w)
+                np.testing.assert_allclose(float(loss), float(expected_loss), rtol=1.e-6)
+                self.assertAlmostEqual(float(acc), expected_acc, places=12)
+
+    def test_gradients(self):
+        segmentation, data, label, weight = self.make_inputs(0)
+        segmentation = [s.requires_grad_() for s in segmentation]
+        loss, _ = SparseSegmentationLoss(None)(segmentation, data, label, weight)
+        grads = torch.autograd.grad(loss, segmentation)
+        expected_loss, _ = reference_loss(segmentation, data, label, weight)
+        expected = torch.autograd.grad(expected_loss, segmentation)
+        for grad, expected_grad in zip(grads, expected):
+            np.testing.assert_allclose(grad.numpy(), expected_grad.numpy(), rtol=1.e-5, atol=1.e-7)
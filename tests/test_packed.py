@@ -0,0 +1,74 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from uresnet.iotools.packed import save_packed, load_packed
+from uresnet.iotools.iotools_packed import io_packed_sparse
+from uresnet.iotools.iotools_synthetic import io_synthetic_sparse
+from tests.common import Flags
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class PackedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = io_synthetic_sparse(Flags(SYNTH_NUM_EVENTS=12, PARTICLE=True))
+        self.source.initialize()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save(self, name, start=0, end=12):
+        path = os.path.join(self.tmp_dir, name)
+        source = self.source
+        save_packed(path, source._store.slice(start, end), source._event_keys[start:end],
+                    source._metas[start:end], source._particles.slice(start, end),
+                    source._index.take(np.arange(start, end)))
+        return path
+
+    def check_round_trip(self, name):
+        store, event_keys, metas, particles, index = load_packed(self.save(name))
+        source = self.source
+        self.assertEqual(sorted(store.keys()), sorted(source._store.keys()))
+        np.testing.assert_array_equal(store.offsets(), source._store.offsets())
+        for key in store.keys():
+            self.assertEqual(store.column(key).dtype, source._store.column(key).dtype)
+            np.testing.assert_array_equal(store.column(key), source._store.column(key))
+        np.testing.assert_array_equal(event_keys, source._event_keys)
+        np.testing.assert_array_equal(metas, source._metas)
+        np.testing.assert_array_equal(particles.offsets(), source._particles.offsets())
+        np.testing.assert_array_equal(particles.column('particles'), source._particles.column('particles'))
+        np.testing.assert_array_equal(index.column('num_points'), store.lengths())
+
+    def test_directory(self):
+        self.check_round_trip('packed')
+
+    def test_npz(self):
+        self.check_round_trip('packed.npz')
+
+    @unittest.skipIf(h5py is None, 'needs h5py')
+    def test_hdf5(self):
+        self.check_round_trip('packed.h5')
+
+    def test_missing(self):
+        self.assertRaises(IOError, load_packed, os.path.join(self.tmp_dir, 'missing'))
+
+    def test_reader(self):
+        # Several packed files of different containers read as one dataset
+        files = [self.save('first.npz', 0, 5), self.save('second', 5, 12)]
+        io = io_packed_sparse(Flags(IO_TYPE='packed_sparse', INPUT_FILE=files, PARTICLE=True, SHUFFLE=0))
+        io.initialize()
+        self.assertEqual(io.num_entries(), 12)
+        np.testing.assert_array_equal(io._event_keys, self.source._event_keys)
+        for entry in [0, 4, 5, 11]:
+            np.testing.assert_array_equal(io._store.event('data', entry), self.source._store.event('data', entry))
+        self.assertEqual(len(io._index.select(min_points=1)), 12)
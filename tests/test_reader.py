@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import copy
+import time
+import unittest
+import numpy as np
+from uresnet.iotools.iotools_synthetic import io_synthetic_sparse
+from uresnet.iotools.collate import collate, copy_batch
+from tests.common import Flags
+
+
+class ReaderTest(unittest.TestCase):
+    """
+    Batches must stay intact while the consumer holds them (held_batches()
+    batches per reader), however far ahead the readers are
+    """
+
+    def check_held_batches(self, flags):
+        io = io_synthetic_sparse(flags)
+        io.initialize()
+        io.start_threads()
+        try:
+            num_held = io.held_batches() * flags.NUM_THREADS
+            # One training iteration takes BATCH_SIZE / MINIBATCH_SIZE batches
+            self.assertEqual(num_held, flags.BATCH_SIZE // flags.MINIBATCH_SIZE)
+            held = []
+            for _ in range(30):
+                idx, blob = io.next()
+                held.append((blob, copy.deepcopy(blob)))
+                held = held[-num_held:]
+                # Let the readers fill their queues
+                time.sleep(0.01)
+                for blob, expected in held:
+                    for key in ['data', 'label']:
+                        for array, array_expected in zip(blob[key], expected[key]):
+                            np.testing.assert_array_equal(array, array_expected)
+        finally:
+            io.stop_threads()
+
+    def check_retained_batches(self, flags):
+        io = io_synthetic_sparse(flags)
+        io.initialize()
+        io.start_threads()
+        try:
+            # Far more batches than held_batches(), as full_inference_loop keeps
+            retained = []
+            for _ in range(10):
+                idx, blob = io.next()
+                self.assertTrue(np.shares_memory(blob['feature'][0], blob['data'][0]))
+                retained.append((idx, copy_batch(blob, 'data')))
+                time.sleep(0.01)
+        finally:
+            io.stop_threads()
+        for idx, blob in retained:
+            for gpu, minibatch_idx in enumerate(idx):
+                expected = collate(io._store, minibatch_idx, 'data', ['label'])
+                for key in ['data', 'voxels', 'feature', 'label']:
+                    np.testing.assert_array_equal(blob[key][gpu], expected[key])
+                self.assertTrue(np.shares_memory(blob['voxels'][gpu], blob['data'][gpu]))
+
+    def test_threads(self):
+        self.check_held_batches(Flags(NUM_THREADS=2, BATCH_SIZE=8))
+
+    def test_single_thread(self):
+        self.check_held_batches(Flags(NUM_THREADS=1, BATCH_SIZE=6))
+
+    def test_retained(self):
+        self.check_retained_batches(Flags(BATCH_SIZE=1, MINIBATCH_SIZE=1, PREFETCH_DEPTH=1))
+
+    def test_processes(self):
+        self.check_held_batches(Flags(NUM_THREADS=2, BATCH_SIZE=8, READER_PROCESSES=True))
+
+    def test_retained_processes(self):
+        self.check_retained_batches(Flags(BATCH_SIZE=1, MINIBATCH_SIZE=1, PREFETCH_DEPTH=1, READER_PROCESSES=True))
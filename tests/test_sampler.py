@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import unittest
+import numpy as np
+from uresnet.iotools.sampler import EpochSampler, BudgetSampler
+
+
+class EpochSamplerTest(unittest.TestCase):
+
+    def test_epochs(self):
+        # 3 entries left over at the end of each epoch: batches span epochs
+        sampler = EpochSampler(23, 4, seed=3)
+        stream = np.concatenate([sampler.batch(b) for b in range(23)])
+        for epoch in range(4):
+            np.testing.assert_array_equal(np.sort(stream[epoch*23:(epoch+1)*23]), np.arange(23))
+        self.assertFalse(np.array_equal(stream[0:23], stream[23:46]))
+        # Same seed, same stream, whatever the order batches are made in
+        other = EpochSampler(23, 4, seed=3)
+        for b in reversed(range(23)):
+            np.testing.assert_array_equal(other.batch(b), stream[b*4:(b+1)*4])
+        self.assertFalse(np.array_equal(EpochSampler(23, 4, seed=4).batch(0), stream[0:4]))
+
+    def test_no_shuffle(self):
+        sampler = EpochSampler(5, 3, shuffle=False)
+        np.testing.assert_array_equal(np.concatenate([sampler.batch(b) for b in range(4)]),
+                                      [0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 1])
+
+    def test_minibatches(self):
+        sampler = EpochSampler(20, 6, num_minibatches=3, seed=1)
+        minibatches = sampler.minibatches(2)
+        self.assertEqual([len(m) for m in minibatches], [2, 2, 2])
+        np.testing.assert_array_equal(np.concatenate(minibatches), sampler.batch(2))
+
+    def test_resume(self):
+        sampler = EpochSampler(23, 4, seed=3)
+        for b in [0, 5, 6, 11, 40]:
+            state = sampler.state(b)
+            self.assertEqual(state, {'epoch': b * 4 // 23, 'cursor': b * 4 % 23})
+            resumed = EpochSampler(23, 4, seed=3, start=state)
+            for k in range(8):
+                np.testing.assert_array_equal(resumed.batch(k), sampler.batch(b + k))
+            self.assertEqual(resumed.state(3), sampler.state(b + 3))
+
+    def test_entries(self):
+        entries = np.array([2, 3, 5, 7, 11, 13, 17])
+        sampler = EpochSampler(100, 7, seed=0, entries=entries)
+        np.testing.assert_array_equal(np.sort(sampler.batch(0)), entries)
+        np.testing.assert_array_equal(np.sort(sampler.batch(1)), entries)
+        np.testing.assert_array_equal(EpochSampler(100, 7, shuffle=False, entries=entries).batch(0), entries)
+
+
+class BudgetSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lengths = np.random.RandomState(0).randint(1, 100, size=60)
+        # Larger than the budget, gets a minibatch of its own
+        self.lengths[7] = 500
+
+    def check_epoch(self, sampler, num_batches):
+        seen = []
+        for b in range(num_batches):
+            minibatches = sampler.minibatches(b)
+            self.assertEqual(len(minibatches), 2)
+            for m in minibatches:
+                self.assertGreater(len(m), 0)
+                self.assertTrue(len(m) == 1 or self.lengths[m].sum() <= 150)
+                seen.extend(m)
+            np.testing.assert_array_equal(sampler.batch(b), np.concatenate(minibatches))
+        # No event twice in an epoch, only the last partial batch is skipped
+        self.assertEqual(len(set(seen)), len(seen))
+        self.assertGreater(len(seen), len(self.lengths) - 10)
+
+    def test_budget(self):
+        for bucket in [0, 16]:
+            sampler = BudgetSampler(self.lengths, 150, num_minibatches=2, seed=2, bucket=bucket)
+            num_batches = [sampler.state(b)['epoch'] for b in range(100)].index(1)
+            self.assertEqual(sampler.state(num_batches - 1), {'epoch': 0, 'cursor': num_batches - 1})
+            self.check_epoch(sampler, num_batches)
+
+    def test_resume(self):
+        sampler = BudgetSampler(self.lengths, 150, num_minibatches=2, seed=2, bucket=16)
+        for b in [0, 3, 17, 50]:
+            resumed = BudgetSampler(self.lengths, 150, num_minibatches=2, seed=2, bucket=16,
+                                    start=sampler.state(b))
+            for k in range(10):
+                np.testing.assert_array_equal(resumed.batch(k), sampler.batch(b + k))
+
+    def test_too_small(self):
+        sampler = BudgetSampler([5, 5, 5], 100, num_minibatches=2)
+        self.assertRaises(ValueError, sampler.batch, 0)
@@ -0,0 +1,49 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import unittest
+import numpy as np
+from uresnet.iotools.shard import shard_bounds, shard_entry_ranges
+
+
+class ShardTest(unittest.TestCase):
+
+    def check_partition(self, bounds, num_entries):
+        # Contiguous, disjoint, non-empty and covering every event
+        self.assertEqual(bounds[0][0], 0)
+        self.assertEqual(bounds[-1][1], num_entries)
+        for (start, end), (next_start, _) in zip(bounds[:-1], bounds[1:]):
+            self.assertEqual(end, next_start)
+        for start, end in bounds:
+            self.assertLess(start, end)
+
+    def test_bounds_balance_points(self):
+        lengths = np.random.RandomState(0).randint(10, 1000, size=1000)
+        bounds = [shard_bounds(lengths, 4, r) for r in range(4)]
+        self.check_partition(bounds, len(lengths))
+        points = [lengths[start:end].sum() for start, end in bounds]
+        self.assertLess(max(points) - min(points), 2 * lengths.max())
+
+    def test_bounds_uneven_events(self):
+        # One large event must not leave the other shards empty
+        lengths = [1, 1, 1000, 1, 1]
+        bounds = [shard_bounds(lengths, 4, r) for r in range(4)]
+        self.check_partition(bounds, len(lengths))
+        self.assertEqual([shard_bounds(lengths, 5, r) for r in range(5)],
+                         [(i, i + 1) for i in range(5)])
+
+    def test_bounds_too_few_events(self):
+        self.assertRaises(ValueError, shard_bounds, [5, 5], 3, 0)
+
+    def test_entry_ranges(self):
+        num_entries = [5, 0, 7]
+        ranges = [shard_entry_ranges(num_entries, 3, r) for r in range(3)]
+        self.assertEqual(ranges, [[(0, 0, 4)],
+                                  [(0, 4, 5), (2, 0, 3)],
+                                  [(2, 3, 7)]])
+        self.assertEqual(shard_entry_ranges(num_entries, 1, 0), [(0, 0, 5), (2, 0, 7)])
+        self.assertRaises(ValueError, shard_entry_ranges, [1, 1], 3, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import uresnet.iotools.iotools_stream as iotools_stream
+from uresnet.iotools.event_index import EventIndex
+from uresnet.iotools.event_store import EventStore
+from uresnet.iotools.collate import copy_batch
+from uresnet.iotools.iotools_sparse import build_index
+from uresnet.iotools.iotools_stream import StreamWindow, collate_events, io_larcv_sparse_stream
+from uresnet.iotools.iotools_synthetic import generate_event
+from tests.common import make_store, event_keys, Flags
+
+
+def make_window(file_offset, entries, lengths):
+    store = make_store(lengths)
+    keys = event_keys(len(lengths))
+    metas = np.zeros((len(lengths), 10))
+    index = EventIndex.build(store, keys, entries=entries)
+    return StreamWindow(file_offset, store, keys, metas, None, index)
+
+
+class StreamWindowTest(unittest.TestCase):
+
+    def test_dropped_entries(self):
+        # Entries 5 and 7 of the window [4, 9) were dropped at ingest
+        window = make_window(100, [4, 6, 8], [3, 2, 4])
+        np.testing.assert_array_equal(window.stream_index, [104, 106, 108])
+        self.assertEqual(window.find(106), 1)
+        self.assertEqual(window.find(108), 2)
+        self.assertEqual(window.find(105), -1)
+        self.assertEqual(window.find(109), -1)
+        self.assertEqual(window.find(0), -1)
+        np.testing.assert_array_equal(window.get('voxels', window.find(108)), window.store.event('voxels', 2))
+
+    def test_collate_windows(self):
+        first = make_window(0, [0, 1], [3, 2])
+        second = make_window(10, [0, 2], [4, 1])
+        events = [(first, 1), (second, 0), (second, 1)]
+        res = collate_events(events, 'data', ['label'], 0, None)
+        self.assertEqual(len(res['label']), 2 + 4 + 1)
+        np.testing.assert_array_equal(res['data'][:, 3], [0] * 2 + [1] * 4 + [2])
+        np.testing.assert_array_equal(res['voxels'][0:2, 0:3], first.store.event('voxels', 1))
+        np.testing.assert_array_equal(res['label'][6:], second.store.event('label', 1))
+
+
+def fake_count_entries(flags, input_file):
+    # Long enough for the reader not to loop back to the first entries
+    return 50
+
+
+def fake_read(flags, input_file, entry_start=0, entry_end=None, verbose=False):
+    """
+    read_larcv_sparse of generated events, entries 3, 8, 13... of a file dropped
+    """
+    store = EventStore()
+    entries = [entry for entry in range(entry_start, entry_end) if entry % 5 != 3]
+    for entry in entries:
+        rng = np.random.RandomState([len(input_file), entry])
+        voxels, feature, label, _ = generate_event(rng, 3, 64, 50, np.ones(3) / 3.)
+        store.append({'data': np.concatenate([voxels, feature], axis=1).astype(np.float32),
+                      'voxels': voxels, 'feature': feature, 'label': label})
+    store.finalize()
+    keys = np.array([(len(input_file), 0, entry) for entry in entries], dtype=np.int64).reshape([-1, 3])
+    metas = np.zeros((len(entries), 10))
+    return store, keys, metas, None, build_index(flags, store, keys, entries, input_file)
+
+
+class StreamReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.count, self.read = iotools_stream.count_larcv_entries, iotools_stream.read_larcv_sparse
+        iotools_stream.count_larcv_entries, iotools_stream.read_larcv_sparse = fake_count_entries, fake_read
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        iotools_stream.count_larcv_entries, iotools_stream.read_larcv_sparse = self.count, self.read
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reader_processes(self):
+        # Streaming ignores READER_PROCESSES, batches come from its thread
+        flags = Flags(IO_TYPE='larcv_sparse_stream', INPUT_FILE=['a', 'bb'], READER_PROCESSES=True, SHUFFLE=0,
+                      STREAM_WINDOW=4, OUTPUT_FILE=os.path.join(self.tmp_dir, 'output.npz'))
+        io = io_larcv_sparse_stream(flags)
+        io.initialize()
+        io.start_threads()
+        try:
+            # Kept longer than held_batches(), as full_inference_loop does
+            batches = []
+            for _ in range(8):
+                idx_v, blob = io.next()
+                batches.append((idx_v, copy_batch(blob, 'data')))
+            self.assertIsNone(io._processes[0])
+            idx = np.concatenate([np.concatenate(idx_v) for idx_v, _ in batches])
+            np.testing.assert_array_equal(idx, [0, 1, 2, 4, 5, 6, 7, 9, 10, 11, 12, 14, 15, 16, 17, 19])
+            for idx_v, blob in batches:
+                for i, minibatch_idx in enumerate(idx_v):
+                    expected = [io.blob()['data'][int(entry)][:, 0:3] for entry in minibatch_idx]
+                    np.testing.assert_array_equal(blob['voxels'][i][:, 0:3], np.concatenate(expected))
+            for idx_v, blob in batches:
+                io.store_segment(idx_v, blob['data'], [np.ones((len(d), 3)) for d in blob['data']])
+            # An event can only be stored once
+            idx_v, blob = batches[0]
+            self.assertRaises(IndexError, io.store_segment, idx_v, blob['data'],
+                              [np.ones((len(d), 3)) for d in blob['data']])
+        finally:
+            io.stop_threads()
+            io.finalize()
+        np.testing.assert_array_equal(np.load(flags.OUTPUT_FILE)['entry'], idx)
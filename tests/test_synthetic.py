@@ -0,0 +1,45 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import unittest
+import numpy as np
+from uresnet.iotools.iotools_synthetic import generate_event, io_synthetic_sparse
+from tests.common import Flags
+
+
+class SyntheticTest(unittest.TestCase):
+
+    def test_event(self):
+        class_prob = np.array([0.5, 0.5, 0.])
+        for dim in [2, 3]:
+            rng = np.random.RandomState(dim)
+            voxels, feature, label, particles = generate_event(rng, dim, 64, 500, class_prob, particle=True)
+            self.assertEqual(voxels.shape[1], dim)
+            self.assertEqual(len(feature), len(voxels))
+            self.assertTrue(np.all((voxels >= 0) & (voxels < 64)))
+            # Unique voxels, no label of a class with probability 0
+            self.assertEqual(len(np.unique(voxels, axis=0)), len(voxels))
+            self.assertTrue(set(np.unique(label)) <= set([0., 1.]))
+            self.assertGreaterEqual(particles['npx'].sum(), len(voxels))
+            np.testing.assert_array_equal(particles['start_x'], particles['creation_x'])
+            if dim == 2:
+                # 2D particles have z = 0, not a copy of x
+                for name in ['creation_z', 'direction_z', 'start_z', 'end_z']:
+                    np.testing.assert_array_equal(particles[name], 0.)
+            else:
+                self.assertTrue(np.all(particles['end_z'] != 0.))
+
+    def test_reproducible(self):
+        io = io_synthetic_sparse(Flags(SYNTH_NUM_EVENTS=10))
+        io.initialize()
+        more = io_synthetic_sparse(Flags(SYNTH_NUM_EVENTS=12))
+        more.initialize()
+        # Events only depend on SEED and their entry
+        self.assertEqual(io.num_entries(), 10)
+        for entry in range(10):
+            np.testing.assert_array_equal(io._store.event('data', entry), more._store.event('data', entry))
+            np.testing.assert_array_equal(io._store.event('label', entry), more._store.event('label', entry))
+
+
+if __name__ == '__main__':
+    unittest.main()
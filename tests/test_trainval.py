@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import unittest
+import numpy as np
+
+try:
+    import torch
+    from uresnet.trainval import trainval
+    from uresnet.models import SparseSegmentationLoss
+except ImportError:
+    torch = None
+
+
+class TrainFlags(object):
+    TRAIN = True
+    WORLD_SIZE = 1
+    RANK = 0
+    MODEL_NAME = 'uresnet_sparse'
+    ACCUMULATE_GRADIENTS = False
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+
+if torch is not None:
+    class ToyNet(torch.nn.Module):
+        """
+        Per-point scores from the coordinates and feature, returned as a
+        list like UResNet
+        """
+
+        def __init__(self):
+            super(ToyNet, self).__init__()
+            torch.manual_seed(0)
+            self.linear = torch.nn.Linear(4, 3)
+
+        def forward(self, point_cloud):
+            features = torch.cat([point_cloud[:, 0:3], point_cloud[:, -1:]], dim=1).float()
+            return [self.linear(features / 64.)]
+
+
+def make_minibatch(rng, lengths, first_batch_id=0):
+    """
+    (data, label, weight) of one minibatch of events with lengths points
+    """
+    data = np.concatenate([np.concatenate([rng.randint(0, 64, size=(n, 3)), np.full((n, 1), first_batch_id + i),
+                                           rng.uniform(1., 100., size=(n, 1))], axis=1)
+                           for i, n in enumerate(lengths)]).astype(np.float32)
+    label = rng.randint(0, 3, size=(len(data), 1)).astype(np.float32)
+    weight = rng.uniform(0.5, 2., size=(len(data), 1)).astype(np.float32)
+    return data, label, weight
+
+
+@unittest.skipIf(torch is None, 'needs torch')
+class AccumulationTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        lengths = [[5, 9], [3, 12], [7, 7], [10, 2]]
+        self.minibatches = [make_minibatch(rng, n) for n in lengths]
+
+    def train_step(self, minibatches, accumulate):
+        flags = TrainFlags(ACCUMULATE_GRADIENTS=accumulate)
+        trainer = trainval(flags)
+        trainer._net = ToyNet()
+        trainer._criterion = SparseSegmentationLoss(flags)
+        # No update: the gradients of the step are compared
+        trainer._optimizer = torch.optim.SGD(trainer._net.parameters(), lr=0.)
+        trainer.tspent_sum['forward'] = trainer.tspent_sum['train'] = 0.
+        data_blob = {'data'  : [[data] for data, _, _ in minibatches],
+                     'label' : [[label] for _, label, _ in minibatches],
+                     'weight': [[weight] for _, _, weight in minibatches],
+                     'idx_v' : [[np.unique(data[:, -2])] for data, _, _ in minibatches]}
+        res = trainer.train_step(data_blob)
+        return res, [p.grad.clone() for p in trainer._net.parameters()]
+
+    def test_accumulated_gradients(self):
+        # The same events as a single minibatch, batch ids made distinct
+        merged = []
+        for i, (data, label, weight) in enumerate(self.minibatches):
+            data = data.copy()
+            data[:, -2] += 2 * i
+            merged.append((data, label, weight))
+        merged = [tuple(np.concatenate(arrays) for arrays in zip(*merged))]
+        res_single, grads_single = self.train_step(merged, accumulate=False)
+        for accumulate in [False, True]:
+            res, grads = self.train_step(self.minibatches, accumulate)
+            for grad, grad_single in zip(grads, grads_single):
+                np.testing.assert_allclose(grad.numpy(), grad_single.numpy(), rtol=1.e-5, atol=1.e-6)
+            np.testing.assert_allclose(res['loss_seg'], res_single['loss_seg'], rtol=1.e-5)
+            self.assertAlmostEqual(res['accuracy'], res_single['accuracy'], places=6)
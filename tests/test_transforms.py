@@ -0,0 +1,48 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import unittest
+import numpy as np
+from uresnet.iotools.transforms import build_transforms
+from tests.common import Flags
+
+
+def make_event():
+    voxels = np.array([[0, 0, 0], [5, 5, 5], [10, 2, 3], [3, 12, 1]], dtype=np.int32)
+    feature = np.array([[1.], [20.], [50.], [200.]], dtype=np.float32)
+    return {'data': np.concatenate([voxels, feature], axis=1),
+            'voxels': voxels,
+            'feature': feature,
+            'label': np.array([[0.], [1.], [2.], [1.]], dtype=np.float32)}
+
+
+class TransformsTest(unittest.TestCase):
+
+    def test_pipeline(self):
+        transform = build_transforms(Flags(LABEL_MAP='1:0,2:1', VALUE_WINDOW='10,100', CROP='0,8'))
+        event = transform(make_event())
+        # Labels are remapped, then the window keeps points 1, 2 and the crop point 1
+        np.testing.assert_array_equal(event['voxels'], [[5, 5, 5]])
+        np.testing.assert_array_equal(event['data'], [[5, 5, 5, 20.]])
+        np.testing.assert_array_equal(event['label'], [[0.]])
+        self.assertIsNone(build_transforms(Flags(CROP='0,8', MIN_POINTS=3))(make_event()))
+
+    def test_identity(self):
+        event = make_event()
+        self.assertIs(build_transforms(Flags(MIN_POINTS=0))(event), event)
+
+    def test_compact(self):
+        event = build_transforms(Flags(COMPACT_STORAGE=True))(make_event())
+        self.assertNotIn('data', event)
+        self.assertEqual(event['voxels'].dtype, np.int16)
+        self.assertEqual(event['label'].dtype, np.uint8)
+        np.testing.assert_array_equal(event['label'], make_event()['label'])
+        # Weights keep their exact value
+        event = make_event()
+        event['weights'] = np.full((4, 1), 1. / 3., dtype=np.float32)
+        compact = build_transforms(Flags(COMPACT_STORAGE=True, DATA_KEYS=['data', 'label', 'weights']))(event)
+        self.assertEqual(compact['weights'].dtype, np.float32)
+        np.testing.assert_array_equal(compact['weights'], event['weights'])
+        event = make_event()
+        event['label'][0] = 0.5
+        self.assertRaises(ValueError, build_transforms(Flags(COMPACT_STORAGE=True)), event)
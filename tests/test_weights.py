@@ -0,0 +1,42 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import unittest
+import numpy as np
+from uresnet.iotools.iotools_sparse import compute_weights
+
+
+def reference_weights(voxels, labels, offset, vertex_factor):
+    """
+    Pairwise definition: vertex if any voxel within offset in x and y has
+    another label
+    """
+    labels = labels.reshape([-1])
+    weights = np.full(len(labels), 0.5, dtype=np.float32)
+    for i in range(len(labels)):
+        near = ((np.abs(voxels[:, 0] - voxels[i, 0]) <= offset) &
+                (np.abs(voxels[:, 1] - voxels[i, 1]) <= offset))
+        if np.any(labels[near] != labels[i]):
+            weights[i] = (1 + vertex_factor) * 0.5
+    return weights
+
+
+class ComputeWeightsTest(unittest.TestCase):
+
+    def test_reference(self):
+        rng = np.random.RandomState(0)
+        for num_points, size in [(50, 20), (300, 40), (200, 200)]:
+            for offset, vertex_factor in [(3, 3), (1, 5), (0, 2)]:
+                voxels = rng.randint(-size, size, size=(num_points, 3))
+                labels = rng.randint(0, 3, size=(num_points, 1)).astype(np.float32)
+                weights = compute_weights(voxels, labels, offset, vertex_factor)
+                self.assertEqual(weights.shape, labels.shape)
+                self.assertEqual(weights.dtype, np.float32)
+                np.testing.assert_array_equal(weights.reshape([-1]),
+                                              reference_weights(voxels, labels, offset, vertex_factor))
+
+    def test_single_label(self):
+        voxels = np.array([[0, 0, 0], [1, 1, 0], [5, 5, 5]])
+        labels = np.ones((3, 1), dtype=np.float32)
+        np.testing.assert_array_equal(compute_weights(voxels, labels), 0.5)
+        np.testing.assert_array_equal(compute_weights(voxels[0:1], labels[0:1]), [[0.5]])
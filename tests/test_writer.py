@@ -0,0 +1,166 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+from uresnet.iotools.writer import AsyncWriter, NPZWriter
+
+
+def make_record(entry, num_points, label=True, extra=()):
+    rng = np.random.RandomState(entry)
+    return {'event_key': (1, 0, entry),
+            'entry': entry,
+            'meta': np.arange(10, dtype=np.float64),
+            'voxels': rng.randint(0, 64, size=(num_points, 3)),
+            'feature': rng.uniform(size=(num_points, 1)).astype(np.float32),
+            'softmax': rng.uniform(size=(num_points, 3)).astype(np.float32),
+            'label': rng.randint(0, 3, size=(num_points, 1)).astype(np.float32) if label else None,
+            'extra': dict([(name, rng.uniform(size=(num_points, 1))) for name in extra])}
+
+
+class NPZWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.tmp_dir, 'output.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        # Small blocks: columns are written in several blocks
+        writer = NPZWriter(self.output_file, block_size=10)
+        records = [make_record(i, n, extra=['score']) for i, n in enumerate([4, 7, 1, 12])]
+        for record in records:
+            writer.write(record)
+        writer.close()
+        columns = np.load(self.output_file)
+        np.testing.assert_array_equal(columns['entry'], [0, 1, 2, 3])
+        np.testing.assert_array_equal(columns['num_points'], [4, 7, 1, 12])
+        offsets = np.cumsum(np.append(0, columns['num_points']))
+        for i, record in enumerate(records):
+            start, end = offsets[i], offsets[i + 1]
+            np.testing.assert_array_equal(columns['voxels'][start:end], record['voxels'])
+            np.testing.assert_array_equal(columns['label'][start:end], record['label'].reshape([-1]))
+            np.testing.assert_array_equal(columns['prediction'][start:end], np.argmax(record['softmax'], axis=1))
+            np.testing.assert_allclose(columns['extra_score'][start:end], record['extra']['score'].reshape([-1]), rtol=1e-6)
+
+    def test_without_label(self):
+        writer = NPZWriter(self.output_file)
+        writer.write(make_record(0, 5, label=False))
+        writer.write(make_record(1, 3, label=False))
+        writer.close()
+        columns = np.load(self.output_file)
+        self.assertNotIn('label', columns.files)
+        self.assertEqual(len(columns['voxels']), 8)
+
+    def test_mixed_columns(self):
+        writer = NPZWriter(self.output_file)
+        writer.write(make_record(0, 5))
+        self.assertRaises(ValueError, writer.write, make_record(1, 5, label=False))
+        self.assertRaises(ValueError, writer.write, make_record(2, 5, extra=['score']))
+        # Rejected records were not buffered
+        writer.write(make_record(3, 2))
+        writer.close()
+        columns = np.load(self.output_file)
+        np.testing.assert_array_equal(columns['entry'], [0, 3])
+        self.assertEqual(len(columns['label']), 7)
+
+
+class FakeWriter(object):
+    """
+    Records what it writes, blocks while gate is cleared, raises on a
+    record equal to fail
+    """
+
+    def __init__(self, fail=None):
+        self.records = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.fail = fail
+        self.num_closed = 0
+
+    def write(self, record):
+        self.gate.wait()
+        if record == self.fail:
+            raise ValueError('Cannot write %r' % record)
+        self.records.append(record)
+
+    def close(self):
+        self.num_closed += 1
+
+
+class AsyncWriterTest(unittest.TestCase):
+
+    def test_order(self):
+        writer = FakeWriter()
+        async_writer = AsyncWriter(writer, max_queue=4)
+        for i in range(100):
+            async_writer.put(i)
+        async_writer.close()
+        self.assertEqual(writer.records, list(range(100)))
+        self.assertEqual(async_writer.stats()['written'], 100)
+
+    def test_flush(self):
+        writer = FakeWriter()
+        writer.gate.clear()
+        async_writer = AsyncWriter(writer, max_queue=8)
+        for i in range(5):
+            async_writer.put(i)
+        # Nothing written while the writer is held, flush waits for all of it
+        self.assertEqual(writer.records, [])
+        threading.Timer(0.05, writer.gate.set).start()
+        async_writer.flush()
+        self.assertEqual(writer.records, list(range(5)))
+        self.assertEqual(async_writer.depth(), 0)
+        async_writer.close()
+
+    def test_error_on_put(self):
+        writer = FakeWriter(fail=2)
+        async_writer = AsyncWriter(writer)
+        for i in range(4):
+            async_writer.put(i)
+        async_writer._queue.join()
+        # Records after the failing one are dropped, the error is raised once
+        self.assertRaises(ValueError, async_writer.put, 4)
+        self.assertEqual(writer.records, [0, 1])
+        async_writer.put(5)
+        async_writer.close()
+        self.assertEqual(writer.records, [0, 1, 5])
+
+    def test_error_on_close(self):
+        writer = FakeWriter(fail=0)
+        async_writer = AsyncWriter(writer)
+        async_writer.put(0)
+        self.assertRaises(ValueError, async_writer.close)
+        self.assertEqual(writer.num_closed, 1)
+
+    def test_close_twice(self):
+        writer = FakeWriter()
+        async_writer = AsyncWriter(writer)
+        async_writer.put(0)
+        async_writer.close()
+        async_writer.close()
+        self.assertEqual(writer.num_closed, 1)
+        self.assertEqual(writer.records, [0])
+
+
+class AsyncNPZWriterTest(unittest.TestCase):
+
+    def test_mixed_columns(self):
+        # A ColumnarWriter error reaches the producer through AsyncWriter
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            output_file = os.path.join(tmp_dir, 'output.npz')
+            async_writer = AsyncWriter(NPZWriter(output_file))
+            async_writer.put(make_record(0, 4))
+            async_writer.put(make_record(1, 4, label=False))
+            self.assertRaises(ValueError, async_writer.flush)
+            async_writer.close()
+            np.testing.assert_array_equal(np.load(output_file)['entry'], [0])
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,160 @@
+"""
+Checkpoints written in the background: the state is copied to host memory
+when training asks for a checkpoint, then serialized by a writer thread.
+Files are written to a temporary name and renamed, so a crash never leaves
+a truncated WEIGHT_PREFIX-<iteration>.ckpt. Only the last keep ones are
+kept, and WEIGHT_PREFIX.latest holds the name of the newest one.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from collections import OrderedDict
+import glob
+import os
+import re
+import threading
+import time
+import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import torch
+
+LATEST_SUFFIX = '.latest'
+
+
+def snapshot_state(state):
+    """
+    Copy of state (nested dicts, lists of tensors...) with every tensor
+    copied to host memory, training can go on updating the originals
+    """
+    if torch.is_tensor(state):
+        return state.detach().cpu().clone()
+    if isinstance(state, OrderedDict):
+        return OrderedDict([(key, snapshot_state(value)) for key, value in state.items()])
+    if isinstance(state, dict):
+        return dict([(key, snapshot_state(value)) for key, value in state.items()])
+    if isinstance(state, (list, tuple)):
+        return type(state)([snapshot_state(value) for value in state])
+    return state
+
+
+def resolve_checkpoint(path):
+    """
+    Checkpoint file a WEIGHT_PREFIX.latest pointer refers to, path otherwise
+    """
+    if not path.endswith(LATEST_SUFFIX):
+        return path
+    with open(path) as f:
+        name = f.read().strip()
+    return os.path.join(os.path.dirname(path), name)
+
+
+def checkpoint_files(prefix):
+    """
+    (iteration, file name) of the checkpoints of prefix, by iteration
+    """
+    pattern = re.compile(re.escape(os.path.basename(prefix)) + r'-(\d+)\.ckpt$')
+    res = []
+    for name in glob.glob('%s-*.ckpt' % prefix):
+        match = pattern.match(os.path.basename(name))
+        if match:
+            res.append((int(match.group(1)), name))
+    return sorted(res)
+
+
+def _write_atomic(filename, write):
+    tmp = '%s.tmp' % filename
+    try:
+        with open(tmp, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.rename(tmp, filename)
+
+
+def checkpoint_func(writer):
+    """
+    Writer thread: write checkpoints from the queue until None is received.
+    An exception is kept and raised again in the producer.
+    """
+    while True:
+        item = writer._queue.get()
+        try:
+            if item is None:
+                return
+            if writer._error is not None:
+                continue
+            tstart = time.time()
+            writer._write(*item)
+            writer.tspent_write = time.time() - tstart
+            writer.tspent_sum_write += writer.tspent_write
+            writer.num_written += 1
+        except Exception as e:
+            traceback.print_exc()
+            writer._error = e
+        finally:
+            writer._queue.task_done()
+
+
+class CheckpointWriter(object):
+    """
+    Write checkpoints prefix-<iteration>.ckpt in a background thread.
+    put() only blocks while the previous checkpoint is still being written.
+    After each checkpoint, prefix.latest is updated and only the last keep
+    checkpoints are kept (all of them if keep is 0).
+    """
+
+    def __init__(self, prefix, keep=0):
+        self._prefix = prefix
+        self._keep = keep
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self.num_written = 0
+        self.tspent_write = 0.
+        self.tspent_sum_write = 0.
+        self._thread = threading.Thread(target=checkpoint_func, args=[self])
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, iteration, state):
+        filename = '%s-%d.ckpt' % (self._prefix, iteration)
+        _write_atomic(filename, lambda f: torch.save(state, f))
+        name = os.path.basename(filename).encode('utf-8')
+        _write_atomic(self._prefix + LATEST_SUFFIX, lambda f: f.write(name + b'\n'))
+        if self._keep > 0:
+            for _, old in checkpoint_files(self._prefix)[:-self._keep]:
+                if old != filename:
+                    os.remove(old)
+
+    def put(self, iteration, state):
+        """
+        Queue state (see snapshot_state) as the checkpoint of iteration
+        """
+        self._check()
+        self._queue.put((iteration, state))
+
+    def flush(self):
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        """
+        Write the queued checkpoint and stop the thread
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._check()
@@ -0,0 +1,126 @@
+"""
+Multi-process (DistributedDataParallel) training.
+One process per device (or CPU socket) trains on its shard of the dataset
+(see uresnet.iotools.shard), gradients are all-reduced at every backward.
+launch() starts the NPROC_PER_NODE processes of this node, every one of
+them runs the same command line with its WORLD_SIZE and RANK.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import contextlib
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import torch
+import torch.distributed as dist
+
+
+def is_distributed(flags):
+    """
+    Whether this process trains as one rank of a process group
+    """
+    return flags.TRAIN and flags.WORLD_SIZE > 1
+
+
+def is_main_process(flags):
+    return flags.RANK == 0
+
+
+def launch(flags):
+    """
+    Run NPROC_PER_NODE copies of the current command, as ranks
+    NODE_RANK * NPROC_PER_NODE + i of NNODES * NPROC_PER_NODE, and wait for
+    them. With --gpus, process i gets the i-th GPU. If one fails, the
+    others are terminated.
+    """
+    nproc = flags.NPROC_PER_NODE
+    world_size = flags.NNODES * nproc
+    gpus = [g for g in os.environ.get('CUDA_VISIBLE_DEVICES', '').split(',') if g]
+    if gpus and len(gpus) < nproc:
+        sys.stderr.write('Need one GPU per process (%d GPUs for %d processes)\n' % (len(gpus), nproc))
+        raise ValueError
+    env = dict(os.environ)
+    if 'OMP_NUM_THREADS' not in env:
+        # Share the cores of the node between its processes
+        env['OMP_NUM_THREADS'] = str(max(1, multiprocessing.cpu_count() // nproc))
+    processes = []
+    for local_rank in range(nproc):
+        # Later occurrences of an option override the earlier ones
+        cmd = [sys.executable] + sys.argv + ['--nproc_per_node', '0',
+                                             '--world_size', str(world_size),
+                                             '--rank', str(flags.NODE_RANK * nproc + local_rank),
+                                             '--seed', str(flags.SEED)]
+        if gpus:
+            cmd += ['--gpus', gpus[local_rank]]
+        processes.append(subprocess.Popen(cmd, env=env))
+    print('Started %d processes (ranks %d-%d of %d)' %
+          (nproc, flags.NODE_RANK * nproc, (flags.NODE_RANK + 1) * nproc - 1, world_size))
+    failed = None
+    try:
+        while processes:
+            for process in list(processes):
+                code = process.poll()
+                if code is None:
+                    continue
+                processes.remove(process)
+                if code != 0 and failed is None:
+                    failed = code
+                    for other in processes:
+                        other.terminate()
+            time.sleep(0.1)
+    finally:
+        for process in processes:
+            process.terminate()
+    if failed is not None:
+        sys.stderr.write('A training process failed with exit code %d\n' % failed)
+        sys.exit(failed)
+
+
+def init_distributed(flags):
+    """
+    Join the process group of WORLD_SIZE processes (rendezvous at
+    MASTER_ADDR:MASTER_PORT)
+    """
+    url = 'tcp://%s:%d' % (flags.MASTER_ADDR, flags.MASTER_PORT)
+    print('Rank %d/%d joining %s process group at %s' % (flags.RANK, flags.WORLD_SIZE, flags.DIST_BACKEND, url))
+    dist.init_process_group(backend=flags.DIST_BACKEND, init_method=url,
+                            world_size=flags.WORLD_SIZE, rank=flags.RANK)
+
+
+def finalize_distributed(flags):
+    if is_distributed(flags) and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+@contextlib.contextmanager
+def no_sync(net, skip):
+    """
+    If skip, backward passes of the DistributedDataParallel net within it
+    accumulate local gradients without all-reducing them
+    """
+    if skip:
+        with net.no_sync():
+            yield
+    else:
+        yield
+
+
+def gather_io_states(state, world_size):
+    """
+    IO state (dict {'epoch', 'cursor'} or None) of every rank, in rank order.
+    The nccl backend only gathers tensors of the current GPU.
+    """
+    device = torch.device('cpu')
+    if dist.get_backend() == 'nccl':
+        device = torch.device('cuda', torch.cuda.current_device())
+    value = [-1, -1] if state is None else [state['epoch'], state['cursor']]
+    states = [torch.zeros(2, dtype=torch.int64, device=device) for _ in range(world_size)]
+    dist.all_gather(states, torch.tensor(value, dtype=torch.int64, device=device))
+    res = []
+    for s in states:
+        epoch, cursor = [int(v) for v in s]
+        res.append(None if epoch < 0 else {'epoch': epoch, 'cursor': cursor})
+    return res
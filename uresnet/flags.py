@@ -5,7 +5,8 @@ import torch
 import numpy as np
 import argparse
 import os
-from uresnet.main_funcs import train, iotest, inference
+import sys
+from uresnet.main_funcs import train, iotest, inference, convert
 from distutils.util import strtobool
 
 
@@ -26,6 +27,8 @@ class URESNET_FLAGS:
 
     # flags for train/inference
     COMPUTE_WEIGHT = False
+    WEIGHT_OFFSET  = 3
+    VERTEX_FACTOR  = 3
     SEED           = -1
     LEARNING_RATE  = 0.001
     GPUS           = []
@@ -35,6 +38,22 @@ class URESNET_FLAGS:
     ITERATION      = 10000
     REPORT_STEP    = 100
     CHECKPOINT_STEP  = 500
+    CHECKPOINT_KEEP  = 0
+    ACCUMULATE_GRADIENTS = False
+
+    # flags for distributed training
+    NPROC_PER_NODE = 0
+    NNODES         = 1
+    NODE_RANK      = 0
+    MASTER_ADDR    = '127.0.0.1'
+    MASTER_PORT    = 29500
+    DIST_BACKEND   = 'gloo'
+
+    # flags for IO benchmark (iotest)
+    BENCH_BATCHES = 100
+    BENCH_WARMUP  = 5
+    BENCH_THREADS = ''
+    BENCH_OUTPUT  = ''
 
     # flags for IO
     PLANE      = 0
@@ -49,8 +68,29 @@ class URESNET_FLAGS:
     SHUFFLE    = 1
     LIMIT_NUM_SAMPLE = -1
     NUM_THREADS = 1
+    PREFETCH_DEPTH = 1
+    READER_PROCESSES = False
     DATA_DIM = 3
     PARTICLE = False
+    CACHE_DIR = ''
+    INGEST_WORKERS = 1
+    STREAM_WINDOW = 64
+    POINT_BUDGET = 0
+    BUCKET_POOL = 0
+    OUTPUT_QUEUE = 64
+    OUTPUT_FORMAT = ''
+    OUTPUT_FLOAT16 = False
+    SYNTH_NUM_EVENTS = 1000
+    SYNTH_POINTS = '100,5000'
+    SYNTH_CLASS_MIX = ''
+    VALUE_WINDOW = '10,300'
+    MIN_POINTS = 1
+    COMPACT_STORAGE = False
+    SELECT = ''
+    WORLD_SIZE = 1
+    RANK = 0
+    CROP = ''
+    LABEL_MAP = ''
 
     def __init__(self):
         self._build_parsers()
@@ -92,6 +132,10 @@ class URESNET_FLAGS:
                             help='Limit number of samples to read from input file [default: %s]' % self.LIMIT_NUM_SAMPLE)
         parser.add_argument('-nt','--num-threads',type=int,default=self.NUM_THREADS,
                             help='Number of threads to read input file [default: %s]' % self.NUM_THREADS)
+        parser.add_argument('-pd','--prefetch-depth',type=int,default=self.PREFETCH_DEPTH,
+                            help='Number of ready batches queued per reader thread [default: %s]' % self.PREFETCH_DEPTH)
+        parser.add_argument('-rp','--reader-processes',type=strtobool,default=self.READER_PROCESSES,
+                            help='Assemble batches in processes writing to shared memory instead of threads [default: %s]' % self.READER_PROCESSES)
         parser.add_argument('-dd','--data-dim',type=int,default=self.DATA_DIM,
                             help='Data dimension [default: %s]' % self.DATA_DIM)
         parser.add_argument('-ss','--spatial_size',type=int,default=self.SPATIAL_SIZE,
@@ -104,6 +148,48 @@ class URESNET_FLAGS:
                             help='BatchNorm Momentum for UResNet [default: %s]' % self.BN_MOMENTUM)
         parser.add_argument('-cw','--compute_weight',default=self.COMPUTE_WEIGHT, action='store_true',
                             help='Compute pixel loss weighting factor on the fly [default: %s' % self.COMPUTE_WEIGHT)
+        parser.add_argument('-wo','--weight_offset',type=int,default=self.WEIGHT_OFFSET,
+                            help='Neighborhood half-size (voxels) to find vertices when computing weights [default: %s]' % self.WEIGHT_OFFSET)
+        parser.add_argument('-vf','--vertex_factor',type=float,default=self.VERTEX_FACTOR,
+                            help='Extra loss weight given to vertex/boundary voxels when computing weights [default: %s]' % self.VERTEX_FACTOR)
+        parser.add_argument('-cd','--cache_dir',type=str,default=self.CACHE_DIR,
+                            help='Directory to cache preprocessed input data (disabled if empty) [default: %s]' % self.CACHE_DIR)
+        parser.add_argument('-iw','--ingest_workers',type=int,default=self.INGEST_WORKERS,
+                            help='Number of processes reading the input files in parallel [default: %s]' % self.INGEST_WORKERS)
+        parser.add_argument('-sw','--stream_window',type=int,default=self.STREAM_WINDOW,
+                            help='Number of entries read at once by the larcv_sparse_stream IO [default: %s]' % self.STREAM_WINDOW)
+        parser.add_argument('-pb','--point_budget',type=int,default=self.POINT_BUDGET,
+                            help='Pack events into minibatches of at most this many voxels instead of MINIBATCH_SIZE events (disabled if 0) [default: %s]' % self.POINT_BUDGET)
+        parser.add_argument('-bkp','--bucket_pool',type=int,default=self.BUCKET_POOL,
+                            help='With --point_budget, group events of similar size within pools of this many events (disabled if 0) [default: %s]' % self.BUCKET_POOL)
+        parser.add_argument('-oq','--output_queue',type=int,default=self.OUTPUT_QUEUE,
+                            help='Number of events waiting for the background output writer before inference blocks [default: %s]' % self.OUTPUT_QUEUE)
+        parser.add_argument('-ofmt','--output_format',type=str,default=self.OUTPUT_FORMAT,
+                            help='Output format, larcv, hdf5, npz or null (guessed from the output file extension if empty) [default: %s]' % self.OUTPUT_FORMAT)
+        parser.add_argument('-of16','--output_float16',type=strtobool,default=self.OUTPUT_FLOAT16,
+                            help='Store softmax scores as float16 in hdf5/npz output [default: %s]' % self.OUTPUT_FLOAT16)
+        parser.add_argument('-sne','--synth_num_events',type=int,default=self.SYNTH_NUM_EVENTS,
+                            help='Number of events generated by the synthetic IO [default: %s]' % self.SYNTH_NUM_EVENTS)
+        parser.add_argument('-snp','--synth_points',type=str,default=self.SYNTH_POINTS,
+                            help='Comma-separated min,max voxel count of synthetic events (log-uniform) [default: %s]' % self.SYNTH_POINTS)
+        parser.add_argument('-scm','--synth_class_mix',type=str,default=self.SYNTH_CLASS_MIX,
+                            help='Comma-separated relative frequency of each class in synthetic events (uniform if empty) [default: %s]' % self.SYNTH_CLASS_MIX)
+        parser.add_argument('-vw','--value_window',type=str,default=self.VALUE_WINDOW,
+                            help='Comma-separated min,max voxel value kept at ingest (disabled if empty) [default: %s]' % self.VALUE_WINDOW)
+        parser.add_argument('-mnp','--min_points',type=int,default=self.MIN_POINTS,
+                            help='Drop events with fewer voxels at ingest [default: %s]' % self.MIN_POINTS)
+        parser.add_argument('-crop','--crop',type=str,default=self.CROP,
+                            help='Comma-separated min,max voxel coordinate kept at ingest (disabled if empty) [default: %s]' % self.CROP)
+        parser.add_argument('-lm','--label_map',type=str,default=self.LABEL_MAP,
+                            help='Comma-separated from:to label remapping applied at ingest [default: %s]' % self.LABEL_MAP)
+        parser.add_argument('-cs','--compact_storage',type=strtobool,default=self.COMPACT_STORAGE,
+                            help='Keep the dataset in memory at compact dtypes (int16 coordinates, uint8 labels, no duplicate data column) [default: %s]' % self.COMPACT_STORAGE)
+        parser.add_argument('-sel','--select',type=str,default=self.SELECT,
+                            help='Comma-separated name:value conditions on the event index restricting the sampled events, names min_points, max_points, has_class, min_class_voxels, runs (slash-separated) and limit [default: %s]' % self.SELECT)
+        parser.add_argument('-ws','--world_size',type=int,default=self.WORLD_SIZE,
+                            help='Number of processes sharing the dataset, each loading only its shard of about the same number of voxels (of entries when ingesting larcv files without a full cache), larcv_sparse, packed_sparse and synthetic_sparse IO only [default: %s]' % self.WORLD_SIZE)
+        parser.add_argument('-rk','--rank',type=int,default=self.RANK,
+                            help='Shard (process index) to load, in [0, world_size) [default: %s]' % self.RANK)
         parser.add_argument('-sd','--seed', default=self.SEED,
                                   help='Seed for random number generators [default: %s]' % self.SEED)
         return parser
@@ -121,6 +207,22 @@ class URESNET_FLAGS:
                                   help='Initial learning rate [default: %s]' % self.LEARNING_RATE)
         train_parser.add_argument('-chks','--checkpoint_step', type=int, default=self.CHECKPOINT_STEP,
                                   help='Period (in steps) to store snapshot of weights [default: %s]' % self.CHECKPOINT_STEP)
+        train_parser.add_argument('-chkk','--checkpoint_keep', type=int, default=self.CHECKPOINT_KEEP,
+                                  help='Number of last snapshots of weights to keep (all if 0) [default: %s]' % self.CHECKPOINT_KEEP)
+        train_parser.add_argument('-ag','--accumulate_gradients', default=self.ACCUMULATE_GRADIENTS, action='store_true',
+                                  help='Run backward after each minibatch and step once per batch, memory does not grow with the batch size [default: %s]' % self.ACCUMULATE_GRADIENTS)
+        train_parser.add_argument('-np','--nproc_per_node', type=int, default=self.NPROC_PER_NODE,
+                                  help='Start this many distributed training processes on this node, one per GPU (or CPU socket) (disabled if 0) [default: %s]' % self.NPROC_PER_NODE)
+        train_parser.add_argument('--nnodes', type=int, default=self.NNODES,
+                                  help='Number of nodes of a distributed training [default: %s]' % self.NNODES)
+        train_parser.add_argument('--node_rank', type=int, default=self.NODE_RANK,
+                                  help='Index of this node in a distributed training [default: %s]' % self.NODE_RANK)
+        train_parser.add_argument('--master_addr', type=str, default=self.MASTER_ADDR,
+                                  help='Address of the node running rank 0 of a distributed training [default: %s]' % self.MASTER_ADDR)
+        train_parser.add_argument('--master_port', type=int, default=self.MASTER_PORT,
+                                  help='Free port on the node running rank 0 of a distributed training [default: %s]' % self.MASTER_PORT)
+        train_parser.add_argument('--dist_backend', type=str, default=self.DIST_BACKEND,
+                                  help='torch.distributed backend, gloo (CPU) or nccl (GPU) [default: %s]' % self.DIST_BACKEND)
 
         # inference parser
         inference_parser = subparsers.add_parser("inference",help="Run inference of Edge-GCNN")
@@ -129,26 +231,41 @@ class URESNET_FLAGS:
         inference_parser.add_argument('-p', '--particle', default=self.PARTICLE, action='store_true',
                                       help='Include particle branch [default: %s]' % self.PARTICLE)
         # IO test parser
-        iotest_parser = subparsers.add_parser("iotest", help="Test iotools for Edge-GCNN")
+        iotest_parser = subparsers.add_parser("iotest", help="Benchmark iotools for Edge-GCNN")
+        iotest_parser.add_argument('-nb','--bench_batches', type=int, default=self.BENCH_BATCHES,
+                                   help='Number of batches timed per configuration [default: %s]' % self.BENCH_BATCHES)
+        iotest_parser.add_argument('-nw','--bench_warmup', type=int, default=self.BENCH_WARMUP,
+                                   help='Number of batches read before timing [default: %s]' % self.BENCH_WARMUP)
+        iotest_parser.add_argument('-bt','--bench_threads', type=str, default=self.BENCH_THREADS,
+                                   help='Comma-separated reader thread counts to benchmark (--num-threads if empty) [default: %s]' % self.BENCH_THREADS)
+        iotest_parser.add_argument('-bo','--bench_output', type=str, default=self.BENCH_OUTPUT,
+                                   help='JSON file for the results (printed if empty) [default: %s]' % self.BENCH_OUTPUT)
+        # Conversion parser
+        convert_parser = subparsers.add_parser("convert", help="Convert larcv input to a packed file for -io packed_sparse")
+        convert_parser.add_argument('-p', '--particle', default=self.PARTICLE, action='store_true',
+                                    help='Include particle branch [default: %s]' % self.PARTICLE)
 
         # attach common parsers
         self.train_parser     = self._attach_common_args(train_parser)
         self.inference_parser = self._attach_common_args(inference_parser)
         self.iotest_parser    = self._attach_common_args(iotest_parser)
+        self.convert_parser   = self._attach_common_args(convert_parser)
 
         # attach executables
         self.train_parser.set_defaults(func=train)
         self.inference_parser.set_defaults(func=inference)
         self.iotest_parser.set_defaults(func=iotest)
+        self.convert_parser.set_defaults(func=convert)
 
     def parse_args(self):
         args = self.parser.parse_args()
         self.update(vars(args))
-        print("\n\n-- CONFIG --")
-        for name in vars(self):
-            attribute = getattr(self,name)
-            if type(attribute) == type(self.parser): continue
-            print("%s = %r" % (name, getattr(self, name)))
+        if self.RANK == 0:
+            print("\n\n-- CONFIG --")
+            for name in vars(self):
+                attribute = getattr(self,name)
+                if type(attribute) == type(self.parser): continue
+                print("%s = %r" % (name, getattr(self, name)))
 
         # Set random seed for reproducibility
         np.random.seed(self.SEED)
@@ -171,6 +288,16 @@ class URESNET_FLAGS:
             self.SEED = int(time.time())
         else:
             self.SEED = int(self.SEED)
+        if self.RANK < 0 or self.RANK >= self.WORLD_SIZE:
+            print('RANK (-rk) must be in [0, WORLD_SIZE (-ws))!')
+            raise ValueError
+        # Sharding: the dense and streaming IO would give every rank all the events
+        if self.WORLD_SIZE > 1 and self.IO_TYPE in ['larcv_dense', 'larcv_sparse_stream']:
+            print('IO_TYPE (-io) %s does not shard the dataset, WORLD_SIZE (-ws) > 1 needs larcv_sparse, packed_sparse or synthetic_sparse!' % self.IO_TYPE)
+            raise ValueError
+        if self.SYNTH_CLASS_MIX and len(self.SYNTH_CLASS_MIX.split(',')) != self.NUM_CLASS:
+            print('SYNTH_CLASS_MIX (-scm) must have one value per class (NUM_CLASS (-nc))!')
+            raise ValueError
         # Batch size checker
         if self.BATCH_SIZE < 0 and self.MINIBATCH_SIZE < 0:
             print('Cannot have both BATCH_SIZE (-bs) and MINIBATCH_SIZE (-mbs) negative values!')
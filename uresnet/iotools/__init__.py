@@ -1 +1 @@
-from iotools import io_factory
\ No newline at end of file
+from uresnet.iotools.iotools import io_factory
@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from uresnet.iotools.event_store import EventStore
+from uresnet.iotools.event_index import EventIndex
+
+# Bump when the layout written by save_cache changes
+CACHE_VERSION = 4
+
+
+def cache_path(cache_dir, input_files, config):
+    """
+    Cache directory for a given input and preprocessing configuration.
+    The key covers the input file paths, sizes and modification times
+    and the (json-serializable) config dict.
+    """
+    files = []
+    for f in input_files:
+        stat = os.stat(f)
+        files.append((os.path.abspath(f), stat.st_size, int(stat.st_mtime)))
+    key = json.dumps({'version': CACHE_VERSION, 'files': files, 'config': config},
+                     sort_keys=True)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def save_cache(path, store, event_keys, metas, particles=None, index=None):
+    """
+    Atomically write a preprocessed dataset to path.
+    Everything is written to a temporary directory first, then renamed,
+    so readers never see a partially written cache.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    try:
+        store.save(tmp_path)
+        np.save(os.path.join(tmp_path, 'event_keys.npy'), np.asarray(event_keys, dtype=np.int64))
+        np.save(os.path.join(tmp_path, 'metas.npy'), np.asarray(metas, dtype=np.float64))
+        if particles is not None:
+            particles.save(os.path.join(tmp_path, 'particles'))
+        if index is not None:
+            index.save(os.path.join(tmp_path, 'index'))
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process may have written the same cache concurrently
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+
+def load_cache(path):
+    """
+    Memory-map a dataset written by save_cache.
+    Returns (store, event_keys, metas, particles, index), particles (an
+    EventStore of particle records) and index (an EventIndex) may be None.
+    """
+    store = EventStore.load(path, mmap_mode='r')
+    event_keys = np.load(os.path.join(path, 'event_keys.npy'))
+    metas = np.load(os.path.join(path, 'metas.npy'))
+    particles = None
+    if os.path.isdir(os.path.join(path, 'particles')):
+        particles = EventStore.load(os.path.join(path, 'particles'), mmap_mode='r')
+    index = None
+    if os.path.isdir(os.path.join(path, 'index')):
+        index = EventIndex.load(os.path.join(path, 'index'))
+    return store, event_keys, metas, particles, index
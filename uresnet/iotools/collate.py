@@ -0,0 +1,112 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+
+class BatchBuffers(object):
+    """
+    Reusable output arrays for collate(), in a ring of num_slots batches.
+    advance() starts a new batch: batch k is written into slot
+    k % num_slots, so its arrays are only overwritten num_slots batches
+    later. The consumer must be done with a batch by then (see
+    io_larcv_sparse.held_batches) or keep a copy_batch() of it. Without
+    slots every array is new.
+    """
+
+    def __init__(self, num_slots=0, growth=1.25):
+        self._slots = [{} for _ in range(num_slots)]
+        self._position = 0
+        self._used = {}
+        self._growth = growth
+
+    def advance(self):
+        self._position += 1
+        self._used = {}
+
+    def get(self, key, num_rows, width, dtype):
+        if not self._slots:
+            return np.empty((num_rows, width), dtype=dtype)
+        # A key can be used several times per batch (one per minibatch)
+        count = self._used.get(key, 0)
+        self._used[key] = count + 1
+        slot = self._slots[self._position % len(self._slots)]
+        buf = slot.get((key, count))
+        if buf is None or len(buf) < num_rows or buf.shape[1] != width or buf.dtype != dtype:
+            buf = np.empty((int(num_rows * self._growth) + 1, width), dtype=dtype)
+            slot[(key, count)] = buf
+        return buf[0:num_rows]
+
+
+def data_views(data):
+    """
+    voxels (coordinates, batch id) and feature views of a collated data array
+    """
+    dim = data.shape[1] - 2
+    return data[:, 0:dim+1], data[:, dim+1:]
+
+
+def copy_batch(blob, data_key):
+    """
+    Copy of a batch blob (see make_batch) that stays valid after its reader
+    reuses the arrays, for consumers keeping batches longer than
+    io_larcv_sparse.held_batches(). Particles view the particle table,
+    which is never reused, and are not copied.
+    """
+    res = {}
+    for key, value in blob.items():
+        if key in ['voxels', 'feature', 'particles']:
+            continue
+        res[key] = [np.array(array) for array in value]
+    if 'voxels' in blob:
+        views = [data_views(data) for data in res[data_key]]
+        res['voxels'] = [voxels for voxels, _ in views]
+        res['feature'] = [feature for _, feature in views]
+    if 'particles' in blob:
+        res['particles'] = blob['particles']
+    return res
+
+
+def collate(store, idx_v, data_key, value_keys, first_batch_id=0, buffers=None):
+    """
+    Gather events idx_v of an EventStore into one minibatch in a single pass.
+    Returns a dict with
+        - data_key: (N, dim+2) float32, voxel coordinates, batch id, feature
+        - voxels, feature: views of the coordinate+batch id / feature columns of it
+        - one (N, width) float32 array per key of value_keys (e.g. label, weights)
+    where N is the total number of points of the events, and batch id is
+    first_batch_id plus the position of the event in idx_v. Columns stored
+    at a compact dtype (see transforms.Compact) are widened here.
+    """
+    if buffers is None:
+        buffers = BatchBuffers()
+    idx_v = np.asarray(idx_v, dtype=np.int64)
+    offsets = store.offsets()
+    starts = offsets[idx_v]
+    lengths = offsets[idx_v + 1] - starts
+    ends = np.cumsum(lengths)
+    num_points = int(ends[-1]) if len(ends) else 0
+
+    voxels = store.column('voxels')
+    feature = store.column('feature')
+    dim = voxels.shape[1]
+    data = buffers.get(data_key, num_points, dim + 2, np.float32)
+    columns = {}
+    values = {}
+    for key in value_keys:
+        columns[key] = store.column(key)
+        values[key] = buffers.get(key, num_points, columns[key].shape[1], np.float32)
+
+    data[:, dim] = np.repeat(np.arange(first_batch_id, first_batch_id + len(idx_v), dtype=np.float32), lengths)
+    for i in range(len(idx_v)):
+        start, end = ends[i] - lengths[i], ends[i]
+        src = slice(starts[i], starts[i] + lengths[i])
+        data[start:end, 0:dim] = voxels[src]
+        data[start:end, dim+1:] = feature[src]
+        for key in value_keys:
+            values[key][start:end] = columns[key][src]
+
+    res = {data_key: data}
+    res['voxels'], res['feature'] = data_views(data)
+    res.update(values)
+    return res
@@ -0,0 +1,250 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from collections import OrderedDict
+import json
+import os
+import numpy as np
+
+# Per-event columns of an EventIndex (class_counts is (num_entries, num_classes))
+INDEX_COLUMNS = ['run', 'subrun', 'event', 'file', 'entry', 'num_points', 'feature_sum', 'class_counts']
+
+
+class EventIndex(object):
+    """
+    Per-event summary of a dataset, one row per event of the EventStore:
+        - run, subrun, event: event key
+        - file, entry: input file (index in files()) and entry in it (-1 if unknown)
+        - num_points: number of voxels
+        - feature_sum: sum of the voxel values
+        - class_counts: number of voxels of each label value
+    Queries (select, lookup, stats...) are vectorized over the columns.
+    """
+
+    def __init__(self, columns, files):
+        self._columns = columns
+        self._files = list(files)
+        self._key_order = None
+        self._sorted_keys = None
+
+    @classmethod
+    def build(cls, store, event_keys, entries=None, file_name='', label_key=None, num_classes=0):
+        """
+        Index of the events of store. entries are their entry numbers in
+        file_name, label_key the store column holding the labels.
+        """
+        num_entries = store.num_entries()
+        event_keys = np.asarray(event_keys, dtype=np.int64).reshape([-1, 3])
+        event_id = np.repeat(np.arange(num_entries), store.lengths())
+        columns = OrderedDict()
+        columns['run'] = event_keys[:, 0].copy()
+        columns['subrun'] = event_keys[:, 1].copy()
+        columns['event'] = event_keys[:, 2].copy()
+        columns['file'] = np.zeros(num_entries, dtype=np.int32)
+        if entries is None:
+            columns['entry'] = np.full(num_entries, -1, dtype=np.int64)
+        else:
+            columns['entry'] = np.asarray(entries, dtype=np.int64)
+        columns['num_points'] = store.lengths().astype(np.int64)
+        columns['feature_sum'] = np.bincount(event_id, weights=store.column('feature')[:, 0].astype(np.float64),
+                                             minlength=num_entries)
+        counts = np.zeros((num_entries, num_classes), dtype=np.int64)
+        if label_key is not None and label_key in store.keys():
+            label = store.column(label_key)[:, 0].astype(np.int64)
+            valid = label >= 0
+            width = max(num_classes, int(label.max()) + 1 if valid.any() else 0)
+            counts = np.bincount(event_id[valid] * width + label[valid],
+                                 minlength=num_entries * width).reshape([num_entries, width])
+        columns['class_counts'] = counts
+        return cls(columns, [file_name])
+
+    @classmethod
+    def concatenate(cls, indexes):
+        """
+        Index of the events of all indexes, in order (files are merged by name)
+        """
+        files = []
+        for index in indexes:
+            files.extend([f for f in index.files() if f not in files])
+        width = max([0] + [index.column('class_counts').shape[1] for index in indexes])
+        columns = OrderedDict()
+        for name in INDEX_COLUMNS:
+            values = []
+            for index in indexes:
+                value = index.column(name)
+                if name == 'file':
+                    value = np.array([files.index(f) for f in index.files()], dtype=np.int32)[value]
+                elif name == 'class_counts':
+                    value = np.pad(value, [(0, 0), (0, width - value.shape[1])], 'constant')
+                values.append(value)
+            if values:
+                columns[name] = np.concatenate(values)
+        if not indexes:
+            columns = OrderedDict([(name, np.zeros(0, dtype=np.int64)) for name in INDEX_COLUMNS])
+            columns['class_counts'] = np.zeros((0, 0), dtype=np.int64)
+        return cls(columns, files)
+
+    def __len__(self):
+        return len(self._columns['run'])
+
+    def take(self, idx):
+        """
+        Index of the events idx (array of indices or slice), in that order
+        """
+        return EventIndex(OrderedDict([(name, value[idx]) for name, value in self._columns.items()]),
+                          self._files)
+
+    def files(self):
+        return list(self._files)
+
+    def column(self, name):
+        return self._columns[name]
+
+    def select(self, min_points=None, max_points=None, has_class=None, min_class_voxels=1,
+               runs=None, files=None, limit=None):
+        """
+        Sorted indices of the events matching every given condition:
+            - min_points <= num_points <= max_points
+            - at least min_class_voxels voxels of class has_class
+            - run in runs, file name in files
+        limit keeps the first limit of them.
+        """
+        mask = np.ones(len(self), dtype=np.bool_)
+        num_points = self._columns['num_points']
+        if min_points is not None:
+            mask &= num_points >= min_points
+        if max_points is not None:
+            mask &= num_points <= max_points
+        if has_class is not None:
+            counts = self._columns['class_counts']
+            if has_class < counts.shape[1]:
+                mask &= counts[:, has_class] >= min_class_voxels
+            else:
+                mask[:] = False
+        if runs is not None:
+            mask &= np.isin(self._columns['run'], runs)
+        if files is not None:
+            file_ids = [i for i, f in enumerate(self._files) if f in files]
+            mask &= np.isin(self._columns['file'], file_ids)
+        idx = np.flatnonzero(mask)
+        if limit is not None and limit >= 0:
+            idx = idx[0:limit]
+        return idx
+
+    def split(self, fraction, seed=0, idx=None):
+        """
+        Random (first, second) partition of idx (all events by default), with
+        fraction of the events in second, e.g. for a validation split.
+        Both are sorted, the same seed gives the same partition.
+        """
+        if idx is None:
+            idx = np.arange(len(self))
+        permutation = np.random.RandomState(seed % 2**32).permutation(len(idx))
+        num_second = int(round(fraction * len(idx)))
+        second = np.sort(idx[permutation[0:num_second]])
+        first = np.sort(idx[permutation[num_second:]])
+        return first, second
+
+    def lookup(self, keys):
+        """
+        Index of the event with key (run, subrun, event), -1 if there is none.
+        keys can also be a (K, 3) array, then an array of K indices is returned.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        single = keys.ndim == 1
+        keys = keys.reshape([-1, 3])
+        if self._key_order is None:
+            # Keys as records sort (and compare) by run, then subrun, then event
+            self._sorted_keys = self._records([self._columns[name] for name in ['run', 'subrun', 'event']])
+            self._key_order = np.argsort(self._sorted_keys, kind='mergesort')
+            self._sorted_keys = self._sorted_keys[self._key_order]
+        res = np.full(len(keys), -1, dtype=np.int64)
+        if len(self._sorted_keys):
+            query = self._records(keys.T)
+            pos = np.minimum(np.searchsorted(self._sorted_keys, query), len(self._sorted_keys) - 1)
+            found = self._sorted_keys[pos] == query
+            res[found] = self._key_order[pos[found]]
+        return int(res[0]) if single else res
+
+    @staticmethod
+    def _records(columns):
+        records = np.empty(len(columns[0]), dtype=[('run', np.int64), ('subrun', np.int64), ('event', np.int64)])
+        for name, values in zip(['run', 'subrun', 'event'], columns):
+            records[name] = values
+        return records
+
+    def histogram(self, bins=20, idx=None):
+        """
+        (counts, bin edges) of the number of points per event (log-spaced bins)
+        """
+        num_points = self._columns['num_points'] if idx is None else self._columns['num_points'][idx]
+        if not len(num_points):
+            return np.zeros(bins, dtype=np.int64), np.zeros(bins + 1)
+        edges = np.logspace(0, np.log10(max(2, num_points.max() + 1)), bins + 1)
+        return np.histogram(num_points, bins=edges)
+
+    def stats(self, idx=None):
+        """
+        Dataset statistics (dict) over the events idx (all by default)
+        """
+        columns = self._columns if idx is None else dict([(name, value[idx]) for name, value in self._columns.items()])
+        num_points = columns['num_points']
+        counts = columns['class_counts']
+        percentiles = np.percentile(num_points, [0, 50, 90, 99, 100]) if len(num_points) else np.zeros(5)
+        return {'num_events'    : int(len(num_points)),
+                'num_points'    : int(num_points.sum()),
+                'points_min'    : float(percentiles[0]),
+                'points_p50'    : float(percentiles[1]),
+                'points_p90'    : float(percentiles[2]),
+                'points_p99'    : float(percentiles[3]),
+                'points_max'    : float(percentiles[4]),
+                'feature_sum'   : float(columns['feature_sum'].sum()),
+                'class_voxels'  : [int(v) for v in counts.sum(axis=0)],
+                'class_events'  : [int(v) for v in (counts > 0).sum(axis=0)],
+                'num_files'     : int(len(np.unique(columns['file'])))}
+
+    def report(self, idx=None):
+        stats = self.stats(idx)
+        msg = '%d events from %d files, %d points (per event: min %d median %d p90 %d p99 %d max %d)\n'
+        msg = msg % (stats['num_events'], stats['num_files'], stats['num_points'], stats['points_min'],
+                     stats['points_p50'], stats['points_p90'], stats['points_p99'], stats['points_max'])
+        for c, (voxels, events) in enumerate(zip(stats['class_voxels'], stats['class_events'])):
+            msg += '   class %d: %d voxels in %d events\n' % (c, voxels, events)
+        return msg
+
+    def to_arrays(self, prefix='index_'):
+        arrays = OrderedDict()
+        for name in INDEX_COLUMNS:
+            arrays[prefix + name] = self._columns[name]
+        arrays[prefix + 'files'] = np.array(self._files, dtype=np.str_)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix='index_'):
+        """
+        Inverse of to_arrays, None if arrays holds no index
+        """
+        if prefix + 'run' not in arrays:
+            return None
+        columns = OrderedDict([(name, np.asarray(arrays[prefix + name])) for name in INDEX_COLUMNS])
+        return cls(columns, [str(f) for f in arrays[prefix + 'files']])
+
+    def save(self, directory):
+        """
+        Write every column as a .npy file and the file names into directory
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in INDEX_COLUMNS:
+            np.save(os.path.join(directory, '%s.npy' % name), self._columns[name])
+        with open(os.path.join(directory, 'files.json'), 'w') as f:
+            json.dump(self._files, f)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'files.json')) as f:
+            files = [str(name) for name in json.load(f)]
+        columns = OrderedDict()
+        for name in INDEX_COLUMNS:
+            columns[name] = np.load(os.path.join(directory, '%s.npy' % name))
+        return cls(columns, files)
@@ -0,0 +1,203 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from collections import OrderedDict
+import json
+import os
+import numpy as np
+
+
+class EventColumn(object):
+    """
+    Read-only, list-like view of one column of an EventStore.
+    column[idx] returns the points of event idx as a zero-copy slice.
+    """
+
+    def __init__(self, store, name):
+        self._store = store
+        self._name = name
+
+    def __len__(self):
+        return self._store.num_entries()
+
+    def __getitem__(self, idx):
+        return self._store.event(self._name, idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class EventStore(object):
+    """
+    Packed (CSR-style) storage for variable-length sparse events.
+    Every column is one contiguous (num_points, width) array shared by all
+    events, event idx owns rows offsets[idx]:offsets[idx+1] of each column.
+    """
+
+    def __init__(self, capacity=1024):
+        self._offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self._columns = OrderedDict()
+        self._num_entries = 0
+        self._num_points = 0
+
+    @classmethod
+    def from_arrays(cls, offsets, columns):
+        """
+        Wrap already packed arrays (no copy).
+        offsets has shape (num_entries+1,), columns maps name -> (num_points, width)
+        """
+        store = cls(capacity=0)
+        store._offsets = np.asarray(offsets, dtype=np.int64)
+        store._num_entries = len(store._offsets) - 1
+        store._num_points = int(store._offsets[-1])
+        for name, array in columns.items():
+            if len(array) != store._num_points:
+                msg = 'Column %s has %d points, offsets expect %d'
+                raise ValueError(msg % (name, len(array), store._num_points))
+            store._columns[name] = array
+        return store
+
+    @classmethod
+    def concatenate(cls, stores):
+        """
+        Store holding the events of all stores, in order.
+        The data is copied unless there is a single non-empty store.
+        """
+        if not stores:
+            raise ValueError('Cannot concatenate an empty list of stores')
+        first = stores[0]
+        stores = [store for store in stores if store.num_entries() > 0]
+        if not stores:
+            return first
+        if len(stores) == 1:
+            return stores[0]
+        offsets = [np.zeros(1, dtype=np.int64)]
+        shift = 0
+        for store in stores:
+            offsets.append(store.offsets()[1:] + shift)
+            shift += store.num_points()
+        columns = OrderedDict()
+        for name in stores[0].keys():
+            columns[name] = np.concatenate([store.column(name) for store in stores])
+        return cls.from_arrays(np.concatenate(offsets), columns)
+
+    def _reserve(self, num_entries, num_points):
+        if num_entries + 1 > len(self._offsets):
+            capacity = max(num_entries + 1, 2 * len(self._offsets))
+            offsets = np.zeros(capacity, dtype=np.int64)
+            offsets[0:self._num_entries+1] = self._offsets[0:self._num_entries+1]
+            self._offsets = offsets
+        for name, array in self._columns.items():
+            if num_points <= len(array):
+                continue
+            capacity = max(num_points, 2 * len(array))
+            column = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+            column[0:self._num_points] = array[0:self._num_points]
+            self._columns[name] = column
+
+    def append(self, columns):
+        """
+        Append one event given as a dict name -> (N, width) array.
+        The first appended event defines the set of columns and their dtype.
+        Returns the index of the new event.
+        """
+        num_point = None
+        for name, array in columns.items():
+            if num_point is None:
+                num_point = len(array)
+            elif len(array) != num_point:
+                msg = 'Column %s has %d points, expected %d'
+                raise ValueError(msg % (name, len(array), num_point))
+        if not self._columns:
+            for name, array in columns.items():
+                self._columns[name] = np.empty((0,) + array.shape[1:], dtype=array.dtype)
+        elif set(columns.keys()) != set(self._columns.keys()):
+            msg = 'Event columns %s do not match store columns %s'
+            raise KeyError(msg % (sorted(columns.keys()), sorted(self._columns.keys())))
+        self._reserve(self._num_entries + 1, self._num_points + num_point)
+        start, end = self._num_points, self._num_points + num_point
+        for name, array in columns.items():
+            self._columns[name][start:end] = array
+        self._num_entries += 1
+        self._num_points = end
+        self._offsets[self._num_entries] = end
+        return self._num_entries - 1
+
+    def finalize(self):
+        """
+        Release the spare capacity left over from appending.
+        """
+        self._offsets = self._offsets[0:self._num_entries+1].copy()
+        for name, array in self._columns.items():
+            if len(array) != self._num_points:
+                self._columns[name] = array[0:self._num_points].copy()
+
+    def slice(self, start, end, copy=False):
+        """
+        Store of events [start, end), viewing the same columns unless copy is set
+        """
+        offsets = self.offsets()[start:end+1]
+        columns = OrderedDict()
+        for name in self._columns.keys():
+            columns[name] = self.column(name)[offsets[0]:offsets[-1]]
+            if copy:
+                columns[name] = columns[name].copy()
+        return EventStore.from_arrays(offsets - offsets[0], columns)
+
+    def keys(self):
+        return list(self._columns.keys())
+
+    def num_entries(self):
+        return self._num_entries
+
+    def num_points(self):
+        return self._num_points
+
+    def nbytes(self):
+        return self.offsets().nbytes + sum(self.column(name).nbytes for name in self._columns)
+
+    def offsets(self):
+        return self._offsets[0:self._num_entries+1]
+
+    def lengths(self):
+        return np.diff(self.offsets())
+
+    def column(self, name):
+        return self._columns[name][0:self._num_points]
+
+    def event(self, name, idx):
+        if idx < 0:
+            idx += self._num_entries
+        if idx < 0 or idx >= self._num_entries:
+            raise IndexError('Event index %d out of range (%d entries)' % (idx, self._num_entries))
+        return self._columns[name][self._offsets[idx]:self._offsets[idx+1]]
+
+    def view(self, name):
+        return EventColumn(self, name)
+
+    def save(self, directory):
+        """
+        Write offsets and every column as .npy files (memory-mappable) into directory.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, 'offsets.npy'), self.offsets())
+        for name in self._columns.keys():
+            np.save(os.path.join(directory, 'column_%s.npy' % name), self.column(name))
+        with open(os.path.join(directory, 'columns.json'), 'w') as f:
+            json.dump(list(self._columns.keys()), f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Inverse of save. With mmap_mode='r' columns are memory-mapped, not read.
+        """
+        with open(os.path.join(directory, 'columns.json')) as f:
+            names = json.load(f)
+        offsets = np.load(os.path.join(directory, 'offsets.npy'))
+        columns = OrderedDict()
+        for name in names:
+            columns[str(name)] = np.load(os.path.join(directory, 'column_%s.npy' % name),
+                                         mmap_mode=mmap_mode)
+        return cls.from_arrays(offsets, columns)
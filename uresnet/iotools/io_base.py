@@ -22,6 +22,8 @@ class io_base(object):
         self._blob = {}
         self.tspent_io = 0
         self.tspent_sum_io = 0
+        # Time reader threads spent blocked on a full prefetch queue
+        self.tspent_sum_blocked = 0
 
     def blob(self):
         return self._blob
@@ -44,6 +46,15 @@ class io_base(object):
     def set_index_start(self,idx):
         raise NotImplementedError
 
+    def state(self):
+        """
+        Data position to store in a checkpoint, None if it cannot be restored
+        """
+        return None
+
+    def restore_state(self,state):
+        raise NotImplementedError
+
     def start_threads(self):
         raise NotImplementedError
 
@@ -63,5 +74,11 @@ class io_base(object):
     def store_segment(self, idx, data, softmax):
         raise NotImplementedError
 
+    def output_stats(self):
+        """
+        Statistics of the output writer (dict), None if there is none
+        """
+        return None
+
     def finalize(self):
         raise NotImplementedError
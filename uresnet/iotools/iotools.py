@@ -1,10 +1,19 @@
-from iotools_sparse import io_larcv_sparse
-from iotools_dense import io_larcv_dense
+from uresnet.iotools.iotools_sparse import io_larcv_sparse
+from uresnet.iotools.iotools_dense import io_larcv_dense
+from uresnet.iotools.iotools_stream import io_larcv_sparse_stream
+from uresnet.iotools.iotools_packed import io_packed_sparse
+from uresnet.iotools.iotools_synthetic import io_synthetic_sparse
 
 
 def io_factory(flags):
     if flags.IO_TYPE == 'larcv_sparse':  # SSCN I/O
         return io_larcv_sparse(flags)
+    if flags.IO_TYPE == 'larcv_sparse_stream':  # SSCN I/O reading the input incrementally
+        return io_larcv_sparse_stream(flags)
+    if flags.IO_TYPE == 'packed_sparse':  # SSCN I/O reading packed files (no ROOT needed)
+        return io_packed_sparse(flags)
+    if flags.IO_TYPE == 'synthetic_sparse':  # SSCN I/O serving generated events
+        return io_synthetic_sparse(flags)
     if flags.IO_TYPE == 'larcv_dense':  # Dense I/O
         return io_larcv_dense(flags)
     raise NotImplementedError
@@ -0,0 +1,45 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import sys
+import numpy as np
+from uresnet.iotools.iotools_sparse import io_larcv_sparse, build_index
+from uresnet.iotools.event_index import EventIndex
+from uresnet.iotools.event_store import EventStore
+from uresnet.iotools.packed import load_packed
+
+
+class io_packed_sparse(io_larcv_sparse):
+    """
+    Sparse IO reading packed files (see uresnet.iotools.packed, written by
+    the convert command) instead of larcv ROOT files. Batching, reader
+    threads and output are the ones of io_larcv_sparse. Ingest options
+    (weights, transforms...) were applied when the files were converted.
+    """
+
+    def initialize(self):
+        results = []
+        for f in self._flags.INPUT_FILE:
+            print('Loading packed data from %s' % f)
+            results.append(load_packed(f))
+        self._store = EventStore.concatenate([r[0] for r in results])
+        self._event_keys = np.concatenate([r[1] for r in results])
+        self._metas = np.concatenate([r[2] for r in results])
+        self._particles = None
+        if self._flags.PARTICLE:
+            if any([r[3] is None for r in results]):
+                raise KeyError('Packed input has no particle table (convert with --particle)')
+            self._particles = EventStore.concatenate([r[3] for r in results])
+        # Files converted without an index get one without input entries
+        indexes = []
+        for f, r in zip(self._flags.INPUT_FILE, results):
+            indexes.append(r[4] if r[4] is not None else build_index(self._flags, r[0], r[1], file_name=f))
+        self._index = EventIndex.concatenate(indexes)
+        for key in self._flags.DATA_KEYS[1:] + ['voxels', 'feature']:
+            if key not in self._store.keys():
+                msg = 'Column %s not found in packed input (columns: %s)'
+                raise KeyError(msg % (key, ', '.join(self._store.keys())))
+        self._blob = {}
+        self._attach_store()
+        sys.stdout.write('Total: %d samples (%d points) ... %d MB\n' % (self._store.num_entries(),self._store.num_points(),self._store.nbytes()/1.e6))
+        print('done')
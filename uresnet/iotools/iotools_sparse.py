@@ -1,67 +1,69 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import argparse
 import numpy as np
+import os
 import sys
 import threading
 import time
+import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 from uresnet.iotools.io_base import io_base
+from uresnet.iotools.event_store import EventStore
+from uresnet.iotools.event_index import EventIndex
+from uresnet.iotools.cache import cache_path, save_cache, load_cache
+from uresnet.iotools.collate import BatchBuffers, collate, data_views
+from uresnet.iotools.transforms import build_transforms
+from uresnet.iotools.sampler import EpochSampler, BudgetSampler
+from uresnet.iotools.writer import AsyncWriter, make_writer
+from uresnet.iotools.packed import save_packed
+from uresnet.iotools.shard import shard_bounds, shard_entry_ranges
+
+
+# One record per particle, see get_particle_info
+PARTICLE_DTYPE = np.dtype([('particle_idx'      , np.int32),
+                           ('primary'           , np.int8),
+                           ('pdg_code'          , np.int32),
+                           ('mass'              , np.float32),
+                           ('creation_x'        , np.float32),
+                           ('creation_y'        , np.float32),
+                           ('creation_z'        , np.float32),
+                           ('direction_x'       , np.float32),
+                           ('direction_y'       , np.float32),
+                           ('direction_z'       , np.float32),
+                           ('start_x'           , np.float32),
+                           ('start_y'           , np.float32),
+                           ('start_z'           , np.float32),
+                           ('end_x'             , np.float32),
+                           ('end_y'             , np.float32),
+                           ('end_z'             , np.float32),
+                           ('creation_energy'   , np.float32),
+                           ('creation_momentum' , np.float32),
+                           ('deposited_energy'  , np.float32),
+                           ('npx'               , np.int32),
+                           ('creation_process'  , 'S32'),
+                           ('category'          , np.int8)])
 
 
 def get_particle_info(particle_v):
+    """
+    Particles of one event as a structured array of PARTICLE_DTYPE records
+    """
     from larcv import larcv
     num_particles = particle_v.size()
-    part_info = {'particle_idx' : np.arange(0,num_particles),
-                 'primary'      : np.zeros(num_particles,np.int8),
-                 'pdg_code'     : np.zeros(num_particles,np.int32),
-                 'mass'         : np.zeros(num_particles,np.float32),
-                 'creation_x'   : np.zeros(num_particles,np.float32),
-                 'creation_y'   : np.zeros(num_particles,np.float32),
-                 'creation_z'   : np.zeros(num_particles,np.float32),
-                 'direction_x'  : np.zeros(num_particles,np.float32),
-                 'direction_y'  : np.zeros(num_particles,np.float32),
-                 'direction_z'  : np.zeros(num_particles,np.float32),
-                 'start_x'      : np.zeros(num_particles,np.float32),
-                 'start_y'      : np.zeros(num_particles,np.float32),
-                 'start_z'      : np.zeros(num_particles,np.float32),
-                 'end_x'        : np.zeros(num_particles,np.float32),
-                 'end_y'        : np.zeros(num_particles,np.float32),
-                 'end_z'        : np.zeros(num_particles,np.float32),
-                 'creation_energy'   : np.zeros(num_particles,np.float32),
-                 'creation_momentum' : np.zeros(num_particles,np.float32),
-                 'deposited_energy'  : np.zeros(num_particles,np.float32),
-                 'npx'               : np.zeros(num_particles,np.int32),
-                 'creation_process'  : ['']*num_particles,
-                 'category'          : np.zeros(num_particles,np.int8)
-                 }
-
+    rows = []
     for idx in range(num_particles):
         particle = particle_v[idx]
         pdg_code = particle.pdg_code()
         mass     = larcv.ParticleMass(pdg_code)
-        momentum = np.float32(np.sqrt(np.power(particle.px(),2)+
-                                      np.power(particle.py(),2)+
-                                      np.power(particle.pz(),2)))
-
-        part_info[ 'primary'     ][idx] = np.int8(particle.track_id() == particle.parent_track_id())
-        part_info[ 'pdg_code'    ][idx] = np.int32(pdg_code)
-        part_info[ 'mass'        ][idx] = np.float32(mass)
-        part_info[ 'creation_x'  ][idx] = np.float32(particle.x())
-        part_info[ 'creation_y'  ][idx] = np.float32(particle.y())
-        part_info[ 'creation_z'  ][idx] = np.float32(particle.z())
-        part_info[ 'direction_x' ][idx] = np.float32(particle.px()/momentum)
-        part_info[ 'direction_y' ][idx] = np.float32(particle.py()/momentum)
-        part_info[ 'direction_z' ][idx] = np.float32(particle.pz()/momentum)
-        part_info[ 'start_x'     ][idx] = np.float32(particle.first_step().x())
-        part_info[ 'start_y'     ][idx] = np.float32(particle.first_step().y())
-        part_info[ 'start_z'     ][idx] = np.float32(particle.first_step().z())
-        part_info[ 'end_x'       ][idx] = np.float32(particle.last_step().x())
-        part_info[ 'end_y'       ][idx] = np.float32(particle.last_step().y())
-        part_info[ 'end_z'       ][idx] = np.float32(particle.last_step().z())
-        part_info[ 'creation_energy'   ][idx] = np.float32(particle.energy_init() - mass)
-        part_info[ 'creation_momentum' ][idx] = momentum
-        part_info[ 'deposited_energy'  ][idx] = np.float32(particle.energy_deposit())
-        part_info[ 'npx'               ][idx] = np.int32(particle.num_voxels())
+        px, py, pz = particle.px(), particle.py(), particle.pz()
+        momentum = np.float32(np.sqrt(px*px + py*py + pz*pz))
+        first_step = particle.first_step()
+        last_step  = particle.last_step()
 
         category = -1
         process  = particle.creation_process()
@@ -76,477 +78,792 @@ def get_particle_info(particle_v):
                 print('Unidentified process found: PDG=%d creation_process="%s"' % (pdg_code,process))
                 raise ValueError
 
-        part_info[ 'creation_process'  ][idx] = process
-        part_info[ 'category'          ][idx] = category
-    return part_info
+        rows.append((idx,
+                     particle.track_id() == particle.parent_track_id(),
+                     pdg_code,
+                     mass,
+                     particle.x(), particle.y(), particle.z(),
+                     px/momentum, py/momentum, pz/momentum,
+                     first_step.x(), first_step.y(), first_step.z(),
+                     last_step.x(), last_step.y(), last_step.z(),
+                     particle.energy_init() - mass,
+                     momentum,
+                     particle.energy_deposit(),
+                     particle.num_voxels(),
+                     process,
+                     category))
+    return np.array(rows, dtype=PARTICLE_DTYPE)
+
+
+def meta_to_array(meta, dim):
+    """
+    Flatten a larcv ImageMeta (2D) or Voxel3DMeta (3D) into a float array
+    """
+    if dim == 2:
+        return np.array([meta.min_x(), meta.min_y(), meta.max_x(), meta.max_y(),
+                         meta.rows(), meta.cols(), meta.id(), meta.unit()], dtype=np.float64)
+    return np.array([meta.min_x(), meta.min_y(), meta.min_z(),
+                     meta.max_x(), meta.max_y(), meta.max_z(),
+                     meta.num_voxel_x(), meta.num_voxel_y(), meta.num_voxel_z(),
+                     meta.unit()], dtype=np.float64)
 
 
-def threadio_func(io_handle, thread_id):
+def array_to_meta(values, dim):
+    """
+    Inverse of meta_to_array
+    """
+    from larcv import larcv
+    if dim == 2:
+        return larcv.ImageMeta(float(values[0]), float(values[1]), float(values[2]), float(values[3]),
+                               int(values[4]), int(values[5]), int(values[6]), int(values[7]))
+    meta = larcv.Voxel3DMeta()
+    meta.set(float(values[0]), float(values[1]), float(values[2]),
+             float(values[3]), float(values[4]), float(values[5]),
+             int(values[6]), int(values[7]), int(values[8]), int(values[9]))
+    return meta
+
+
+def compute_weights(voxels, labels, offset=3, vertex_factor=3):
+    """
+    Per-voxel loss weight: voxels with a differently labelled neighbor
+    within offset in x and y (vertices and boundaries) get
+    (1+vertex_factor)*0.5, all others 0.5.
+    Voxels are hashed into (x,y) cells, and each of the (2*offset+1)^2
+    neighboring cells is looked up with a binary search, comparing against
+    the min/max label of the cell. Cost is O(N log N) instead of O(N^2).
+    """
+    shape = labels.shape
+    labels = labels.reshape([-1])
+    weights = np.ones(shape=shape,dtype=np.float32)
+    ver_weights = np.zeros(shape=shape,dtype=np.float32)
+    if len(labels) < 2:
+        return np.add(ver_weights,weights)*0.5
+    # Shift coordinates so that all neighbor cells have a non-negative key
+    x = voxels[:,0].astype(np.int64) - int(voxels[:,0].min()) + offset
+    y = voxels[:,1].astype(np.int64) - int(voxels[:,1].min()) + offset
+    ny = int(y.max()) + offset + 1
+    key = x * ny + y
+    order = np.argsort(key, kind='mergesort')
+    sorted_key = key[order]
+    starts = np.concatenate([[0], np.where(np.diff(sorted_key) != 0)[0] + 1])
+    cells = sorted_key[starts]
+    cell_min = np.minimum.reduceat(labels[order], starts)
+    cell_max = np.maximum.reduceat(labels[order], starts)
+    is_vertex = np.zeros(len(labels), dtype=np.bool_)
+    for dx in range(-offset, offset+1):
+        for dy in range(-offset, offset+1):
+            neighbor = key + dx * ny + dy
+            pos = np.minimum(np.searchsorted(cells, neighbor), len(cells)-1)
+            found = cells[pos] == neighbor
+            is_vertex |= found & ((cell_min[pos] != labels) | (cell_max[pos] != labels))
+    ver_weights[is_vertex.reshape(shape)] = vertex_factor
+    return np.add(ver_weights,weights)*0.5
+
+
+def larcv_sparse_functions(data_dim):
+    """
+    Returns (dtype_keyword, as_numpy_voxels, as_numpy_pcloud, as_meta) for 2D/3D
+    """
+    from larcv import larcv
+    if data_dim == 3:
+        return 'sparse3d', larcv.fill_3d_voxels, larcv.fill_3d_pcloud, larcv.Voxel3DMeta
+    elif data_dim == 2:
+        return 'sparse2d', larcv.fill_2d_voxels, larcv.fill_2d_pcloud, larcv.ImageMeta
+    print('larcv IO not implemented for data dimension', data_dim)
+    raise NotImplementedError
+
+
+def count_larcv_entries(flags, input_file):
+    """
+    Number of entries read from input_file (honors LIMIT_NUM_SAMPLE)
+    """
+    from ROOT import TChain
+    dtype_keyword = larcv_sparse_functions(flags.DATA_DIM)[0]
+    ch = TChain('%s_%s_tree' % (dtype_keyword, flags.DATA_KEYS[0]))
+    ch.AddFile(input_file)
+    num_entries = ch.GetEntries()
+    if flags.LIMIT_NUM_SAMPLE > 0:
+        num_entries = min(num_entries, flags.LIMIT_NUM_SAMPLE)
+    return num_entries
+
+
+def build_index(flags, store, event_keys, entries=None, file_name=''):
+    """
+    EventIndex of store, class counts taken from the label column DATA_KEYS[1]
+    """
+    label_key = flags.DATA_KEYS[1] if len(flags.DATA_KEYS) > 1 else None
+    return EventIndex.build(store, event_keys, entries, file_name, label_key, flags.NUM_CLASS)
+
+
+def parse_selection(selection):
+    """
+    EventIndex.select keyword arguments from a 'name:value,...' string
+    """
+    kwargs = {}
+    for condition in selection.split(','):
+        name, value = condition.split(':')
+        if name == 'runs':
+            kwargs[name] = [int(v) for v in value.split('/')]
+        else:
+            kwargs[name] = int(value)
+    return kwargs
+
+
+def read_larcv_sparse(flags, input_file, entry_start=0, entry_end=None, verbose=False):
+    """
+    Read entries [entry_start, entry_end) of one larcv file into an EventStore.
+    Returns (store, event_keys, metas, particles, index), particles is None
+    unless flags.PARTICLE is set, otherwise an EventStore with a single
+    'particles' column of PARTICLE_DTYPE records. index is the EventIndex
+    of the events read. Empty events are skipped.
+    """
+    from ROOT import TChain
+    plane_id = flags.PLANE
+    dtype_keyword, as_numpy_voxels, as_numpy_pcloud, as_meta = larcv_sparse_functions(flags.DATA_DIM)
+    store = EventStore()
+    event_keys = []
+    entries = []
+    metas = []
+    particles = EventStore() if flags.PARTICLE else None
+    ch_blob = {}
+    br_blob = {}
+    for key in flags.DATA_KEYS:
+        if flags.COMPUTE_WEIGHT and key == flags.DATA_KEYS[2]:
+            continue
+        ch_blob[key] = TChain('%s_%s_tree' % (dtype_keyword, key))
+    if flags.PARTICLE:
+        ch_blob['mcst'] = TChain('particle_mcst_tree')
+    for ch in ch_blob.values():
+        ch.AddFile(input_file)
+    if entry_end is None:
+        entry_end = ch_blob[flags.DATA_KEYS[0]].GetEntries()
+        if flags.LIMIT_NUM_SAMPLE > 0:
+            entry_end = min(entry_end, flags.LIMIT_NUM_SAMPLE)
+    event_fraction = 1./max(1, entry_end - entry_start) * 100.
+    transform = build_transforms(flags)
+    total_data = 0.
+
+    for entry in range(entry_start, entry_end):
+        for key, ch in ch_blob.iteritems():
+            ch.GetEntry(entry)
+            if key not in br_blob:
+                if key == 'mcst':
+                    br_blob[key] = getattr(ch, 'particle_mcst_branch')
+                else:
+                    br_blob[key] = getattr(ch, '%s_%s_branch' % (dtype_keyword, key))
+
+        br_data = br_blob[flags.DATA_KEYS[0]]
+        event_key = (br_data.run(), br_data.subrun(), br_data.event())
+        if flags.DATA_DIM == 2:
+            br_data = br_data.as_vector().at(plane_id)
+        num_point = br_data.as_vector().size()
+        if num_point < 1: continue
+
+        # special treatment for the data
+        event = {}
+        np_data  = np.zeros(shape=(num_point, flags.DATA_DIM+1),dtype=np.float32)
+        as_numpy_pcloud(br_data, np_data)
+        event[flags.DATA_KEYS[0]] = np_data
+
+        np_voxel   = np.zeros(shape=(num_point,flags.DATA_DIM),dtype=np.int32)
+        as_numpy_voxels(br_data, np_voxel)
+        event['voxels'] = np_voxel
+
+        np_feature = np.zeros(shape=(num_point,1),dtype=np.float32)
+        as_numpy_pcloud(br_data,  np_feature)
+        event['feature'] = np_feature
+
+        # for the rest, different treatment
+        for key in flags.DATA_KEYS[1:]:
+            if flags.COMPUTE_WEIGHT and key == flags.DATA_KEYS[2]:
+                continue
+            br = br_blob[key]
+            if flags.DATA_DIM == 2:
+                br = br.as_vector().at(plane_id)
+            np_data = np.zeros(shape=(num_point,1),dtype=np.float32)
+            as_numpy_pcloud(br,np_data)
+            event[key] = np_data
+
+        # if weights need to be computed, compute here using label (index 1)
+        if flags.COMPUTE_WEIGHT:
+            event[flags.DATA_KEYS[2]] = compute_weights(np_voxel, event[flags.DATA_KEYS[1]],
+                                                        flags.WEIGHT_OFFSET, flags.VERTEX_FACTOR)
+
+        event = transform(event)
+        if event is None: continue
+
+        store.append(event)
+        event_keys.append(event_key)
+        entries.append(entry)
+        metas.append(meta_to_array(as_meta(br_data.meta()), flags.DATA_DIM))
+        if flags.PARTICLE:
+            particles.append({'particles': get_particle_info(br_blob['mcst'].as_vector())})
+
+        total_data  += sum([v.size for v in event.values()])
+        if verbose:
+            sys.stdout.write('Processed %d samples (%d%% ... %d MB\r' % (store.num_entries(),int(event_fraction*(entry-entry_start)),int(total_data*4/1.e6)))
+            sys.stdout.flush()
+
+    store.finalize()
+    if particles is not None:
+        particles.finalize()
+    event_keys = np.array(event_keys, dtype=np.int64).reshape([-1, 3])
+    metas = np.array(metas, dtype=np.float64).reshape([-1, 8 if flags.DATA_DIM == 2 else 10])
+    index = build_index(flags, store, event_keys, entries, input_file)
+    return store, event_keys, metas, particles, index
+
+
+def ingest_worker(args):
+    """
+    Pool worker: read one (file, entry range) chunk and hand it back to the
+    parent through a temporary directory in the cache layout.
+    """
+    flags, input_file, entry_start, entry_end, tmp_dir = args
+    store, event_keys, metas, particles, index = read_larcv_sparse(flags, input_file, entry_start, entry_end)
+    path = os.path.join(tmp_dir, '%s-%d-%d' % (os.path.basename(input_file), entry_start, entry_end))
+    save_cache(path, store, event_keys, metas, particles, index)
+    return path
+
+
+def make_batch(io_handle, thread_id, buffers=None):
     """
     Structure of returned blob:
-        - voxels = [(N, 4)] * batch size
-        - feature = [(N, 1)] * batch_per_step
-        - data = [(N, 5)] * batch_per_step
-        - label = [(N, 1)] * batch size
-    where N = total number of points across minibatch_size events
+        - data = [(N, dim+2)] * num_gpus, float32 (coordinates, batch id, feature)
+        - voxels = [(N, dim+1)] * num_gpus, view of data (coordinates, batch id)
+        - feature = [(N, 1)] * num_gpus, view of data
+        - label, weights = [(N, 1)] * num_gpus
+        - particles = [{batch id: (P,) PARTICLE_DTYPE}] * num_gpus, if PARTICLE is set
+    where N = total number of points across minibatch_size events (or
+    across the events packed up to POINT_BUDGET points)
     """
-    num_gpus = max(1, len(io_handle._flags.GPUS))
-    batch_per_step = io_handle.batch_per_step()
-    batch_per_gpu = io_handle.batch_per_gpu()
-    while 1:
-        time.sleep(0.000001)
-        while not io_handle._locks[thread_id]:
-            idx_v     = []
-            voxel_v   = []
-            feature_v = []
-            new_idx_v = []
-            particles_v = []
-            # label_v   = []
-            blob = {}
-            for key, val in io_handle.blob().iteritems():
+    # Threads take turns: thread_id makes batch numbers thread_id + k * num_threads
+    minibatch_idx_v = io_handle._sampler.minibatches(io_handle._batch_number[thread_id])
+    io_handle._batch_number[thread_id] += len(io_handle._threads)
+    if buffers is not None:
+        buffers.advance()
+
+    data_key = io_handle._flags.DATA_KEYS[0]
+    blob = {}
+    new_idx_v = []
+    first_batch_id_v = []
+    first_batch_id = 0
+    for minibatch_idx in minibatch_idx_v:
+        new_idx_v.append(np.array(minibatch_idx))
+        first_batch_id_v.append(first_batch_id)
+        minibatch = collate(io_handle._store, minibatch_idx, data_key,
+                            io_handle._flags.DATA_KEYS[1:],
+                            first_batch_id=first_batch_id, buffers=buffers)
+        first_batch_id += len(minibatch_idx)
+        for key, value in minibatch.items():
+            if key not in blob:
                 blob[key] = []
-            if io_handle._flags.SHUFFLE:
-                idx_v = np.random.random([batch_per_step])*io_handle.num_entries()
-                idx_v = idx_v.astype(np.int32)
-                # for key, val in io_handle.blob().iteritems():
-                #     blob[key] = val  # fixme start, val?
-            else:
-                start = io_handle._start_idx[thread_id]
-                end   = start + batch_per_step
-                if end < io_handle.num_entries():
-                    idx_v = np.arange(start,end)
-                    # for key, val in io_handle.blob().iteritems():
-                    #     blob[key] = val[start:end]
-                else:
-                    idx_v = np.arange(start, io_handle.num_entries())
-                    idx_v = np.concatenate([idx_v,np.arange(0,end-io_handle.num_entries())])
-                    # for key, val in io_handle.blob().iteritems():
-                    #     blob[key] = val[start:] + val[0:end-io_handle.num_entries()]
-                next_start = start + len(io_handle._threads) * batch_per_step
-                if next_start >= io_handle.num_entries():
-                    next_start -= io_handle.num_entries()
-                io_handle._start_idx[thread_id] = next_start
-
-            for i in range(num_gpus):
-                voxel_v.append([])
-                feature_v.append([])
-                new_idx_v.append([])
-                particles_v.append([])
-                for key in io_handle._flags.DATA_KEYS:
-                    blob[key].append([])
-
-            for data_id, idx in enumerate(idx_v):
-                voxel  = io_handle.blob()['voxels'][idx]
-                new_id = int(data_id / batch_per_gpu)
-                voxel_v[new_id].append(np.pad(voxel, [(0,0),(0,1)],'constant',constant_values=data_id))
-                feature_v[new_id].append(io_handle.blob()['feature'][idx])
-                new_idx_v[new_id].append(idx)
-                if 'particles' in io_handle.blob():
-                    particles = io_handle.blob()['particles'][idx]
-                    particles['batch_id'] = data_id
-                    particles_v[new_id].append(particles)
-                for key in io_handle._flags.DATA_KEYS:
-                    blob[key][new_id].append(io_handle.blob()[key][idx])
-                # if len(io_handle._label):
-                #     label_v.append(io_handle._label[idx])
-            blob['voxels']  = [np.vstack(voxel_v[i]) for i in range(num_gpus)]
-            blob['feature'] = [np.vstack(feature_v[i]) for i in range(num_gpus)]
-            if len(particles_v) > 0:
-                blob['particles'] = particles_v
-            new_idx_v = [np.array(x) for x in new_idx_v]
-            # if len(label_v): label_v = np.hstack(label_v)
-            for key in io_handle._flags.DATA_KEYS:
-                blob[key] = [np.vstack(minibatch) for minibatch in blob[key]]
-            blob[io_handle._flags.DATA_KEYS[0]] = [np.concatenate([blob['voxels'][i], blob['feature'][i]], axis=1) for i in range(num_gpus)]
-            io_handle._buffs[thread_id] = (new_idx_v, blob)
-            io_handle._locks[thread_id] = True
-    return
+            blob[key].append(value)
+    if io_handle._particles is not None:
+        # Zero-copy slices of the particle table, keyed by batch id
+        particles_v = []
+        for i in range(len(new_idx_v)):
+            particles_v.append({})
+            for data_id, idx in enumerate(new_idx_v[i]):
+                particles = np.asarray(io_handle._particles.event('particles', idx))
+                particles_v[i][first_batch_id_v[i] + data_id] = particles
+        blob['particles'] = particles_v
+    return new_idx_v, blob
+
+
+def threadio_func(io_handle, thread_id):
+    """
+    Reader thread: push batches into this thread's bounded queue until
+    io_handle.stop_threads() is called. Blocks (without polling) while the
+    queue is full, an exception is handed over to the consumer.
+    """
+    buff_queue = io_handle._queues[thread_id]
+    # Batches queued, the one being made and the ones the consumer holds
+    buffers = BatchBuffers(num_slots=io_handle._flags.PREFETCH_DEPTH + 1 + io_handle.held_batches())
+    while not io_handle._stop_event.is_set():
+        try:
+            res = make_batch(io_handle, thread_id, buffers)
+        except Exception as e:
+            traceback.print_exc()
+            res = e
+        tstart = time.time()
+        buff_queue.put(res)
+        io_handle._tspent_blocked[thread_id] += time.time() - tstart
+        if isinstance(res, Exception):
+            return
+
+def batch_layout(blob):
+    """
+    (key, gpu, dtype, shape, offset) of every array of a batch blob
+    packed back to back in one buffer, and the total number of bytes.
+    """
+    layout = []
+    nbytes = 0
+    for key in sorted(blob.keys()):
+        for gpu, array in enumerate(blob[key]):
+            layout.append((key, gpu, array.dtype.str, array.shape, nbytes))
+            nbytes += int(np.ceil(array.nbytes / 8.)) * 8
+    return layout, nbytes
+
+
+def processio_func(io_handle, thread_id, free_queue, ready_queue, shm_dir, max_slots):
+    """
+    Reader process: like threadio_func, but every batch is written into a
+    shared-memory slot (a file under shm_dir) and only its layout is sent
+    to the trainer, which maps it without copying (voxels and feature are
+    views of data, only data is written). Slots come back through
+    free_queue as ('free', name) once the trainer is done with them (see
+    io_larcv_sparse.held_batches), None stops the process. Slots replaced
+    by larger ones are reported with the next batch, for the trainer to
+    unmap them.
+    """
+    ready_queue.cancel_join_thread()
+    # Batches are copied into a slot as soon as they are made
+    buffers = BatchBuffers(num_slots=1)
+    slots = {}
+    free = []
+    dropped = []
+    counter = 0
+    tspent_blocked = 0.
+
+    def handle(msg):
+        if msg is None:
+            return False
+        action, name = msg
+        if action == 'free':
+            free.append(name)
+        else:
+            del slots[name]
+            os.remove(os.path.join(shm_dir, name))
+            dropped.append(name)
+        return True
+
+    try:
+        while True:
+            while True:
+                try:
+                    if not handle(free_queue.get_nowait()):
+                        return
+                except queue.Empty:
+                    break
+            new_idx_v, blob = make_batch(io_handle, thread_id, buffers)
+            particles = blob.pop('particles', None)
+            # Views of data, made again by the trainer
+            del blob['voxels'], blob['feature']
+            layout, nbytes = batch_layout(blob)
+            name = None
+            while name is None:
+                fits = [n for n in free if len(slots[n]) >= nbytes]
+                if fits:
+                    name = fits[0]
+                    free.remove(name)
+                elif len(slots) < max_slots:
+                    name = '%d-%d' % (thread_id, counter)
+                    counter += 1
+                    # Some headroom so that slightly larger batches fit later
+                    slots[name] = np.memmap(os.path.join(shm_dir, name), dtype=np.uint8,
+                                            mode='w+', shape=(int(nbytes * 1.25) + 8,))
+                elif free:
+                    # Only too small slots are free: replace one
+                    handle(('drop', free.pop(0)))
+                elif not handle(free_queue.get()):
+                    return
+            for key, gpu, dtype, shape, offset in layout:
+                np.ndarray(shape, dtype, buffer=slots[name], offset=offset)[...] = blob[key][gpu]
+            tstart = time.time()
+            ready_queue.put((name, layout, new_idx_v, particles, tspent_blocked, list(dropped)))
+            tspent_blocked += time.time() - tstart
+            del dropped[:]
+    except Exception as e:
+        traceback.print_exc()
+        ready_queue.put(e)
+
 
 class io_larcv_sparse(io_base):
 
     def __init__(self, flags):
         super(io_larcv_sparse, self).__init__(flags=flags)
-        self._fout    = None
+        self._writer  = None
         self._event_keys = []
         self._metas      = []
-        # For circular buffer / thread function controls
-        self._locks   = [False] * flags.NUM_THREADS
-        self._buffs   = [None ] * flags.NUM_THREADS
+        self._particles  = None
+        self._index      = None
+        # True once only the events of RANK are kept
+        self._is_shard   = False
+        # For reader threads / prefetch queue controls
+        self._queues  = [None ] * flags.NUM_THREADS
+        self._pending = [None ] * flags.NUM_THREADS
         self._threads = [None ] * flags.NUM_THREADS
-        self._start_idx = [-1 ] * flags.NUM_THREADS
+        self._batch_number = [-1] * flags.NUM_THREADS
+        self._num_consumed = 0
+        self._sampler = None
+        self._selection = None
+        self._start_state = None
+        self._tspent_blocked = [0.] * flags.NUM_THREADS
+        self._stop_event = threading.Event()
         self._last_buffer_id = -1
+        # For reader processes (shared-memory batch slots)
+        self._processes = [None] * flags.NUM_THREADS
+        self._free_queues = [None] * flags.NUM_THREADS
+        self._held_slots = [[] for _ in range(flags.NUM_THREADS)]
+        self._slot_maps = {}
+        self._shm_dir = None
         self.set_index_start(0)
 
     def initialize(self):
-        plane_id = self._flags.PLANE
-        print('________________plane id is %d_________________' % plane_id)
+        """
+        Load the dataset: from the cache if there is one for the whole input
+        (the shard of RANK is then cut from it), otherwise by reading the
+        input files (only the entries of RANK if WORLD_SIZE > 1)
+        """
         self._event_keys = []
         self._metas = []
-        # configure the input
-        from larcv import larcv
-        from ROOT import TChain
-        dtype_keyword  = ''
-        as_numpy_voxels = larcv.fill_2d_voxels
-        as_numpy_pcloud = larcv.fill_2d_pcloud
-        dtype_keyword   = 'sparse2d'
-        as_meta = larcv.ImageMeta
-        ch_blob = {}
-        br_blob = {}
-        self._blob['voxels'] = []
-        self._blob['feature'] = []
-        total_sample = 0.
-        total_point = 0.
-        total_data = 0.
-        for key in self._flags.DATA_KEYS:
-            self._blob[key] = []
-        for file_number,f in enumerate(self._flags.INPUT_FILE):
-            for key in self._flags.DATA_KEYS:
-                if self._flags.COMPUTE_WEIGHT and key == self._flags.DATA_KEYS[2]:
-                    continue
-                ch_blob[key] = TChain('%s_%s_tree' % (dtype_keyword, key))
-            for ch in ch_blob.values():
-                ch.AddFile(f)
-            print(ch_blob.values())
-            ach = ch_blob.values()[0]
-            event_fraction = 1./ach.GetEntries() * 100.
-            if self._flags.LIMIT_NUM_SAMPLE > 0:
-                event_fraction = 1./self._flags.LIMIT_NUM_SAMPLE * 100.
-
-
-            for entry in range(ach.GetEntries()):
-                if self._flags.LIMIT_NUM_SAMPLE > 0 and entry == self._flags.LIMIT_NUM_SAMPLE:
-                    break
-                for key, ch in ch_blob.iteritems():
-                    ch.GetEntry(entry)
-                    if entry == 0:
-                        if key == 'mcst':
-                            br_blob[key] = getattr(ch, 'particle_mcst_branch')
-                        else:
-                            br_blob[key] = getattr(ch, '%s_%s_branch' % (dtype_keyword, key))
-
-                self._event_keys.append((br_blob[self._flags.DATA_KEYS[0]].run(),
-                                         br_blob[self._flags.DATA_KEYS[0]].subrun(),
-                                         br_blob[self._flags.DATA_KEYS[0]].event()))
-                num_point = br_blob[self._flags.DATA_KEYS[0]].as_vector().at(plane_id).as_vector().size()
-
-                if num_point < 1: continue
-                # special treatment for the data
-                br_data = br_blob[self._flags.DATA_KEYS[0]]
-                br_data = br_data.as_vector().at(plane_id)
-                np_data  = np.zeros(shape=(num_point, self._flags.DATA_DIM+1),dtype=np.float32)
-                as_numpy_pcloud(br_data, np_data)
-                total_data += np_data.size
-                self._blob[self._flags.DATA_KEYS[0]].append(np_data)
-
-                self._metas.append(as_meta(br_data.meta()))
-
-                np_voxel   = np.zeros(shape=(num_point,self._flags.DATA_DIM),dtype=np.int32)
-                as_numpy_voxels(br_data, np_voxel)
-                total_data += np_voxel.size
-                self._blob['voxels'].append(np_voxel)
-
-                np_feature = np.zeros(shape=(num_point,1),dtype=np.float32)
-                as_numpy_pcloud(br_data,  np_feature)
-                total_data += np_feature.size
-                self._blob['feature'].append(np_feature)
-
-
-                # for the rest, different treatment
-                for key in self._flags.DATA_KEYS[1:]:
-                    if self._flags.COMPUTE_WEIGHT and key == self._flags.DATA_KEYS[2]:
-                        continue
-                    br = br_blob[key]
-                    br = br.as_vector().at(plane_id)
-                    np_data = np.zeros(shape=(num_point,1),dtype=np.float32)
-                    as_numpy_pcloud(br,np_data)
-                    total_data += np_data.size
-                    self._blob[key].append(np_data)
-
-
-                    if self._flags.COMPUTE_WEIGHT:
-                    	labels  = self._blob[self._flags.DATA_KEYS[1]][-1]
-                    	weights = np.zeros(shape=labels.shape,dtype=np.float32)
-                    	classes,counts = np.unique(labels,return_counts=True)
-                    	# weight by class only hip mip shower
-			for c in range(len(classes)):
-                        	idx = np.where(labels == float(c))[0]
-                        	if (c>2):
-					weights[idx] = float(1/(len(classes))/counts[c])
-				else:
-					weights[idx] = float(5*len(labels))/(len(classes))/counts[c] 
-			#weight vertices and X surronding
-                    	xy_cor = self._blob['voxels'][-1]
-                    	x= xy_cor[:,0]
-                    	y= xy_cor[:,1]
-			offset = 3
-			vertex_factor = 3
-                    	weights = np.ones(shape=labels.shape,dtype=np.float32)
-			ver_weights = np.zeros(shape=labels.shape,dtype=np.float32)
-			for id_cur in range(len(labels)-1):
-				for id_check in range(id_cur,len(labels)):
-					if ( (abs(x[id_cur] - x[id_check])<=offset ) and 
-					   (abs(y[id_cur] - y[id_check])<=offset ) and 
-					   (labels[id_check] != labels[id_cur ])):
-						if (ver_weights[id_cur] == 0):
-							ver_weights[id_cur]+=vertex_factor
-                                                if (ver_weights[id_check] == 0):
-							ver_weights[id_check]+=vertex_factor
-			weights = np.add(ver_weights,weights)*0.5				
-#                    	weights = np.zeros(shape=labels.shape,dtype=np.float32)*1000
-			if (first):
-				np.savetxt('test.out', weights, fmt='%1.4e')   # use exponential notation
-				first=False
-                    	self._blob[self._flags.DATA_KEYS[2]].append(weights)
-
-            total_point  += num_point
-            total_sample += 1.
-            sys.stdout.write('Processed %d samples (%d%% ... %d MB\r' % (int(total_sample),int(event_fraction*entry),int(total_data*4/1.e6)))
-            sys.stdout.flush()
-
-        sys.stdout.write('\n')
-        sys.stdout.write('Total: %d samples (%d points) ... %d MB\n' % (total_sample,total_point,total_data*4/1.e6))
-        sys.stdout.flush()
-        self.Applythreshold()
-        data = self._blob[self._flags.DATA_KEYS[0]]
-        self._num_channels = data[0].shape[-1]
-        self._num_entries = len(data)
-# Output
-        if self._flags.OUTPUT_FILE:
-            import tempfile
-            cfg = '''
-IOManager: {
-      Verbosity:   2
-      Name:        "IOManager"
-      IOMode:      1
-      OutFileName: "%s"
-      InputFiles:  []
-      InputDirs:   []
-      StoreOnlyType: []
-      StoreOnlyName: []
-    }
-                  '''
-            cfg = cfg % self._flags.OUTPUT_FILE
-            cfg_file = tempfile.NamedTemporaryFile('w')
-            cfg_file.write(cfg)
-            cfg_file.flush()
-            self._fout = larcv.IOManager(cfg_file.name)
-            self._fout.initialize()
+        self._blob = {}
+        self._is_shard = False
+        cache = None
+        shard_cache = None
+        if self._flags.CACHE_DIR:
+            config = self._cache_config()
+            cache = cache_path(self._flags.CACHE_DIR, self._flags.INPUT_FILE, config)
+            if self._flags.WORLD_SIZE > 1:
+                config = dict(config, world_size=self._flags.WORLD_SIZE, rank=self._flags.RANK)
+                shard_cache = cache_path(self._flags.CACHE_DIR, self._flags.INPUT_FILE, config)
+        if cache is not None and os.path.isdir(cache):
+            print('Loading preprocessed data from %s' % cache)
+            self._store, self._event_keys, self._metas, self._particles, self._index = load_cache(cache)
+        elif shard_cache is not None and os.path.isdir(shard_cache):
+            print('Loading preprocessed data of rank %d from %s' % (self._flags.RANK, shard_cache))
+            self._store, self._event_keys, self._metas, self._particles, self._index = load_cache(shard_cache)
+            self._is_shard = True
+        else:
+            self._ingest()
+            self._is_shard = self._flags.WORLD_SIZE > 1
+            if cache is not None:
+                path = shard_cache if self._is_shard else cache
+                print('Writing preprocessed data to %s' % path)
+                save_cache(path, self._store, self._event_keys, self._metas, self._particles, self._index)
+        self._attach_store()
         print('done')
-## Continoue here this should work
-
-
 
-    def initializeOrig(self):
-        plane_id = self._flags.PLANE
-        print('________________plane id is %d_________________' % plane_id)
-        self._event_keys = []
-        self._metas = []
-        # configure the input
-        from larcv import larcv
-        from ROOT import TChain
-        # set 2d vs. 3d functions
-        dtype_keyword  = ''
-        if self._flags.DATA_DIM == 3:
-            as_numpy_voxels = larcv.fill_3d_voxels
-            as_numpy_pcloud = larcv.fill_3d_pcloud
-            dtype_keyword   = 'sparse3d'
-            as_meta = larcv.Voxel3DMeta
-        elif self._flags.DATA_DIM == 2:
-            as_numpy_voxels = larcv.fill_2d_voxels
-            as_numpy_pcloud = larcv.fill_2d_pcloud
-            dtype_keyword   = 'sparse2d'
-            as_meta = larcv.ImageMeta
+    def _attach_store(self):
+        """
+        Expose the loaded store through blob(), then set up sampling and output
+        """
+        if self._flags.WORLD_SIZE > 1 and not self._is_shard:
+            self._take_shard()
+        for key in self._store.keys():
+            self._blob[key] = self._store.view(key)
+        if self._particles is not None:
+            self._blob['particles'] = self._particles.view('particles')
+        # Coordinates + value (DATA_KEYS[0] may be dropped by COMPACT_STORAGE)
+        self._num_channels = self._store.column('voxels').shape[-1] + 1
+        self._num_entries = self._store.num_entries()
+        if self._index is None:
+            self._index = build_index(self._flags, self._store, self._event_keys)
+        self._selection = None
+        if self._flags.SELECT:
+            self._selection = self._index.select(**parse_selection(self._flags.SELECT))
+            if not len(self._selection):
+                raise ValueError('No event matches the selection %s' % self._flags.SELECT)
+            print('Selected %d/%d events (%s)' % (len(self._selection), self._num_entries, self._flags.SELECT))
+        self._sampler = self._make_sampler()
+        self._init_output()
+
+    def _take_shard(self):
+        """
+        Keep only the events of RANK: a contiguous range holding about
+        1/WORLD_SIZE of the points. Memory-mapped data stays mapped (only
+        the shard gets paged in), in-memory data is copied so that the rest
+        can be freed.
+        """
+        start, end = shard_bounds(self._store.lengths(), self._flags.WORLD_SIZE, self._flags.RANK)
+        copy = not isinstance(self._store.column('voxels'), np.memmap)
+        total_entries, total_points = self._store.num_entries(), self._store.num_points()
+        self._store = self._store.slice(start, end, copy=copy)
+        self._event_keys = np.array(self._event_keys[start:end])
+        self._metas = np.array(self._metas[start:end])
+        if self._particles is not None:
+            self._particles = self._particles.slice(start, end, copy=copy)
+        if self._index is not None:
+            self._index = self._index.take(slice(start, end))
+        self._is_shard = True
+        print('Rank %d/%d: events %d-%d of %d (%d points of %d)' %
+              (self._flags.RANK, self._flags.WORLD_SIZE, start, end, total_entries,
+               self._store.num_points(), total_points))
+
+    def _init_output(self):
+        if self._flags.OUTPUT_FILE:
+            self._writer = AsyncWriter(make_writer(self._flags), max_queue=self._flags.OUTPUT_QUEUE)
+
+    def _cache_config(self):
+        """
+        Flags that change the content of the preprocessed dataset
+        """
+        return {'plane'            : self._flags.PLANE,
+                'data_dim'         : self._flags.DATA_DIM,
+                'data_keys'        : self._flags.DATA_KEYS,
+                'compute_weight'   : self._flags.COMPUTE_WEIGHT,
+                'weight_offset'    : self._flags.WEIGHT_OFFSET,
+                'vertex_factor'    : self._flags.VERTEX_FACTOR,
+                'limit_num_sample' : self._flags.LIMIT_NUM_SAMPLE,
+                'particle'         : self._flags.PARTICLE,
+                'label_map'        : self._flags.LABEL_MAP,
+                'value_window'     : self._flags.VALUE_WINDOW,
+                'crop'             : self._flags.CROP,
+                'min_points'       : self._flags.MIN_POINTS,
+                'compact_storage'  : self._flags.COMPACT_STORAGE,
+                'spatial_size'     : self._flags.SPATIAL_SIZE if self._flags.COMPACT_STORAGE else None}
+
+    def _ingest_flags(self):
+        """
+        Picklable copy of the flags needed to read the input (for ingest workers)
+        """
+        names = ['PLANE', 'DATA_DIM', 'DATA_KEYS', 'NUM_CLASS', 'COMPUTE_WEIGHT', 'WEIGHT_OFFSET', 'VERTEX_FACTOR',
+                 'PARTICLE', 'LIMIT_NUM_SAMPLE', 'LABEL_MAP', 'VALUE_WINDOW', 'CROP', 'MIN_POINTS',
+                 'COMPACT_STORAGE', 'SPATIAL_SIZE']
+        return argparse.Namespace(**dict([(name, getattr(self._flags, name)) for name in names]))
+
+    def _ingest(self):
+        print('________________plane id is %d_________________' % self._flags.PLANE)
+        num_workers = self._flags.INGEST_WORKERS
+        if num_workers > 1:
+            results = self._ingest_parallel(num_workers)
         else:
-            print('larcv IO not implemented for data dimension', self._flags.DATA_DIM)
-            raise NotImplementedError
-        ch_blob = {}
-        br_blob = {}
-        self._blob['voxels'] = []
-        self._blob['feature'] = []
+            results = []
+            for f, start, end in self._entry_ranges(self._flags):
+                results.append(read_larcv_sparse(self._flags, f, start, end, verbose=True))
+                sys.stdout.write('\n')
+
+        self._store = EventStore.concatenate([r[0] for r in results])
+        self._event_keys = np.concatenate([r[1] for r in results])
+        self._metas = np.concatenate([r[2] for r in results])
+        self._particles = None
         if self._flags.PARTICLE:
-            self._blob['particles'] = []
-        for key in self._flags.DATA_KEYS:
-            self._blob[key] = []
-            if self._flags.COMPUTE_WEIGHT and key == self._flags.DATA_KEYS[2]:
-                continue
-            ch_blob[key] = TChain('%s_%s_tree' % (dtype_keyword, key))
-        if self._flags.PARTICLE:
-            ch_blob['mcst'] = TChain('particle_mcst_tree')
-
-        for f in self._flags.INPUT_FILE:
-            for ch in ch_blob.values():
-                ch.AddFile(f)
-
-        ach = ch_blob.values()[0]
-        event_fraction = 1./ach.GetEntries() * 100.
-        if self._flags.LIMIT_NUM_SAMPLE > 0:
-            event_fraction = 1./self._flags.LIMIT_NUM_SAMPLE * 100.
-        total_sample = 0.
-        total_point = 0.
-        total_data = 0.
-        for entry in range(ach.GetEntries()):
-            if self._flags.LIMIT_NUM_SAMPLE > 0 and entry == self._flags.LIMIT_NUM_SAMPLE:
-                break
-            for key, ch in ch_blob.iteritems():
-                ch.GetEntry(entry)
-                if entry == 0:
-                    if key == 'mcst':
-                        br_blob[key] = getattr(ch, 'particle_mcst_branch')
-                    else:
-                        br_blob[key] = getattr(ch, '%s_%s_branch' % (dtype_keyword, key))
-
-
-            self._event_keys.append((br_blob[self._flags.DATA_KEYS[0]].run(),
-                                     br_blob[self._flags.DATA_KEYS[0]].subrun(),
-                                     br_blob[self._flags.DATA_KEYS[0]].event()))
-
-            if self._flags.DATA_DIM == 2:
-                num_point = br_blob[self._flags.DATA_KEYS[0]].as_vector().at(plane_id).as_vector().size()
+            self._particles = EventStore.concatenate([r[3] for r in results])
+        self._index = EventIndex.concatenate([r[4] for r in results])
+        sys.stdout.write('Total: %d samples (%d points) ... %d MB\n' % (self._store.num_entries(),self._store.num_points(),self._store.nbytes()/1.e6))
+        sys.stdout.flush()
 
-            else:
-                num_point = br_blob[self._flags.DATA_KEYS[0]].as_vector().size()
-            if num_point < 1: continue
-                # special treatment for the data
-            br_data = br_blob[self._flags.DATA_KEYS[0]]
-
-
-            if self._flags.DATA_DIM == 2:
-                br_data = br_data.as_vector().at(plane_id)
-            np_data  = np.zeros(shape=(num_point, self._flags.DATA_DIM+1),dtype=np.float32)
-            as_numpy_pcloud(br_data, np_data)
-            total_data += np_data.size
-            self._blob[self._flags.DATA_KEYS[0]].append(np_data)
-
-            self._metas.append(as_meta(br_data.meta()))
-
-
-            np_voxel   = np.zeros(shape=(num_point,self._flags.DATA_DIM),dtype=np.int32)
-            as_numpy_voxels(br_data, np_voxel)
-            total_data += np_voxel.size
-            self._blob['voxels'].append(np_voxel)
-
-            np_feature = np.zeros(shape=(num_point,1),dtype=np.float32)
-            as_numpy_pcloud(br_data,  np_feature)
-            total_data += np_feature.size
-            self._blob['feature'].append(np_feature)
-
-            # for the rest, different treatment
-            for key in self._flags.DATA_KEYS[1:]:
-                if self._flags.COMPUTE_WEIGHT and key == self._flags.DATA_KEYS[2]:
-                    continue
-                br = br_blob[key]
-                if self._flags.DATA_DIM == 2:
-    #               br = br.as_vector().front()
-                    br = br.as_vector().at(plane_id)
-                np_data = np.zeros(shape=(num_point,1),dtype=np.float32)
-                as_numpy_pcloud(br,np_data)
-                total_data += np_data.size
-                self._blob[key].append(np_data)
-
-                # if weights need to be computed, compute here using label (index 1)
-
-                if self._flags.COMPUTE_WEIGHT:
-                    labels  = self._blob[self._flags.DATA_KEYS[1]][-1]
-                    weights = np.zeros(shape=labels.shape,dtype=np.float32)
-                    classes,counts = np.unique(labels,return_counts=True)
-                    for c in range(len(classes)):
-                        idx = np.where(labels == float(c))[0]
-                        if (c>2):
-				weights[idx] = float(1000)#1/(len(classes)))
-			else:
-				weights[idx] = float(1000)#len(labels))/(len(classes))/counts[c]
-                    weights = np.ones(shape=labels.shape,dtype=np.float32)
-
-                    self._blob[self._flags.DATA_KEYS[2]].append(weights)
-
-                if self._flags.PARTICLE:
-                    particle_v = br_blob['mcst'].as_vector()
-                    part_info = get_particle_info(particle_v)
-                    self._blob['particles'].append(part_info)
-
-                total_point  += num_point
-                total_sample += 1.
-#                sys.stdout.write('Processed %d samples (%d%% ... %d MB\r' % (int(total_sample),int(event_fraction*entry),int(total_data*4/1.e6)))
-#                sys.stdout.flush()
-
-#            sys.stdout.write('\n')
-#            sys.stdout.write('Total: %d samples (%d points) ... %d MB\n' % (total_sample,total_point,total_data*4/1.e6))
-#            sys.stdout.flush()
-            data = self._blob[self._flags.DATA_KEYS[0]]
-            self._num_channels = data[0].shape[-1]
-            self._num_entries = len(data)
-            # Output
-            if self._flags.OUTPUT_FILE:
-                import tempfile
-                cfg = '''
-    IOManager: {
-          Verbosity:   2
-          Name:        "IOManager"
-          IOMode:      1
-          OutFileName: "%s"
-          InputFiles:  []
-          InputDirs:   []
-          StoreOnlyType: []
-          StoreOnlyName: []
-        }
-                      '''
-                cfg = cfg % self._flags.OUTPUT_FILE
-                cfg_file = tempfile.NamedTemporaryFile('w')
-                cfg_file.write(cfg)
-                cfg_file.flush()
-                self._fout = larcv.IOManager(cfg_file.name)
-                self._fout.initialize()
-    def Applythreshold(self):
-        blob = {}
-        for key in self._blob.keys():
-            blob[key] = []
-        for i,image in enumerate(self._blob['wire']):
-            mask = np.where(np.logical_and(image[:,2]>=10,image[:,2]<=300))[0]
-            for key in self._blob.keys():
-                blob[key].append(self._blob[key][i][mask])
-        self._blob = blob
+    def _entry_ranges(self, flags):
+        """
+        (file, entry start, entry end) ranges to read: all the entries, or
+        with WORLD_SIZE > 1 the 1/WORLD_SIZE of them of RANK (the number of
+        points of an entry is only known once read, so ranks get the same
+        number of entries)
+        """
+        num_entries = [count_larcv_entries(flags, f) for f in self._flags.INPUT_FILE]
+        if self._flags.WORLD_SIZE > 1:
+            return [(self._flags.INPUT_FILE[i], start, end) for i, start, end in
+                    shard_entry_ranges(num_entries, self._flags.WORLD_SIZE, self._flags.RANK)]
+        return [(f, 0, n) for f, n in zip(self._flags.INPUT_FILE, num_entries)]
+
+    def _ingest_parallel(self, num_workers):
+        """
+        Split the input files into entry ranges and read them in a process pool.
+        Chunks are merged back in input order so event indices do not depend
+        on the number of workers.
+        """
+        import multiprocessing
+        import shutil
+        import tempfile
+        flags = self._ingest_flags()
+        ranges = self._entry_ranges(flags)
+        # Several chunks per worker to balance uneven files
+        chunk_size = max(1, int(np.ceil(sum([end - start for _, start, end in ranges]) / float(4 * num_workers))))
+        tmp_dir = tempfile.mkdtemp(dir=self._flags.CACHE_DIR or None, prefix='.ingest_')
+        tasks = []
+        for f, first, last in ranges:
+            for start in range(first, last, chunk_size):
+                tasks.append((flags, f, start, min(last, start + chunk_size), tmp_dir))
+        results = []
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            for i, path in enumerate(pool.imap(ingest_worker, tasks)):
+                results.append(load_cache(path))
+                sys.stdout.write('Processed %d/%d chunks (%d samples)\r' % (i+1, len(tasks), sum([r[0].num_entries() for r in results])))
+                sys.stdout.flush()
+            sys.stdout.write('\n')
+        finally:
+            # Memory-mapped chunks stay readable after their files are unlinked
+            pool.close()
+            pool.join()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return results
+
+    def _make_sampler(self):
+        num_gpus = max(1, len(self._flags.GPUS))
+        if self._flags.POINT_BUDGET > 0:
+            return BudgetSampler(self._store.lengths(), self._flags.POINT_BUDGET,
+                                 num_minibatches=num_gpus, shuffle=bool(self._flags.SHUFFLE),
+                                 seed=self._flags.SEED, start=self._start_state,
+                                 bucket=self._flags.BUCKET_POOL, entries=self._selection)
+        return EpochSampler(self._num_entries, self.batch_per_step(), num_minibatches=num_gpus,
+                            shuffle=bool(self._flags.SHUFFLE), seed=self._flags.SEED,
+                            start=self._start_state, entries=self._selection)
+
+    def index(self):
+        """
+        EventIndex of the loaded events (see uresnet.iotools.event_index)
+        """
+        return self._index
+
+    def set_selection(self, idx):
+        """
+        Only sample the events idx (e.g. from index().select()), all if None.
+        The data stream restarts from the beginning.
+        """
+        self._selection = None if idx is None else np.asarray(idx, dtype=np.int64)
+        self.set_index_start(0)
 
     def set_index_start(self,idx):
+        """
+        Restart the data stream at position idx (entry idx of the first epoch,
+        idx - num_entries of the second one and so on; batch idx of the first
+        epoch with POINT_BUDGET)
+        """
+        self.restore_state({'epoch': 0, 'cursor': idx})
+
+    def state(self):
+        """
+        Position of the next batch served by next(), as {'epoch', 'cursor'}
+        """
+        return self._sampler.state(self._num_consumed)
+
+    def restore_state(self, state):
+        running = self._threads[0] is not None
         self.stop_threads()
+        self._start_state = dict(state)
+        if self._sampler is not None:
+            self._sampler = self._make_sampler()
         for i in range(len(self._threads)):
-            self._start_idx[i] = idx + i * self.batch_per_step()
+            self._batch_number[i] = i
+        self._num_consumed = 0
+        if running:
+            self.start_threads()
 
     def start_threads(self):
         if self._threads[0] is not None:
             return
+        if self._flags.READER_PROCESSES:
+            self._start_processes()
+            return
+        self._stop_event.clear()
+        self._last_buffer_id = -1
         for thread_id in range(len(self._threads)):
             print('Starting thread',thread_id)
+            self._queues[thread_id] = queue.Queue(maxsize=self._flags.PREFETCH_DEPTH)
             self._threads[thread_id] = threading.Thread(target = threadio_func, args=[self,thread_id])
             self._threads[thread_id].daemon = True
             self._threads[thread_id].start()
 
+    def _start_processes(self):
+        import multiprocessing
+        import tempfile
+        self._last_buffer_id = -1
+        self._shm_dir = tempfile.mkdtemp(prefix='uresnet_',
+                                         dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        # Slots: queued batches + one being written + the ones the trainer holds
+        max_slots = self._flags.PREFETCH_DEPTH + 1 + self.held_batches()
+        for thread_id in range(len(self._threads)):
+            print('Starting process',thread_id)
+            self._queues[thread_id] = multiprocessing.Queue(maxsize=self._flags.PREFETCH_DEPTH)
+            self._free_queues[thread_id] = multiprocessing.Queue()
+            self._processes[thread_id] = multiprocessing.Process(target = processio_func,
+                                                                 args=[self, thread_id,
+                                                                       self._free_queues[thread_id],
+                                                                       self._queues[thread_id],
+                                                                       self._shm_dir, max_slots])
+            self._processes[thread_id].daemon = True
+            self._processes[thread_id].start()
+            self._threads[thread_id] = self._processes[thread_id]
+
     def stop_threads(self):
         if self._threads[0] is None:
             return
-        for i in range(len(self._threads)):
-            while self._locks[buffer_id]:
-                time.sleep(0.000001)
-            self._buffs[i] = None
-            self._start_idx[i] = -1
+        self._stop_event.set()
+        for free_queue in self._free_queues:
+            if free_queue is not None:
+                free_queue.put(None)
+        for i, thread in enumerate(self._threads):
+            # Drain the queue so that a producer blocked on put() can exit
+            while thread.is_alive():
+                try:
+                    self._queues[i].get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+            self._threads[i] = None
+            self._queues[i] = None
+            self._pending[i] = None
+            self._processes[i] = None
+            self._free_queues[i] = None
+            self._held_slots[i] = []
+        if self._shm_dir is not None:
+            # Slots still referenced by the trainer stay mapped
+            import shutil
+            shutil.rmtree(self._shm_dir, ignore_errors=True)
+            self._shm_dir = None
+            self._slot_maps = {}
+
+    def _map_batch(self, buffer_id, msg):
+        """
+        Turn a reader process message into (idx, blob) with arrays viewing the shared slot
+        """
+        name, layout, new_idx_v, particles, tspent_blocked, dropped = msg
+        self._tspent_blocked[buffer_id] = tspent_blocked
+        for slot in dropped:
+            self._slot_maps.pop(slot, None)
+        # The batch taken held_batches() batches ago is not used anymore
+        held = self._held_slots[buffer_id] + [name]
+        while len(held) > self.held_batches():
+            self._free_queues[buffer_id].put(('free', held.pop(0)))
+        self._held_slots[buffer_id] = held
+        if name not in self._slot_maps:
+            self._slot_maps[name] = np.memmap(os.path.join(self._shm_dir, name), dtype=np.uint8, mode='r+')
+        blob = {}
+        for key, gpu, dtype, shape, offset in layout:
+            if key not in blob:
+                blob[key] = []
+            blob[key].append(np.ndarray(shape, dtype, buffer=self._slot_maps[name], offset=offset))
+        views = [data_views(data) for data in blob[self._flags.DATA_KEYS[0]]]
+        blob['voxels'] = [voxels for voxels, _ in views]
+        blob['feature'] = [feature for _, feature in views]
+        if particles is not None:
+            blob['particles'] = particles
+        return new_idx_v, blob
+
+    def held_batches(self):
+        """
+        Number of batches of one reader the consumer uses at once. A batch
+        returned by next() is valid until this many more batches were taken
+        from the same reader: the batches of one training iteration (see
+        get_data_minibatched), readers taking turns. Its arrays are then
+        reused for later batches.
+        """
+        return max(1, int(np.ceil(self._flags.BATCH_SIZE / float(self.batch_per_step() * len(self._threads)))))
 
     def _next(self,buffer_id=-1,release=True):
 
-        if buffer_id >= len(self._locks):
+        if buffer_id >= len(self._threads):
             sys.stderr.write('Invalid buffer id requested: {:d}\n'.format(buffer_id))
             raise ValueError
         if buffer_id < 0: buffer_id = self._last_buffer_id + 1
-        if buffer_id >= len(self._locks):
+        if buffer_id >= len(self._threads):
             buffer_id = 0
         if self._threads[buffer_id] is None:
             sys.stderr.write('Read-thread does not exist (did you initialize?)\n')
             raise ValueError
-        while not self._locks[buffer_id]:
-            time.sleep(0.000001)
-        res = self._buffs[buffer_id]
+        if self._pending[buffer_id] is None:
+            res = self._queues[buffer_id].get()
+            if self._processes[buffer_id] is not None and not isinstance(res, Exception):
+                res = self._map_batch(buffer_id, res)
+            self._pending[buffer_id] = res
+        res = self._pending[buffer_id]
+        if isinstance(res, Exception):
+            raise res
         if release:
-            self._buffs[buffer_id] = None
-            self._locks[buffer_id] = False
-            self._last_buffer_id   = buffer_id
+            self._pending[buffer_id] = None
+            self._last_buffer_id     = buffer_id
+            self._num_consumed      += 1
+        self.tspent_sum_blocked = sum(self._tspent_blocked)
 
         return res
 
@@ -565,67 +882,42 @@ IOManager: {
             start = end
 
     def store_one_segment(self, idx, softmax, **kwargs):
-        from larcv import larcv
-        if self._fout is None:
+        """
+        Queue the output of event idx for the background writer
+        """
+        if self._writer is None:
             return
         idx=int(idx)
         if idx >= self.num_entries():
             raise ValueError
-        keys = self._event_keys[idx]
-        meta = self._metas[idx]
-        dtype_keyword  = ''
-        if self._flags.DATA_DIM == 3:
-            as_numpy_voxels = larcv.fill_3d_voxels
-            as_numpy_pcloud = larcv.fill_3d_pcloud
-            as_tensor = larcv.as_tensor3d
-            dtype_keyword   = 'sparse3d'
-            as_meta = larcv.Voxel3DMeta
-        elif self._flags.DATA_DIM == 2:
-            as_numpy_voxels = larcv.fill_2d_voxels
-            as_numpy_pcloud = larcv.fill_2d_pcloud
-            dtype_keyword   = 'sparse2d'
-            as_meta = larcv.ImageMeta
-            as_tensor = larcv.as_tensor2d
-
-        data_key = self._flags.DATA_KEYS[0]
-
-        larcv_data = self._fout.get_data(dtype_keyword, data_key)
-        voxel   = self._blob['voxels'][idx]
-        feature = self._blob['feature'][idx].reshape([-1])
-        if self._flags.DATA_DIM == 3:
-            vs = as_tensor(voxel,feature,meta,0.)
-        elif self._flags.DATA_DIM == 2:
-            vs = as_tensor(voxel,feature,meta,0.)
-
-	
-        larcv_data.set(vs,meta)
-
-        score = np.max(softmax,axis=1).reshape([-1])
-        prediction = np.argmax(softmax,axis=1).astype(np.float32).reshape([-1])
-
-        larcv_softmax = self._fout.get_data(dtype_keyword,'softmax')
-        vs = as_tensor(voxel,score,meta,-1.)
-        larcv_softmax.set(vs,meta)
-
-        larcv_prediction = self._fout.get_data(dtype_keyword,'prediction')
-        vs = as_tensor(voxel,prediction,meta,-1.)
-        larcv_prediction.set(vs,meta)
-
-        for keyword in kwargs:
-            values = kwargs[keyword].reshape([-1]).astype(np.float32)
-            larcv_arg = self._fout.get_data(dtype_keyword, keyword)
-            vs = as_tensor(voxel, values, meta, -1.)
-            larcv_arg.set(vs, meta)
-
+        label = None
         if len(self._flags.DATA_KEYS) > 1:
             label = self.blob()[self._flags.DATA_KEYS[1]][idx]
-            label = label.astype(np.float32).reshape([-1])
-            larcv_label = self._fout.get_data(dtype_keyword,'label')
-            vs = as_tensor(voxel,label,meta,-1.)
-            larcv_label.set(vs,meta)
-        self._fout.set_id(keys[0],keys[1],keys[2])
-        self._fout.save_entry()
+        self._writer.put({'event_key' : self._event_keys[idx],
+                          'entry'     : idx,
+                          'meta'      : self._metas[idx],
+                          'voxels'    : self._blob['voxels'][idx],
+                          'feature'   : self._blob['feature'][idx],
+                          'softmax'   : softmax,
+                          'label'     : label,
+                          'extra'     : kwargs})
+
+    def output_stats(self):
+        if self._writer is None:
+            return None
+        return self._writer.stats()
 
     def finalize(self):
-        if self._fout:
-            self._fout.finalize()
+        if self._writer is not None:
+            self._writer.close()
+            stats = self._writer.stats()
+            print('Wrote %d events to %s (%.1f events/s in the writer, %.1f s waiting on it)' %
+                  (stats['written'], self._flags.OUTPUT_FILE,
+                   stats['written'] / max(stats['tsumwrite'], 1.e-9), stats['tsumblocked']))
+            self._writer = None
+
+    def save(self, path):
+        """
+        Write the loaded dataset as a packed file (see uresnet.iotools.packed)
+        """
+        save_packed(path, self._store, self._event_keys, self._metas, self._particles, self._index)
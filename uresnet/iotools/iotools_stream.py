@@ -0,0 +1,270 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import sys
+import threading
+import time
+import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import numpy as np
+from uresnet.iotools.iotools_sparse import io_larcv_sparse, count_larcv_entries, read_larcv_sparse
+from uresnet.iotools.collate import BatchBuffers, collate, data_views
+
+
+class StreamWindow(object):
+    """
+    Events read from one entry range of one input file (see
+    read_larcv_sparse). file_offset is the stream index of the first entry
+    of the file: event local of the window has stream index
+    file_offset + its entry in the file, entries dropped at ingest
+    (empty, or removed by a transform) leave a gap.
+    """
+
+    def __init__(self, file_offset, store, event_keys, metas, particles, index):
+        self.store = store
+        self.index = index
+        self.stream_index = file_offset + index.column('entry')
+        self.event_keys = event_keys
+        self.metas = metas
+        self.particles = particles
+        self.released = np.zeros(store.num_entries(), dtype=np.bool_)
+
+    def __len__(self):
+        return self.store.num_entries()
+
+    def find(self, idx):
+        """
+        Local index of the event of stream index idx, -1 if not in the window
+        """
+        local = int(np.searchsorted(self.stream_index, idx))
+        if local < len(self) and self.stream_index[local] == idx:
+            return local
+        return -1
+
+    def get(self, name, local):
+        if name == 'event_keys':
+            return self.event_keys[local]
+        if name == 'metas':
+            return self.metas[local]
+        if name == 'particles':
+            return np.asarray(self.particles.event('particles', local))
+        return self.store.event(name, local)
+
+
+class StreamColumn(object):
+    """
+    List-like view of one per-event field of the windows currently held by
+    an io_larcv_sparse_stream, indexed by stream event index.
+    """
+
+    def __init__(self, io_handle, name):
+        self._io_handle = io_handle
+        self._name = name
+
+    def __getitem__(self, idx):
+        window, local = self._io_handle._locate(idx)
+        return window.get(self._name, local)
+
+
+def collate_events(events, data_key, value_keys, first_batch_id, buffers):
+    """
+    collate() over a list of (window, local) events. Events of consecutive
+    windows are gathered separately, then concatenated.
+    """
+    parts = []
+    batch_id = first_batch_id
+    start = 0
+    while start < len(events):
+        window = events[start][0]
+        end = start
+        while end < len(events) and events[end][0] is window:
+            end += 1
+        local_v = [local for _, local in events[start:end]]
+        parts.append(collate(window.store, local_v, data_key, value_keys,
+                             first_batch_id=batch_id, buffers=buffers))
+        batch_id += end - start
+        start = end
+    if len(parts) == 1:
+        return parts[0]
+    res = {}
+    for key in [data_key] + list(value_keys):
+        res[key] = np.concatenate([part[key] for part in parts])
+    res['voxels'], res['feature'] = data_views(res[data_key])
+    return res
+
+
+def streamio_func(io_handle):
+    """
+    Reader thread: read the input files window by window (looping over them
+    forever) and push batches into the bounded queue until
+    io_handle.stop_threads() is called.
+    """
+    flags = io_handle._flags
+    buff_queue = io_handle._queues[0]
+    buffers = BatchBuffers(num_slots=flags.PREFETCH_DEPTH + 1 + io_handle.held_batches())
+    num_gpus = max(1, len(flags.GPUS))
+    batch_per_step = io_handle.batch_per_step()
+    batch_per_gpu = io_handle.batch_per_gpu()
+    data_key = flags.DATA_KEYS[0]
+    window_size = max(1, flags.STREAM_WINDOW)
+
+    def emit(events):
+        buffers.advance()
+        new_idx_v = []
+        blob = {}
+        for i in range(num_gpus):
+            minibatch = events[i*batch_per_gpu:(i+1)*batch_per_gpu]
+            new_idx_v.append(np.array([window.stream_index[local] for window, local in minibatch]))
+            res = collate_events(minibatch, data_key, flags.DATA_KEYS[1:], i * batch_per_gpu, buffers)
+            if flags.PARTICLE:
+                res['particles'] = dict([(i * batch_per_gpu + data_id, window.get('particles', local))
+                                         for data_id, (window, local) in enumerate(minibatch)])
+            for key, value in res.items():
+                if key not in blob:
+                    blob[key] = []
+                blob[key].append(value)
+        if not flags.OUTPUT_FILE:
+            # Nothing will be written back, events can go as soon as they are batched
+            for window, local in events:
+                io_handle._release(window, local)
+        tstart = time.time()
+        buff_queue.put((new_idx_v, blob))
+        io_handle._tspent_blocked[0] += time.time() - tstart
+
+    try:
+        events = []
+        while not io_handle._stop_event.is_set():
+            file_offset = 0
+            num_read = 0
+            for input_file, num_entries in zip(flags.INPUT_FILE, io_handle._file_entries):
+                for entry_start in range(0, num_entries, window_size):
+                    if io_handle._stop_event.is_set():
+                        return
+                    entry_end = min(num_entries, entry_start + window_size)
+                    window = StreamWindow(file_offset, *read_larcv_sparse(flags, input_file, entry_start, entry_end))
+                    if not len(window):
+                        continue
+                    num_read += len(window)
+                    io_handle._add_window(window)
+                    events.extend([(window, local) for local in range(len(window))])
+                    while len(events) >= batch_per_step:
+                        emit(events[0:batch_per_step])
+                        events = events[batch_per_step:]
+                file_offset += num_entries
+            if not num_read:
+                raise ValueError('No event left in the input after ingest transforms')
+    except Exception as e:
+        traceback.print_exc()
+        buff_queue.put(e)
+
+
+class io_larcv_sparse_stream(io_larcv_sparse):
+    """
+    Sparse larcv IO reading the input incrementally instead of loading it
+    all in initialize(). Entries are read STREAM_WINDOW at a time, in file
+    order, by a single reader thread (READER_PROCESSES is ignored). A window
+    is released once all its events are written by store_segment (or
+    batched, if there is no output file), so memory stays bounded by the
+    prefetch queue and the batches not stored yet. The event index of a
+    batch is its entry index in the input (files concatenated, entries
+    dropped at ingest are skipped but keep their number), and is only valid
+    until the event is stored.
+    With an output file, every batch taken must be stored (the windows of a
+    batch never stored stay in memory), and only once.
+    """
+
+    def __init__(self, flags):
+        super(io_larcv_sparse_stream, self).__init__(flags=flags)
+        self._file_entries = []
+        self._windows = []
+        self._window_lock = threading.Lock()
+        # A single reader thread keeps the input order
+        self._queues  = [None]
+        self._pending = [None]
+        self._threads = [None]
+        self._tspent_blocked = [0.]
+        self._processes = [None]
+        self._free_queues = [None]
+        self._held_slots = [[]]
+
+    def initialize(self):
+        if self._flags.SHUFFLE:
+            sys.stderr.write('Streaming IO reads entries in order, ignoring SHUFFLE\n')
+        if self._flags.POINT_BUDGET > 0:
+            sys.stderr.write('Streaming IO batches MINIBATCH_SIZE events, ignoring POINT_BUDGET\n')
+        if self._flags.SELECT:
+            sys.stderr.write('Streaming IO has no event index, ignoring SELECT\n')
+        if self._flags.READER_PROCESSES:
+            sys.stderr.write('Streaming IO reads with a single thread, ignoring READER_PROCESSES\n')
+        self._file_entries = [count_larcv_entries(self._flags, f) for f in self._flags.INPUT_FILE]
+        self._num_entries = sum(self._file_entries)
+        if self._num_entries < 1:
+            raise ValueError('No entry found in %s' % ','.join(self._flags.INPUT_FILE))
+        self._windows = []
+        # Same columns as read_larcv_sparse, data = coordinates + value
+        self._num_channels = self._flags.DATA_DIM + 1
+        self._blob = {}
+        keys = ['voxels', 'feature'] + self._flags.DATA_KEYS[1:]
+        if not self._flags.COMPACT_STORAGE:
+            keys.append(self._flags.DATA_KEYS[0])
+        for key in keys:
+            self._blob[key] = StreamColumn(self, key)
+        if self._flags.PARTICLE:
+            self._blob['particles'] = StreamColumn(self, 'particles')
+        self._event_keys = StreamColumn(self, 'event_keys')
+        self._metas = StreamColumn(self, 'metas')
+        self._init_output()
+        print('done')
+
+    def _add_window(self, window):
+        with self._window_lock:
+            self._windows.append(window)
+
+    def _locate(self, idx):
+        """
+        (window, local index) of the oldest not yet released event idx
+        """
+        with self._window_lock:
+            for window in self._windows:
+                local = window.find(idx)
+                if local >= 0 and not window.released[local]:
+                    return window, local
+        raise IndexError('Event %d is not held (not read yet or already stored)' % idx)
+
+    def _release(self, window, local):
+        with self._window_lock:
+            window.released[local] = True
+            if window.released.all():
+                self._windows.remove(window)
+
+    def set_index_start(self, idx):
+        if idx != 0:
+            sys.stderr.write('Streaming IO always starts from the first entry, ignoring %d\n' % idx)
+        self.stop_threads()
+
+    def state(self):
+        return None
+
+    def start_threads(self):
+        if self._threads[0] is not None:
+            return
+        self._stop_event.clear()
+        self._last_buffer_id = -1
+        self._windows = []
+        print('Starting stream thread')
+        self._queues[0] = queue.Queue(maxsize=self._flags.PREFETCH_DEPTH)
+        self._threads[0] = threading.Thread(target = streamio_func, args=[self])
+        self._threads[0].daemon = True
+        self._threads[0].start()
+
+    def _next(self, buffer_id=-1, release=True):
+        return super(io_larcv_sparse_stream, self)._next(0, release)
+
+    def store_segment(self, idx_vv, data_vv, softmax_vv, **kwargs):
+        super(io_larcv_sparse_stream, self).store_segment(idx_vv, data_vv, softmax_vv, **kwargs)
+        for idx_v in idx_vv:
+            for idx in idx_v:
+                self._release(*self._locate(int(idx)))
@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+from uresnet.iotools.iotools_sparse import io_larcv_sparse, compute_weights, build_index, PARTICLE_DTYPE
+from uresnet.iotools.event_store import EventStore
+from uresnet.iotools.transforms import build_transforms
+
+
+def generate_particle(rng, dim, spatial_size, num_points, shower):
+    """
+    (num_points, dim) float coordinates of one track (straight line with a
+    small jitter) or shower (cone widening along its axis), and its start
+    and end points
+    """
+    # Particles stay within the volume: start in the middle third, at most a third long
+    start = rng.uniform(spatial_size / 3., 2 * spatial_size / 3., size=dim)
+    direction = rng.normal(size=dim)
+    direction /= max(np.linalg.norm(direction), 1.e-6)
+    if shower:
+        length = min(3. * np.sqrt(num_points), spatial_size / 3.)
+        t = length * np.sqrt(rng.uniform(size=(num_points, 1)))
+        spread = 0.5 + 0.4 * t
+    else:
+        length = min(0.7 * num_points, spatial_size / 3.)
+        t = length * rng.uniform(size=(num_points, 1))
+        # Long tracks folded into the volume get thicker
+        spread = 0.5 * max(1., 0.7 * num_points / length) ** (1. / (dim - 1))
+    points = start + t * direction + rng.normal(size=(num_points, dim)) * spread
+    return points, start, start + length * direction
+
+
+def _vector3(v):
+    """
+    3D tuple of a 2D or 3D vector (z = 0 in 2D)
+    """
+    return tuple(np.pad(v, (0, 3 - len(v)), 'constant'))
+
+
+def generate_event(rng, dim, spatial_size, num_points, class_prob, particle=False):
+    """
+    One track-and-shower-like event of about num_points voxels: a few
+    particles, each of a class drawn from class_prob (even classes are
+    tracks, odd classes showers). Returns (voxels, feature, label, particles)
+    with unique voxels, particles is None unless particle is set.
+    """
+    num_particles = 1 + rng.poisson(2)
+    fractions = rng.dirichlet(np.ones(num_particles))
+    voxels, labels, records = [], [], []
+    for i in range(num_particles):
+        count = max(1, int(fractions[i] * num_points))
+        category = rng.choice(len(class_prob), p=class_prob)
+        points, start, end = generate_particle(rng, dim, spatial_size, count, category % 2 == 1)
+        voxels.append(points)
+        labels.append(np.full(count, category, dtype=np.float32))
+        if particle:
+            direction = (end - start) / max(np.linalg.norm(end - start), 1.e-6)
+            records.append((i, 1, 11 if category % 2 else 13, 0.) +
+                           _vector3(start) + _vector3(direction) + _vector3(start) + _vector3(end) +
+                           (0., 0., 0., count, 'primary', category))
+    voxels = np.clip(np.concatenate(voxels).astype(np.int32), 0, spatial_size - 1)
+    labels = np.concatenate(labels)
+    # One point per voxel (the first particle reaching it wins)
+    _, index = np.unique(np.ravel_multi_index(voxels.T, (spatial_size,) * dim), return_index=True)
+    voxels = voxels[index]
+    labels = labels[index].reshape([-1, 1])
+    feature = (10. + rng.gamma(2., 30., size=(len(voxels), 1))).astype(np.float32)
+    particles = np.array(records, dtype=PARTICLE_DTYPE) if particle else None
+    return voxels, feature, labels, particles
+
+
+class io_synthetic_sparse(io_larcv_sparse):
+    """
+    Sparse IO serving generated events instead of reading files, to run the
+    whole pipeline (and measure its throughput) without input data.
+    Events are generated once in initialize() from SEED, then batched like
+    io_larcv_sparse ones. Configured by SYNTH_NUM_EVENTS, SYNTH_POINTS
+    (log-uniform min,max voxel count per event), SYNTH_CLASS_MIX (relative
+    class frequencies, uniform over NUM_CLASS if empty), SPATIAL_SIZE and
+    DATA_DIM. Ingest transforms and weights apply as for larcv input.
+    With an output file, -ofmt null discards the outputs.
+    """
+
+    def initialize(self):
+        tstart = time.time()
+        flags = self._flags
+        dim = flags.DATA_DIM
+        size = flags.SPATIAL_SIZE
+        min_points, max_points = [float(v) for v in flags.SYNTH_POINTS.split(',')]
+        if flags.SYNTH_CLASS_MIX:
+            class_prob = np.array([float(v) for v in flags.SYNTH_CLASS_MIX.split(',')])
+        else:
+            class_prob = np.ones(flags.NUM_CLASS)
+        class_prob /= class_prob.sum()
+        transform = build_transforms(flags)
+        meta = [0., 0., size, size, size, size, 0., 1.] if dim == 2 else [0., 0., 0., size, size, size, size, size, size, 1.]
+
+        self._store = EventStore(capacity=flags.SYNTH_NUM_EVENTS)
+        self._particles = EventStore(capacity=flags.SYNTH_NUM_EVENTS) if flags.PARTICLE else None
+        event_keys = []
+        for entry in range(flags.SYNTH_NUM_EVENTS):
+            # Seeded per event: the same events whatever SYNTH_NUM_EVENTS
+            rng = np.random.RandomState([flags.SEED % 2**32, entry])
+            num_points = int(np.exp(rng.uniform(np.log(min_points), np.log(max_points))))
+            voxels, feature, label, particles = generate_event(rng, dim, size, num_points, class_prob,
+                                                               flags.PARTICLE)
+            event = {flags.DATA_KEYS[0]: np.concatenate([voxels, feature], axis=1).astype(np.float32),
+                     'voxels': voxels,
+                     'feature': feature}
+            if len(flags.DATA_KEYS) > 1:
+                event[flags.DATA_KEYS[1]] = label
+            if len(flags.DATA_KEYS) > 2:
+                event[flags.DATA_KEYS[2]] = compute_weights(voxels, label, flags.WEIGHT_OFFSET, flags.VERTEX_FACTOR)
+            event = transform(event)
+            if event is None: continue
+            self._store.append(event)
+            if self._particles is not None:
+                self._particles.append({'particles': particles})
+            event_keys.append((0, 0, entry))
+        self._store.finalize()
+        if self._particles is not None:
+            self._particles.finalize()
+        self._event_keys = np.array(event_keys, dtype=np.int64).reshape([-1, 3])
+        self._metas = np.tile(np.array(meta, dtype=np.float64), (len(self._event_keys), 1))
+        self._index = build_index(flags, self._store, self._event_keys, self._event_keys[:, 2], 'synthetic')
+        self._blob = {}
+        self._attach_store()
+        sys.stdout.write('Generated %d samples (%d points) ... %d MB in %g [s]\n' % (self._store.num_entries(),self._store.num_points(),self._store.nbytes()/1.e6,time.time()-tstart))
+        print('done')
@@ -0,0 +1,98 @@
+"""
+Packed sparse dataset files, readable without larcv/ROOT.
+Three containers hold the same arrays:
+    - a directory in the save_cache layout (columns memory-mapped)
+    - a .npz file
+    - a .h5/.hdf5 file (needs h5py)
+The arrays are offsets (num_entries+1,), one column_<name> (num_points, width)
+per column of the EventStore (coordinates 'voxels', values 'feature', label,
+weights...), event_keys (num_entries, 3) and metas (num_entries, 8 or 10),
+plus particle_offsets and particles if the particle table was kept, and
+the index_* columns of the EventIndex.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import sys
+from collections import OrderedDict
+import numpy as np
+from uresnet.iotools.event_store import EventStore
+from uresnet.iotools.event_index import EventIndex
+from uresnet.iotools.cache import save_cache, load_cache
+
+
+def packed_format(path):
+    extension = path.lower().rsplit('.', 1)[-1]
+    if extension == 'npz':
+        return 'npz'
+    if extension in ['h5', 'hdf5']:
+        return 'hdf5'
+    return 'directory'
+
+
+def _to_arrays(store, event_keys, metas, particles, index):
+    arrays = OrderedDict()
+    arrays['offsets'] = store.offsets()
+    for name in store.keys():
+        arrays['column_%s' % name] = store.column(name)
+    arrays['event_keys'] = np.asarray(event_keys, dtype=np.int64)
+    arrays['metas'] = np.asarray(metas, dtype=np.float64)
+    if particles is not None:
+        arrays['particle_offsets'] = particles.offsets()
+        arrays['particles'] = particles.column('particles')
+    if index is not None:
+        arrays.update(index.to_arrays())
+    return arrays
+
+
+def _from_arrays(arrays):
+    columns = OrderedDict()
+    for name in sorted(arrays.keys()):
+        if name.startswith('column_'):
+            columns[name[len('column_'):]] = arrays[name]
+    store = EventStore.from_arrays(arrays['offsets'], columns)
+    particles = None
+    if 'particles' in arrays:
+        particles = EventStore.from_arrays(arrays['particle_offsets'],
+                                           {'particles': arrays['particles']})
+    return store, arrays['event_keys'], arrays['metas'], particles, EventIndex.from_arrays(arrays)
+
+
+def save_packed(path, store, event_keys, metas, particles=None, index=None):
+    fmt = packed_format(path)
+    if fmt == 'directory':
+        save_cache(path, store, event_keys, metas, particles, index)
+    elif fmt == 'npz':
+        np.savez(path, **_to_arrays(store, event_keys, metas, particles, index))
+    else:
+        try:
+            import h5py
+        except ImportError:
+            sys.stderr.write('HDF5 files need h5py, use a directory or a .npz file instead\n')
+            raise
+        with h5py.File(path, 'w') as f:
+            for name, array in _to_arrays(store, event_keys, metas, particles, index).items():
+                f.create_dataset(name, data=array, chunks=True if len(array) else None)
+
+
+def load_packed(path):
+    """
+    Returns (store, event_keys, metas, particles, index) read from a packed
+    file, index is None for files converted without one
+    """
+    fmt = packed_format(path)
+    if fmt == 'directory':
+        if not os.path.isdir(path):
+            raise IOError('Packed dataset directory not found: %s' % path)
+        return load_cache(path)
+    if fmt == 'npz':
+        with np.load(path) as f:
+            return _from_arrays(dict([(name, f[name]) for name in f.files]))
+    try:
+        import h5py
+    except ImportError:
+        sys.stderr.write('HDF5 files need h5py, use a directory or a .npz file instead\n')
+        raise
+    with h5py.File(path, 'r') as f:
+        return _from_arrays(dict([(name, f[name][...]) for name in f.keys()]))
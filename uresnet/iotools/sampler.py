@@ -0,0 +1,163 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import threading
+import numpy as np
+
+
+class EpochSampler(object):
+    """
+    Deterministic sampling of entries without replacement.
+    The entries of an epoch are a permutation of range(num_entries), seeded
+    by (seed, epoch) (identity if shuffle is off), and epochs are chained
+    into one stream of positions. Batch number b is positions
+    [start + b*batch_size, start + (b+1)*batch_size) of that stream, split
+    into num_minibatches minibatches, so any batch can be computed
+    independently: reader thread t of T handles batch numbers t, t+T, ...
+    without overlap. start is a state() dict, None for the beginning.
+    With entries (an array of entry indices), only those are sampled.
+    """
+
+    def __init__(self, num_entries, batch_size, num_minibatches=1, shuffle=True, seed=0, start=None,
+                 entries=None):
+        self._entries = None if entries is None else np.asarray(entries, dtype=np.int64)
+        if self._entries is not None:
+            num_entries = len(self._entries)
+        self._num_entries = num_entries
+        self._batch_size = batch_size
+        self._num_minibatches = num_minibatches
+        self._shuffle = shuffle
+        self._seed = seed
+        self._start = start if start is not None else {'epoch': 0, 'cursor': 0}
+        self._permutations = {}
+        self._lock = threading.Lock()
+
+    def permutation(self, epoch):
+        """
+        Entry indices in the order of epoch
+        """
+        if not self._shuffle:
+            return np.arange(self._num_entries) if self._entries is None else self._entries
+        with self._lock:
+            if epoch not in self._permutations:
+                # Keep the epochs that in-flight batches may still span
+                for old in [e for e in self._permutations if e < epoch - 1]:
+                    del self._permutations[old]
+                random = np.random.RandomState([self._seed % 2**32, epoch])
+                permutation = random.permutation(self._num_entries)
+                if self._entries is not None:
+                    permutation = self._entries[permutation]
+                self._permutations[epoch] = permutation
+            return self._permutations[epoch]
+
+    def _position(self, batch_number):
+        return (self._start['epoch'] * self._num_entries + self._start['cursor'] +
+                batch_number * self._batch_size)
+
+    def batch(self, batch_number):
+        """
+        Entry indices of batch batch_number
+        """
+        position = self._position(batch_number)
+        idx_v = []
+        while len(idx_v) < self._batch_size:
+            epoch, cursor = divmod(position + len(idx_v), self._num_entries)
+            count = min(self._batch_size - len(idx_v), self._num_entries - cursor)
+            idx_v.extend(self.permutation(epoch)[cursor:cursor+count])
+        return np.array(idx_v, dtype=np.int64)
+
+    def minibatches(self, batch_number):
+        """
+        Entry indices of batch batch_number, as a list of num_minibatches arrays
+        """
+        return np.split(self.batch(batch_number), self._num_minibatches)
+
+    def state(self, batch_number):
+        """
+        Position of batch batch_number as {'epoch', 'cursor'}
+        """
+        epoch, cursor = divmod(self._position(batch_number), self._num_entries)
+        return {'epoch': int(epoch), 'cursor': int(cursor)}
+
+
+class BudgetSampler(EpochSampler):
+    """
+    EpochSampler variant making minibatches of a bounded number of points
+    instead of a fixed number of events. The events of an epoch permutation
+    are packed in order into minibatches of at most budget points (at least
+    one event each), and every num_minibatches consecutive minibatches make
+    a batch. Minibatches left over at the end of an epoch are skipped.
+    With bucket > 0 the permutation is first sorted by point count within
+    consecutive pools of bucket entries, so that a minibatch gets events of
+    similar size, and the batches of the epoch are then shuffled.
+    The cursor of a state is the batch index within its epoch.
+    """
+
+    def __init__(self, lengths, budget, num_minibatches=1, shuffle=True, seed=0, start=None, bucket=0,
+                 entries=None):
+        super(BudgetSampler, self).__init__(len(lengths), 1, num_minibatches=num_minibatches,
+                                            shuffle=shuffle, seed=seed, start=start, entries=entries)
+        self._lengths = np.asarray(lengths)
+        self._budget = budget
+        self._bucket = bucket
+        self._epochs = {}
+        self._num_batches = {}
+
+    def _pack(self, epoch):
+        """
+        (order, bounds) of an epoch: bounds[b, m] = (start, end) of minibatch m
+        of batch b in order
+        """
+        with self._lock:
+            if epoch in self._epochs:
+                return self._epochs[epoch]
+        order = np.array(self.permutation(epoch))
+        if self._bucket > 0:
+            for start in range(0, len(order), self._bucket):
+                pool = order[start:start+self._bucket]
+                order[start:start+self._bucket] = pool[np.argsort(self._lengths[pool], kind='mergesort')]
+        ends = []
+        total = 0
+        for i, length in enumerate(self._lengths[order]):
+            if total > 0 and total + length > self._budget:
+                ends.append(i)
+                total = 0
+            total += length
+        ends.append(len(order))
+        num_batches = len(ends) // self._num_minibatches
+        ends = np.array(ends[0:num_batches * self._num_minibatches], dtype=np.int64)
+        starts = np.concatenate([[0], ends[0:-1]]).astype(np.int64)
+        bounds = np.stack([starts, ends], axis=-1).reshape([num_batches, self._num_minibatches, 2])
+        if self._bucket > 0 and self._shuffle:
+            bounds = bounds[np.random.RandomState([self._seed % 2**32, epoch, 1]).permutation(num_batches)]
+        with self._lock:
+            for old in [e for e in self._epochs if e < epoch - 1]:
+                del self._epochs[old]
+            self._epochs[epoch] = (order, bounds)
+            self._num_batches[epoch] = num_batches
+        return order, bounds
+
+    def _locate(self, batch_number):
+        epoch = self._start['epoch']
+        index = self._start['cursor'] + batch_number
+        while True:
+            if epoch not in self._num_batches:
+                self._pack(epoch)
+            if self._num_batches[epoch] < 1:
+                raise ValueError('No complete batch fits in an epoch')
+            if index < self._num_batches[epoch]:
+                return epoch, index
+            index -= self._num_batches[epoch]
+            epoch += 1
+
+    def minibatches(self, batch_number):
+        epoch, index = self._locate(batch_number)
+        order, bounds = self._pack(epoch)
+        return [order[start:end] for start, end in bounds[index]]
+
+    def batch(self, batch_number):
+        return np.concatenate(self.minibatches(batch_number))
+
+    def state(self, batch_number):
+        epoch, index = self._locate(batch_number)
+        return {'epoch': int(epoch), 'cursor': int(index)}
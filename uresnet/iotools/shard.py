@@ -0,0 +1,50 @@
+"""
+Splitting a dataset between the WORLD_SIZE processes of a distributed run.
+Every rank gets one contiguous range of events, disjoint from the others.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+
+def shard_bounds(lengths, world_size, rank):
+    """
+    (start, end) event range of rank when splitting events of the given
+    lengths (number of points) into world_size contiguous shards of about
+    the same total number of points. Every shard gets at least one event.
+    """
+    num_entries = len(lengths)
+    if num_entries < world_size:
+        raise ValueError('Cannot split %d events between %d ranks' % (num_entries, world_size))
+    ends = np.cumsum(lengths, dtype=np.float64)
+    total = ends[-1] if num_entries else 0.
+    # Shard r starts with the first event ending past r/world_size of the points
+    starts = np.searchsorted(ends, total * np.arange(world_size) / world_size, side='right')
+    starts[0] = 0
+    # Non-empty shards: at least one event after the previous start, and
+    # enough events left for the following shards
+    for r in range(1, world_size):
+        starts[r] = min(max(starts[r], starts[r-1] + 1), num_entries - world_size + r)
+    bounds = np.append(starts, num_entries)
+    return int(bounds[rank]), int(bounds[rank + 1])
+
+
+def shard_entry_ranges(num_entries, world_size, rank):
+    """
+    [(file index, entry start, entry end)] read by rank when splitting the
+    entries of files (num_entries per file, concatenated) into world_size
+    contiguous shards of the same number of entries
+    """
+    total = sum(num_entries)
+    if total < world_size:
+        raise ValueError('Cannot split %d entries between %d ranks' % (total, world_size))
+    start, end = total * rank // world_size, total * (rank + 1) // world_size
+    ranges = []
+    offset = 0
+    for i, n in enumerate(num_entries):
+        lo, hi = max(start - offset, 0), min(end - offset, n)
+        if lo < hi:
+            ranges.append((i, lo, hi))
+        offset += n
+    return ranges
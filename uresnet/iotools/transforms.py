@@ -0,0 +1,146 @@
+"""
+Per-event transforms applied while reading the input, before an event is
+stored. An event is a dict name -> (N, width) array with at least
+'voxels' (coordinates) and 'feature' (voxel value). A transform returns
+the transformed event, or None to drop the event altogether.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+
+def select_points(event, mask):
+    """
+    Keep the points of every column of event where mask is True
+    """
+    if mask.all():
+        return event
+    return dict([(key, value[mask]) for key, value in event.items()])
+
+
+class ValueWindow(object):
+    """
+    Keep the voxels with vmin <= feature <= vmax
+    """
+
+    def __init__(self, vmin, vmax):
+        self._vmin = vmin
+        self._vmax = vmax
+
+    def __call__(self, event):
+        value = event['feature'][:, 0]
+        return select_points(event, np.logical_and(value >= self._vmin, value <= self._vmax))
+
+
+class Crop(object):
+    """
+    Keep the voxels with vmin <= coordinate < vmax along every axis
+    """
+
+    def __init__(self, vmin, vmax):
+        self._vmin = vmin
+        self._vmax = vmax
+
+    def __call__(self, event):
+        voxels = event['voxels']
+        mask = np.logical_and(voxels >= self._vmin, voxels < self._vmax).all(axis=1)
+        return select_points(event, mask)
+
+
+class RemapLabels(object):
+    """
+    Replace label values of column key according to mapping {from: to}
+    """
+
+    def __init__(self, key, mapping):
+        self._key = key
+        self._mapping = mapping
+
+    def __call__(self, event):
+        label = event[self._key]
+        remapped = label.copy()
+        for source, target in self._mapping.items():
+            remapped[label == source] = target
+        event = dict(event)
+        event[self._key] = remapped
+        return event
+
+
+class MinPoints(object):
+    """
+    Drop events with fewer than num_points voxels
+    """
+
+    def __init__(self, num_points):
+        self._num_points = num_points
+
+    def __call__(self, event):
+        if len(event['voxels']) < self._num_points:
+            return None
+        return event
+
+
+class Compact(object):
+    """
+    Store columns at their smallest exact dtype: coordinates as int16 (if
+    spatial_size allows), label_key as uint8, and drop data_key, a copy of
+    the coordinates and values that collate() rebuilds. Labels must be
+    integers in [0, 255]. Weights and values stay float32.
+    """
+
+    def __init__(self, data_key, label_key=None, spatial_size=0):
+        self._data_key = data_key
+        self._label_key = label_key
+        self._coordinate_type = np.int16 if spatial_size <= 2**15 else np.int32
+
+    def __call__(self, event):
+        event = dict(event)
+        event.pop(self._data_key, None)
+        event['voxels'] = event['voxels'].astype(self._coordinate_type)
+        if self._label_key is not None:
+            label = event[self._label_key]
+            if len(label) and (label.min() < 0 or label.max() > 255 or (np.round(label) != label).any()):
+                raise ValueError('Compact storage needs integer labels in [0, 255] (%s)' % self._label_key)
+            event[self._label_key] = label.astype(np.uint8)
+        return event
+
+
+class Compose(object):
+
+    def __init__(self, transforms):
+        self._transforms = transforms
+
+    def __call__(self, event):
+        for transform in self._transforms:
+            event = transform(event)
+            if event is None:
+                return None
+        return event
+
+
+def build_transforms(flags):
+    """
+    Transform pipeline configured by LABEL_MAP, VALUE_WINDOW, CROP and MIN_POINTS
+    (in that order). Empty strings disable the corresponding transform.
+    With COMPACT_STORAGE the surviving events are then compacted.
+    """
+    transforms = []
+    if flags.LABEL_MAP:
+        mapping = {}
+        for pair in flags.LABEL_MAP.split(','):
+            source, target = pair.split(':')
+            mapping[float(source)] = float(target)
+        transforms.append(RemapLabels(flags.DATA_KEYS[1], mapping))
+    if flags.VALUE_WINDOW:
+        vmin, vmax = [float(v) for v in flags.VALUE_WINDOW.split(',')]
+        transforms.append(ValueWindow(vmin, vmax))
+    if flags.CROP:
+        vmin, vmax = [int(v) for v in flags.CROP.split(',')]
+        transforms.append(Crop(vmin, vmax))
+    if flags.MIN_POINTS > 0:
+        transforms.append(MinPoints(flags.MIN_POINTS))
+    if flags.COMPACT_STORAGE:
+        label_key = flags.DATA_KEYS[1] if len(flags.DATA_KEYS) > 1 else None
+        transforms.append(Compact(flags.DATA_KEYS[0], label_key, flags.SPATIAL_SIZE))
+    return Compose(transforms)
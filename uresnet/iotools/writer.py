@@ -0,0 +1,329 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import sys
+import threading
+import time
+import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import numpy as np
+
+
+class LarcvWriter(object):
+    """
+    Write inference records to a larcv ROOT file, one entry per record.
+    A record is a dict with
+        - event_key: (run, subrun, event)
+        - entry: event index in the input
+        - meta: meta array (see meta_to_array)
+        - voxels: (N, dim) coordinates, feature: (N, 1) voxel values
+        - softmax: (N, num_classes)
+        - label: (N, 1) or None
+        - extra: dict name -> (N, 1) values, stored as one product each
+    """
+
+    def __init__(self, output_file, data_dim, data_key):
+        from larcv import larcv
+        from uresnet.iotools.iotools_sparse import array_to_meta
+        import tempfile
+        cfg = '''
+IOManager: {
+      Verbosity:   2
+      Name:        "IOManager"
+      IOMode:      1
+      OutFileName: "%s"
+      InputFiles:  []
+      InputDirs:   []
+      StoreOnlyType: []
+      StoreOnlyName: []
+    }
+                  '''
+        cfg = cfg % output_file
+        cfg_file = tempfile.NamedTemporaryFile('w')
+        cfg_file.write(cfg)
+        cfg_file.flush()
+        self._fout = larcv.IOManager(cfg_file.name)
+        self._fout.initialize()
+        self._data_dim = data_dim
+        self._data_key = data_key
+        self._array_to_meta = array_to_meta
+        if data_dim == 3:
+            self._dtype_keyword = 'sparse3d'
+            self._as_tensor = larcv.as_tensor3d
+        elif data_dim == 2:
+            self._dtype_keyword = 'sparse2d'
+            self._as_tensor = larcv.as_tensor2d
+        else:
+            print('larcv IO not implemented for data dimension', data_dim)
+            raise NotImplementedError
+
+    def _set(self, name, voxel, values, meta, threshold):
+        product = self._fout.get_data(self._dtype_keyword, name)
+        product.set(self._as_tensor(voxel, values, meta, threshold), meta)
+
+    def write(self, record):
+        meta = self._array_to_meta(record['meta'], self._data_dim)
+        voxel = np.asarray(record['voxels'], dtype=np.int32)
+        softmax = record['softmax']
+        self._set(self._data_key, voxel, record['feature'].reshape([-1]), meta, 0.)
+        self._set('softmax', voxel, np.max(softmax, axis=1).reshape([-1]), meta, -1.)
+        self._set('prediction', voxel, np.argmax(softmax, axis=1).astype(np.float32).reshape([-1]), meta, -1.)
+        for keyword, values in record['extra'].items():
+            self._set(keyword, voxel, values.reshape([-1]).astype(np.float32), meta, -1.)
+        if record['label'] is not None:
+            self._set('label', voxel, record['label'].astype(np.float32).reshape([-1]), meta, -1.)
+        run, subrun, event = [int(k) for k in record['event_key']]
+        self._fout.set_id(run, subrun, event)
+        self._fout.save_entry()
+
+    def close(self):
+        self._fout.finalize()
+
+
+class NullWriter(object):
+    """
+    Discard every record (to measure the pipeline without output cost)
+    """
+
+    def write(self, record):
+        pass
+
+    def close(self):
+        pass
+
+
+class ColumnarWriter(object):
+    """
+    Base of the columnar output formats. Records (see LarcvWriter) are
+    buffered and handed to _write_block as concatenated columns once
+    block_size points are buffered. Columns:
+        - per event: event_key (E, 3), entry (E,), meta (E, 8 or 10), num_points (E,)
+        - per point: voxels (N, dim), feature (N,), softmax (N, num_classes),
+          prediction (N,), label (N,) and one extra_<name> (N,) per extra output
+    Events own consecutive points, in order (offsets = cumsum of num_points).
+    All records must have the same optional columns (label and extra names)
+    as the first one, otherwise the columns would not line up.
+    """
+
+    def __init__(self, output_file, float16=False, block_size=1000000):
+        self._output_file = output_file
+        self._float_type = np.float16 if float16 else np.float32
+        self._block_size = block_size
+        self._blocks = {}
+        self._num_points = 0
+        self._optional_columns = None
+
+    def _add(self, name, value):
+        if name not in self._blocks:
+            self._blocks[name] = []
+        self._blocks[name].append(value)
+
+    def write(self, record):
+        optional_columns = sorted(['extra_%s' % keyword for keyword in record['extra']])
+        if record['label'] is not None:
+            optional_columns.append('label')
+        if self._optional_columns is None:
+            self._optional_columns = optional_columns
+        elif optional_columns != self._optional_columns:
+            raise ValueError('Record of entry %d has columns %s, previous records had %s' %
+                             (record['entry'], optional_columns, self._optional_columns))
+        num_points = len(record['voxels'])
+        softmax = record['softmax']
+        self._add('event_key', np.asarray(record['event_key'], dtype=np.int64).reshape([1, 3]))
+        self._add('entry', np.array([record['entry']], dtype=np.int64))
+        self._add('meta', np.asarray(record['meta'], dtype=np.float64).reshape([1, -1]))
+        self._add('num_points', np.array([num_points], dtype=np.int64))
+        self._add('voxels', np.asarray(record['voxels'], dtype=np.int32))
+        self._add('feature', np.asarray(record['feature'], dtype=np.float32).reshape([-1]))
+        self._add('softmax', softmax.astype(self._float_type))
+        self._add('prediction', np.argmax(softmax, axis=1).astype(np.int16))
+        if record['label'] is not None:
+            self._add('label', record['label'].reshape([-1]).astype(np.int16))
+        for keyword, values in record['extra'].items():
+            self._add('extra_%s' % keyword, values.reshape([-1]).astype(np.float32))
+        self._num_points += num_points
+        if self._num_points >= self._block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._blocks:
+            return
+        columns = dict([(name, np.concatenate(values)) for name, values in self._blocks.items()])
+        self._blocks = {}
+        self._num_points = 0
+        self._write_block(columns)
+
+    def _write_block(self, columns):
+        raise NotImplementedError
+
+    def close(self):
+        self._flush_block()
+        self._close()
+
+    def _close(self):
+        raise NotImplementedError
+
+
+class HDF5Writer(ColumnarWriter):
+    """
+    Columns as chunked, gzip-compressed, resizable HDF5 datasets (needs h5py)
+    """
+
+    def __init__(self, output_file, float16=False, block_size=1000000):
+        super(HDF5Writer, self).__init__(output_file, float16=float16, block_size=block_size)
+        try:
+            import h5py
+        except ImportError:
+            sys.stderr.write('HDF5 output needs h5py, use a .npz or .root output file instead\n')
+            raise
+        self._file = h5py.File(output_file, 'w')
+
+    def _write_block(self, columns):
+        for name, values in columns.items():
+            if name not in self._file:
+                self._file.create_dataset(name, data=values, maxshape=(None,) + values.shape[1:],
+                                          chunks=True, compression='gzip')
+                continue
+            dataset = self._file[name]
+            start = len(dataset)
+            dataset.resize(start + len(values), axis=0)
+            dataset[start:] = values
+
+    def _close(self):
+        self._file.close()
+
+
+class NPZWriter(ColumnarWriter):
+    """
+    Columns as one compressed .npz file. Blocks are kept in memory until
+    close(), prefer HDF5Writer for large outputs.
+    """
+
+    def __init__(self, output_file, float16=False, block_size=1000000):
+        super(NPZWriter, self).__init__(output_file, float16=float16, block_size=block_size)
+        self._columns = {}
+
+    def _write_block(self, columns):
+        for name, values in columns.items():
+            if name not in self._columns:
+                self._columns[name] = []
+            self._columns[name].append(values)
+
+    def _close(self):
+        columns = dict([(name, np.concatenate(values)) for name, values in self._columns.items()])
+        self._columns = {}
+        np.savez_compressed(self._output_file, **columns)
+
+
+def output_format(flags):
+    """
+    OUTPUT_FORMAT if set, otherwise guessed from the OUTPUT_FILE extension
+    """
+    if flags.OUTPUT_FORMAT:
+        return flags.OUTPUT_FORMAT
+    extension = flags.OUTPUT_FILE.lower().rsplit('.', 1)[-1]
+    if extension in ['h5', 'hdf5']:
+        return 'hdf5'
+    if extension == 'npz':
+        return 'npz'
+    return 'larcv'
+
+
+def make_writer(flags):
+    fmt = output_format(flags)
+    if fmt == 'larcv':
+        return LarcvWriter(flags.OUTPUT_FILE, flags.DATA_DIM, flags.DATA_KEYS[0])
+    if fmt == 'hdf5':
+        return HDF5Writer(flags.OUTPUT_FILE, float16=flags.OUTPUT_FLOAT16)
+    if fmt == 'npz':
+        return NPZWriter(flags.OUTPUT_FILE, float16=flags.OUTPUT_FLOAT16)
+    if fmt == 'null':
+        return NullWriter()
+    raise ValueError('Unknown output format %s' % fmt)
+
+
+def writer_func(async_writer):
+    """
+    Writer thread: write records from the queue until None is received.
+    An exception is kept and raised again in the producer.
+    """
+    while True:
+        record = async_writer._queue.get()
+        try:
+            if record is None:
+                return
+            if async_writer._error is not None:
+                continue
+            tstart = time.time()
+            async_writer._writer.write(record)
+            async_writer.tspent_sum_write += time.time() - tstart
+            async_writer.num_written += 1
+        except Exception as e:
+            traceback.print_exc()
+            async_writer._error = e
+        finally:
+            async_writer._queue.task_done()
+
+
+class AsyncWriter(object):
+    """
+    Run a writer (LarcvWriter or alike) in a background thread.
+    put() only blocks when max_queue records are already waiting, flush()
+    waits until everything queued so far is written.
+    """
+
+    def __init__(self, writer, max_queue=64):
+        self._writer = writer
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self.num_written = 0
+        self.max_depth = 0
+        self.tspent_sum_write = 0.
+        self.tspent_sum_blocked = 0.
+        self._tstart = time.time()
+        self._thread = threading.Thread(target=writer_func, args=[self])
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def put(self, record):
+        self._check()
+        tstart = time.time()
+        self._queue.put(record)
+        self.tspent_sum_blocked += time.time() - tstart
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        """
+        Write everything left, stop the thread and close the writer
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._writer.close()
+        self._check()
+
+    def stats(self):
+        telapsed = max(time.time() - self._tstart, 1.e-9)
+        return {'depth'      : self.depth(),
+                'max_depth'  : self.max_depth,
+                'written'    : self.num_written,
+                'tsumwrite'  : self.tspent_sum_write,
+                'tsumblocked': self.tspent_sum_blocked,
+                'rate'       : self.num_written / telapsed}
@@ -2,33 +2,151 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import os
+import copy
+import json
+import socket
 import time
 import datetime
 import glob
 import sys
 import numpy as np
 from uresnet.iotools import io_factory
+from uresnet.iotools.iotools_sparse import io_larcv_sparse
+from uresnet.iotools.iotools_stream import io_larcv_sparse_stream
+from uresnet.iotools.collate import copy_batch
 from uresnet.trainval import trainval
+from uresnet.distributed import launch, init_distributed, finalize_distributed, is_distributed, is_main_process
 import uresnet.utils as utils
 import torch
 import psutil
 
 
-def iotest(flags):
-    # IO configuration
+def batch_size_stats(flags, idx, blob):
+    """
+    (events, voxels, bytes) of one batch returned by io.next()
+    """
+    num_events = sum([np.size(i) for i in idx])
+    data_v = blob[flags.DATA_KEYS[0]]
+    if not isinstance(data_v, list): data_v = [data_v]
+    if 'voxels' in blob:
+        num_voxels = sum([len(v) for v in blob['voxels']])
+    else:
+        num_voxels = sum([np.count_nonzero(d) for d in data_v])
+    nbytes = 0
+    for key in flags.DATA_KEYS:
+        value_v = blob[key] if isinstance(blob[key], list) else [blob[key]]
+        nbytes += sum([v.nbytes for v in value_v])
+    return num_events, num_voxels, nbytes
+
+
+def benchmark_io(flags, num_threads):
+    """
+    Read BENCH_WARMUP + BENCH_BATCHES batches with num_threads reader
+    threads and return the throughput and latency statistics (dict)
+    """
+    flags = copy.copy(flags)
+    flags.NUM_THREADS = num_threads
+    tstart = time.time()
     io = io_factory(flags)
     io.initialize()
-    num_entries = io.num_entries()
-    ctr = 0
-    data_key = flags.DATA_KEYS[0]
-    while ctr < num_entries:
-        idx,blob=io.next()
-        msg = str(ctr) + '/' + str(num_entries) + ' ... '  + str(idx) + ' ' + str(blob[data_key][0].shape)
-        for key in flags.DATA_KEYS:
-            if key == data_key: continue
-            msg += str(blob[key][0].shape)
-        print(msg)
-        ctr += len(data)
+    if 'sparse' in flags.IO_TYPE:
+        io.start_threads()
+    tinit = time.time() - tstart
+    try:
+        for _ in range(flags.BENCH_WARMUP):
+            io.next()
+        latencies = []
+        num_events, num_voxels, nbytes = 0, 0, 0
+        tblocked = io.tspent_sum_blocked
+        tstart = time.time()
+        for _ in range(flags.BENCH_BATCHES):
+            tbatch = time.time()
+            idx, blob = io.next()
+            latencies.append(time.time() - tbatch)
+            events, voxels, size = batch_size_stats(flags, idx, blob)
+            num_events += events
+            num_voxels += voxels
+            nbytes += size
+        telapsed = max(time.time() - tstart, 1.e-9)
+        tblocked = io.tspent_sum_blocked - tblocked
+    finally:
+        io.stop_threads()
+        io.finalize()
+    latencies = np.array(latencies) * 1.e3
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0., 0., 0.)
+    twait = latencies.sum() / 1.e3
+    return {'num_threads'         : num_threads,
+            'num_batches'         : len(latencies),
+            'init_s'              : tinit,
+            'elapsed_s'           : telapsed,
+            'events_per_s'        : num_events / telapsed,
+            'voxels_per_s'        : num_voxels / telapsed,
+            'mb_per_s'            : nbytes / 1.e6 / telapsed,
+            'latency_ms_mean'     : float(latencies.mean()) if len(latencies) else 0.,
+            'latency_ms_p50'      : float(p50),
+            'latency_ms_p95'      : float(p95),
+            'latency_ms_p99'      : float(p99),
+            'latency_ms_max'      : float(latencies.max()) if len(latencies) else 0.,
+            # Readers are busy unless blocked on a full prefetch queue
+            'producer_utilization': max(0., 1. - tblocked / (num_threads * telapsed)),
+            'consumer_wait_s'     : twait,
+            'consumer_wait_frac'  : twait / telapsed}
+
+
+def iotest(flags):
+    """
+    Benchmark the IO: for each reader thread count of BENCH_THREADS
+    (NUM_THREADS if empty), time BENCH_BATCHES batches after BENCH_WARMUP
+    ones. Results are printed and written as JSON to BENCH_OUTPUT if set.
+    """
+    thread_counts = [flags.NUM_THREADS]
+    if flags.BENCH_THREADS:
+        thread_counts = [int(n) for n in flags.BENCH_THREADS.split(',')]
+    report = {'config' : {'io_type'         : flags.IO_TYPE,
+                          'input_file'      : flags.INPUT_FILE,
+                          'data_keys'       : flags.DATA_KEYS,
+                          'batch_size'      : flags.BATCH_SIZE,
+                          'minibatch_size'  : flags.MINIBATCH_SIZE,
+                          'num_gpus'        : len(flags.GPUS),
+                          'point_budget'    : flags.POINT_BUDGET,
+                          'prefetch_depth'  : flags.PREFETCH_DEPTH,
+                          'reader_processes': bool(flags.READER_PROCESSES),
+                          'warmup'          : flags.BENCH_WARMUP,
+                          'hostname'        : socket.gethostname(),
+                          'time'            : datetime.datetime.now().isoformat()},
+              'results': []}
+    for num_threads in thread_counts:
+        res = benchmark_io(flags, num_threads)
+        report['results'].append(res)
+        msg = '%d threads: %.1f events/s %.3g voxels/s %.1f MB/s ... latency p50 %.2f p95 %.2f p99 %.2f [ms] '
+        msg += 'producer utilization %.1f%% consumer wait %.1f%%'
+        print(msg % (num_threads, res['events_per_s'], res['voxels_per_s'], res['mb_per_s'],
+                     res['latency_ms_p50'], res['latency_ms_p95'], res['latency_ms_p99'],
+                     res['producer_utilization'] * 100., res['consumer_wait_frac'] * 100.))
+        sys.stdout.flush()
+    if flags.BENCH_OUTPUT:
+        with open(flags.BENCH_OUTPUT, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True, separators=(',', ': '))
+        print('Wrote benchmark results to %s' % flags.BENCH_OUTPUT)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True, separators=(',', ': ')))
+    return report
+
+
+def convert(flags):
+    """
+    Read larcv input files (with the usual ingest options) and write them
+    as a packed file OUTPUT_FILE for the packed_sparse IO
+    """
+    if not flags.OUTPUT_FILE:
+        sys.stderr.write('convert needs an output file (-of)\n')
+        raise ValueError
+    output_file, flags.OUTPUT_FILE = flags.OUTPUT_FILE, ''
+    io = io_larcv_sparse(flags)
+    io.initialize()
+    tstart = time.time()
+    io.save(output_file)
+    print('Wrote %d events to %s in %g [s]' % (io.num_entries(), output_file, time.time() - tstart))
     io.finalize()
 
 
@@ -43,8 +161,13 @@ class Handlers:
 
 def train(flags):
     flags.TRAIN = True
+    if flags.NPROC_PER_NODE > 0:
+        # Launcher: the processes started run this function again as ranks
+        launch(flags)
+        return
     handlers = prepare(flags)
     train_loop(flags, handlers)
+    finalize_distributed(flags)
 
 
 def inference(flags):
@@ -59,6 +182,8 @@ def inference(flags):
 def prepare(flags):
     if len(flags.GPUS) > 0:
         torch.cuda.set_device(flags.GPUS[0])
+    if is_distributed(flags):
+        init_distributed(flags)
     handlers = Handlers()
 
     # IO configuration
@@ -81,18 +206,29 @@ def prepare(flags):
     if not flags.FULL:
         loaded_iteration   = handlers.trainer.initialize()
         if flags.TRAIN: handlers.iteration = loaded_iteration
+        # Resume reading where the checkpoint left off
+        io_state = handlers.trainer.io_state
+        if flags.TRAIN and io_state is not None and handlers.data_io.state() is not None:
+            handlers.data_io.restore_state(io_state)
 
     # Weight save directory
-    if flags.WEIGHT_PREFIX:
+    if flags.WEIGHT_PREFIX and is_main_process(flags):
         save_dir = flags.WEIGHT_PREFIX[0:flags.WEIGHT_PREFIX.rfind('/')]
         if save_dir and not os.path.isdir(save_dir): os.makedirs(save_dir)
 
     # Log save directory
     if flags.LOG_DIR:
-        if not os.path.exists(flags.LOG_DIR): os.mkdir(flags.LOG_DIR)
-        logname = '%s/train_log-%07d.csv' % (flags.LOG_DIR, loaded_iteration)
+        if not os.path.exists(flags.LOG_DIR):
+            try:
+                os.mkdir(flags.LOG_DIR)
+            except OSError:
+                # Created meanwhile by another rank
+                if not os.path.isdir(flags.LOG_DIR): raise
+        # One log per rank
+        suffix = '-rank%d' % flags.RANK if flags.WORLD_SIZE > 1 else ''
+        logname = '%s/train_log-%07d%s.csv' % (flags.LOG_DIR, loaded_iteration, suffix)
         if not flags.TRAIN:
-            logname = '%s/inference_log-%07d.csv' % (flags.LOG_DIR, loaded_iteration)
+            logname = '%s/inference_log-%07d%s.csv' % (flags.LOG_DIR, loaded_iteration, suffix)
         handlers.csv_logger = utils.CSVData(logname)
         if not flags.TRAIN and flags.FULL:
             handlers.metrics_logger = utils.CSVData('%s/metrics_log-%07d.csv' % (flags.LOG_DIR, loaded_iteration))
@@ -113,11 +249,13 @@ def get_keys(flags):
 
 def log(handlers, tstamp_iteration, tspent_iteration, tsum, res, flags, epoch):
 
-    report_step  = flags.REPORT_STEP and ((handlers.iteration+1) % flags.REPORT_STEP == 0)
+    # Only rank 0 reports to stdout
+    report_step  = flags.REPORT_STEP and ((handlers.iteration+1) % flags.REPORT_STEP == 0) and is_main_process(flags)
 
 #    loss_seg = np.mean(res['loss_seg']) # RanItay change this
-    loss_seg = np.sum(res['loss_seg'])
-    acc_seg  = np.mean(res['accuracy'])
+    # Not materialized (None) outside of report steps in training
+    loss_seg = np.sum(res['loss_seg']) if res['loss_seg'] is not None else np.nan
+    acc_seg  = np.mean(res['accuracy']) if res['accuracy'] is not None else np.nan
 
     if len(flags.GPUS) > 0:
         mem = utils.round_decimals(torch.cuda.max_memory_allocated()/1.e9, 3)
@@ -129,13 +267,19 @@ def log(handlers, tstamp_iteration, tspent_iteration, tsum, res, flags, epoch):
     if handlers.csv_logger:
         handlers.csv_logger.record(('iter', 'epoch', 'titer', 'tsumiter'),
                                    (handlers.iteration,epoch,tspent_iteration,tsum))
-        handlers.csv_logger.record(('tio', 'tsumio'),
-                                   (handlers.data_io.tspent_io,handlers.data_io.tspent_sum_io))
+        handlers.csv_logger.record(('tio', 'tsumio', 'tsumblocked'),
+                                   (handlers.data_io.tspent_io,handlers.data_io.tspent_sum_io,
+                                    handlers.data_io.tspent_sum_blocked))
+        output_stats = handlers.data_io.output_stats()
+        if output_stats is not None:
+            handlers.csv_logger.record(('outdepth', 'outwritten', 'tsumwrite', 'tsumoutblocked'),
+                                       (output_stats['depth'], output_stats['written'],
+                                        output_stats['tsumwrite'], output_stats['tsumblocked']))
         handlers.csv_logger.record(('mem', ), (mem, ))
         tmap, tsum_map = handlers.trainer.tspent, handlers.trainer.tspent_sum
         if flags.TRAIN:
-            handlers.csv_logger.record(('ttrain','tsave','tsumtrain','tsumsave'),
-                                       (tmap['train'],tmap['save'],tsum_map['train'],tsum_map['save']))
+            handlers.csv_logger.record(('ttrain','tsave','tsumtrain','tsumsave','tsavewrite'),
+                                       (tmap['train'],tmap['save'],tsum_map['train'],tsum_map['save'],tmap['save_write']))
         # else:
         handlers.csv_logger.record(('tforward','tsave','tsumforward','tsumsave'),
                                    (tmap['forward'],tmap['save'],tsum_map['forward'],tsum_map['save']))
@@ -193,15 +337,18 @@ def train_loop(flags, handlers):
         tstart_iteration = time.time()
 
         checkpt_step = flags.CHECKPOINT_STEP and flags.WEIGHT_PREFIX and ((handlers.iteration+1) % flags.CHECKPOINT_STEP == 0)
+        # Loss and accuracy are copied from the device only to be reported
+        report_step  = flags.REPORT_STEP and ((handlers.iteration+1) % flags.REPORT_STEP == 0)
 
         data_blob = get_data_minibatched(handlers, flags, data_key, label_key, weight_key)
 
         # Train step
         res = handlers.trainer.train_step(data_blob, epoch=float(epoch),
-                                          batch_size=flags.BATCH_SIZE)
+                                          batch_size=flags.BATCH_SIZE,
+                                          metrics=bool(report_step))
         # Save snapshot
         if checkpt_step:
-            handlers.trainer.save_state(handlers.iteration)
+            handlers.trainer.save_state(handlers.iteration, io_state=handlers.data_io.state())
 
         tspent_iteration = time.time() - tstart_iteration
         tsum += tspent_iteration
@@ -211,6 +358,7 @@ def train_loop(flags, handlers):
         handlers.iteration += 1
 
     # Finalize
+    handlers.trainer.close()
     if handlers.csv_logger:
         handlers.csv_logger.close()
     handlers.data_io.finalize()
@@ -231,14 +379,16 @@ def inference_loop(flags, handlers):
 
         data_blob = {}
         data_blob['data'] = [blob[data_key]]
+        data_blob['idx_v'] = [idx]
         if label_key is not None:
             data_blob['label'] = [blob[label_key]]
         if weight_key is not None:
             data_blob['weight'] = [blob[weight_key]]
 
         # Run inference
+        outputs = ['segmentation', 'softmax'] if flags.OUTPUT_FILE else ['segmentation']
         res = handlers.trainer.forward(data_blob, epoch=float(epoch),
-                                       batch_size=flags.BATCH_SIZE)
+                                       batch_size=flags.BATCH_SIZE, outputs=outputs)
         print('segmentation',
               np.unique(np.argmax(res['segmentation'][0], axis=0)[(data_blob['data'][0]>0)[0, 0, ...]], return_counts=True),
               np.unique(np.argmax(res['segmentation'][0], axis=0), return_counts=True))
@@ -278,10 +428,16 @@ def full_inference_loop(flags, handlers):
     }
     weights = glob.glob(flags.MODEL_PATH)
     print(weights)
+    if flags.OUTPUT_FILE and len(weights) > 1 and isinstance(handlers.data_io, io_larcv_sparse_stream):
+        sys.stderr.write('Streaming IO stores each event once, cannot write the output of %d weight files\n' % len(weights))
+        raise ValueError
     idx_v, blob_v = [], []
     if flags.ITERATION <= 300:
         for i in range(flags.ITERATION):
             idx, blob = handlers.data_io.next()
+            if isinstance(handlers.data_io, io_larcv_sparse):
+                # The reader reuses the arrays of a batch a few batches later
+                blob = copy_batch(blob, data_key)
             idx_v.append(idx)
             blob_v.append(blob)
 
@@ -308,6 +464,7 @@ def full_inference_loop(flags, handlers):
 
             data_blob = {}
             data_blob['data'] = [blob[data_key]]
+            data_blob['idx_v'] = [idx]
             # print(data_blob['data'][0].shape)
             if label_key is not None:
                 data_blob['label'] = [blob[label_key]]
@@ -315,8 +472,10 @@ def full_inference_loop(flags, handlers):
                 data_blob['weight'] = [blob[weight_key]]
 
             # Run inference
+            # The writer and the metrics need the full softmax
+            outputs = ['softmax'] if flags.OUTPUT_FILE or label_key is not None else []
             res = handlers.trainer.forward(data_blob,
-                                           batch_size=flags.BATCH_SIZE)
+                                           batch_size=flags.BATCH_SIZE, outputs=outputs)
 
             # Store output if requested
             if flags.OUTPUT_FILE:
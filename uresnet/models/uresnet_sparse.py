@@ -54,31 +54,26 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
         assert len(data) == len(label)
         if weight is not None:
             assert len(data) == len(weight)
-        batch_ids = [d[:, -2] for d in data]
         total_loss = 0
         total_acc = 0
-        total_count = 0
-        # Loop over ?
+        # One pass over all the points of each minibatch, accuracy is
+        # reduced per event (segment sums over the batch ids) and stays
+        # on the device like the loss
         for i in range(len(segmentation)):
-            for b in batch_ids[i].unique():
-                batch_index = batch_ids[i] == b
-                event_segmentation = segmentation[i][batch_index]
-                event_label = label[i][batch_index]
-                event_label = torch.squeeze(event_label, dim=-1).long()
-                loss_seg = self.cross_entropy(event_segmentation, event_label)
-                if weight is not None:
-                    event_weight = weight[i][batch_index]
-                    event_weight = torch.squeeze(event_weight, dim=-1).float()
-                    total_loss += torch.sum(loss_seg * event_weight) # RanItay change this
-#                   total_loss += torch.mean(loss_seg * event_weight)
-                else:
-#                    total_loss += torch.mean(loss_seg)
-		    total_loss += torch.sum(loss_seg)
-                total_count += 1
+            point_label = torch.squeeze(label[i], dim=-1).long()
+            loss_seg = self.cross_entropy(segmentation[i], point_label)
+            if weight is not None:
+                point_weight = torch.squeeze(weight[i], dim=-1).float()
+                total_loss += torch.sum(loss_seg * point_weight) # RanItay change this
+            else:
+                total_loss += torch.sum(loss_seg)
 
-                # Accuracy
-                predicted_labels = torch.argmax(event_segmentation, dim=-1)
-                acc = (predicted_labels == event_label).sum().item() / float(predicted_labels.nelement())
-                total_acc += acc
+            # Accuracy (summed over events)
+            event_ids, event_index = torch.unique(data[i][:, -2], return_inverse=True)
+            num_events = len(event_ids)
+            correct = (torch.argmax(segmentation[i], dim=-1) == point_label).double()
+            event_correct = correct.new_zeros(num_events).index_add_(0, event_index, correct)
+            event_count = correct.new_zeros(num_events).index_add_(0, event_index, torch.ones_like(correct))
+            total_acc += (event_correct / event_count).sum()
 
         return total_loss, total_acc
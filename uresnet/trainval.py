@@ -6,6 +6,8 @@ import time
 import os
 import sys
 from uresnet.ops import GraphDataParallel
+from uresnet.distributed import is_distributed, is_main_process, gather_io_states, no_sync
+from uresnet.checkpoint import CheckpointWriter, snapshot_state, resolve_checkpoint
 import uresnet.models as models
 import numpy as np
 import matplotlib
@@ -15,8 +17,16 @@ from matplotlib import pyplot as plt
 class trainval(object):
     def __init__(self, flags):
         self._flags = flags
+        # One process per device, DistributedDataParallel all-reduces gradients
+        self._distributed = is_distributed(flags)
+        # Backward after each minibatch (DDP can only reduce one graph per step)
+        self._accumulate = flags.ACCUMULATE_GRADIENTS or self._distributed
         self.tspent = {}
         self.tspent_sum = {}
+        # Data position restored from the checkpoint, if it has one
+        self.io_state = None
+        # Background checkpoint writer, started by the first save_state
+        self._checkpoint_writer = None
 
     def backward(self):
         total_loss = 0.0
@@ -27,34 +37,90 @@ class trainval(object):
         self._loss = []  # Reset loss accumulator
 
         self._optimizer.zero_grad()  # Reset gradients accumulation
-        total_loss.backward()
+        self._scale(total_loss).backward()
         self._optimizer.step()
 
-    def save_state(self, iteration):
+    def _scale(self, loss):
+        if self._distributed:
+            # DDP averages gradients over ranks, keep the loss summed over
+            # the events of all ranks like a single process would
+            return loss * self._flags.WORLD_SIZE
+        return loss
+
+    def _backward_minibatch(self):
+        """
+        Add the gradients of the last minibatch loss and free its graph.
+        The sum of these gradients is the one of the summed loss.
+        """
+        for loss in self._loss:
+            self._scale(loss).backward()
+        self._loss = []
+
+    def save_state(self, iteration, io_state=None):
+        """
+        Checkpoint: the state is copied to host memory and written in the
+        background (see uresnet.checkpoint), tspent['save'] is the time
+        training waited for it. When distributed every rank must call it
+        (the IO states of all ranks are gathered), only rank 0 writes.
+        """
         tstart = time.time()
-        filename = '%s-%d.ckpt' % (self._flags.WEIGHT_PREFIX, iteration)
-        torch.save({
-            'global_step': iteration,
-            'state_dict': self._net.state_dict(),
-            'optimizer': self._optimizer.state_dict()
-        }, filename)
+        io_states = None
+        if self._distributed:
+            io_states = gather_io_states(io_state, self._flags.WORLD_SIZE)
+        if is_main_process(self._flags):
+            if self._checkpoint_writer is None:
+                self._checkpoint_writer = CheckpointWriter(self._flags.WEIGHT_PREFIX,
+                                                           keep=self._flags.CHECKPOINT_KEEP)
+            state = snapshot_state({
+                'global_step': iteration,
+                'state_dict': self._net.state_dict(),
+                'optimizer': self._optimizer.state_dict(),
+                'io_state': io_state,
+                'io_states': io_states
+            })
+            self._checkpoint_writer.put(iteration, state)
+            self.tspent['save_write'] = self._checkpoint_writer.tspent_write
         self.tspent['save'] = time.time() - tstart
+        self.tspent_sum['save'] += self.tspent['save']
+
+    def close(self):
+        """
+        Wait for the last checkpoint to be written
+        """
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.close()
+            self._checkpoint_writer = None
 
-    def train_step(self, data_blob, epoch=None, batch_size=1):
+    def train_step(self, data_blob, epoch=None, batch_size=1, metrics=True):
+        """
+        One optimizer step over the minibatches of data_blob. Without
+        metrics, loss and accuracy are not copied to the host (None).
+        """
         tstart = time.time()
         self._loss = []  # Initialize loss accumulator
-        res_combined = self.forward(data_blob,
-                                    epoch=epoch, batch_size=batch_size)
-        # Run backward once for all the previous forward
-        self.backward()
+        if self._accumulate:
+            # forward runs backward after each minibatch
+            self._optimizer.zero_grad()
+            res_combined = self.forward(data_blob,
+                                        epoch=epoch, batch_size=batch_size, metrics=metrics)
+            self._optimizer.step()
+        else:
+            res_combined = self.forward(data_blob,
+                                        epoch=epoch, batch_size=batch_size, metrics=metrics)
+            # Run backward once for all the previous forward
+            self.backward()
         self.tspent['train'] = time.time() - tstart
         self.tspent_sum['train'] += self.tspent['train']
         return res_combined
 
-    def forward(self, data_blob, epoch=None, batch_size=1):
+    def forward(self, data_blob, epoch=None, batch_size=1, outputs=(), metrics=True):
         """
         Run forward for
         flags.BATCH_SIZE / (flags.MINIBATCH_SIZE * len(flags.GPUS)) times
+        outputs are the per-point products copied to numpy, one list entry
+        per minibatch (segmentation, softmax or prediction, see _forward).
+        loss_seg and accuracy are materialized only with metrics (otherwise
+        None).
         """
         res_combined = {}
         for idx in range(len(data_blob['data'])):
@@ -99,20 +165,48 @@ class trainval(object):
 
 
 
-            res = self._forward(blob,
-                                epoch=epoch)
+            if self._accumulate and self._flags.TRAIN:
+                # Gradients are all-reduced by the backward of the last minibatch only
+                last = idx == len(data_blob['data']) - 1
+                with no_sync(self._net, self._distributed and not last):
+                    res = self._forward(blob,
+                                        epoch=epoch, outputs=outputs)
+                    self._backward_minibatch()
+            else:
+                res = self._forward(blob,
+                                    epoch=epoch, outputs=outputs)
             for key in res.keys():
                 if key not in res_combined:
                     res_combined[key] = res[key]
                 else:
                     res_combined[key].extend(res[key])
+        if not metrics:
+            res_combined['accuracy'] = res_combined['loss_seg'] = None
+            return res_combined
         # Average loss and acc over all the events in this batch
-        res_combined['accuracy'] = np.array(res_combined['accuracy']).sum() / batch_size
-        res_combined['loss_seg'] = np.array(res_combined['loss_seg']).sum() #/ batch_size Ran Itay Change this
+        # (their number varies with POINT_BUDGET). Summed on the device
+        # first, one host sync for each.
+        num_events = max(1, sum([self._num_events(idx) for idx in data_blob['idx_v']]))
+        res_combined['accuracy'] = float(sum(res_combined['accuracy'])) / num_events
+        res_combined['loss_seg'] = float(sum(res_combined['loss_seg'])) #/ batch_size Ran Itay Change this
         return res_combined
 
-    def _forward(self, data_blob, epoch=None):
+    def _num_events(self, idx):
+        """
+        Number of events of a batch from its entry indices (one array per
+        minibatch for the sparse IO), the accuracy is summed over them
+        """
+        if isinstance(idx, list):
+            return sum([len(i) for i in idx])
+        return len(idx)
+
+    def _forward(self, data_blob, epoch=None, outputs=()):
         """
+        Loss and accuracy stay on the device, only the products in outputs
+        are computed and copied to numpy:
+            - segmentation: scores before softmax
+            - softmax: class probabilities
+            - prediction: most probable class (int16)
         data/label/weight are lists of size minibatch size.
         For sparse uresnet:
         data[0]: shape=(N, 5)
@@ -134,11 +228,13 @@ class trainval(object):
             data = [torch.as_tensor(d) for d in data]
             if torch.cuda.is_available():
                 data = [d.cuda() for d in data]
-            else:
+            # A single minibatch per process without DataParallel scatter
+            single = self._distributed or not torch.cuda.is_available()
+            if single:
                data = data[0]
             tstart = time.time()
             segmentation = self._net(data)
-            if not torch.cuda.is_available():
+            if single:
                 data = [data]
 
             # If label is given, compute the loss
@@ -163,12 +259,18 @@ class trainval(object):
                 loss_seg, acc = self._criterion(segmentation, data, label, weight)
                 if self._flags.TRAIN:
                     self._loss.append(loss_seg)
+                    loss_seg = loss_seg.detach()
             res = {
-                'segmentation': [s.cpu().detach().numpy() for s in segmentation],
-                'softmax': [self._softmax(s).cpu().detach().numpy() for s in segmentation],
                 'accuracy': [acc],
-                'loss_seg': [loss_seg.cpu().item() if not isinstance(loss_seg, float) else loss_seg]
+                'loss_seg': [loss_seg]
             }
+            if 'segmentation' in outputs:
+                res['segmentation'] = [s.cpu().detach().numpy() for s in segmentation]
+            if 'softmax' in outputs:
+                res['softmax'] = [self._softmax(s).cpu().detach().numpy() for s in segmentation]
+            if 'prediction' in outputs:
+                dim = 1 if 'sparse' in self._flags.MODEL_NAME else 0
+                res['prediction'] = [torch.argmax(s, dim=dim).short().cpu().numpy() for s in segmentation]
         self.tspent['forward'] = time.time() - tstart
         self.tspent_sum['forward'] += self.tspent['forward']
         return res
@@ -187,13 +289,18 @@ class trainval(object):
 
         self.tspent_sum['forward'] = self.tspent_sum['train'] = self.tspent_sum['save'] = 0.
         self.tspent['forward'] = self.tspent['train'] = self.tspent['save'] = 0.
+        self.tspent['save_write'] = 0.
 
-        # if len(self._flags.GPUS) > 0:
-        self._net = GraphDataParallel(model(self._flags),
-                                      device_ids=self._flags.GPUS,
-                                      dense=('sparse' not in self._flags.MODEL_NAME))
-        # else:
-        #     self._net = model
+        if self._distributed:
+            net = model(self._flags)
+            if torch.cuda.is_available():
+                net = net.cuda()
+            self._net = torch.nn.parallel.DistributedDataParallel(net,
+                                                                  device_ids=[0] if torch.cuda.is_available() else None)
+        else:
+            self._net = GraphDataParallel(model(self._flags),
+                                          device_ids=self._flags.GPUS,
+                                          dense=('sparse' not in self._flags.MODEL_NAME))
 
         if self._flags.TRAIN:
             self._net.train()
@@ -209,6 +316,9 @@ class trainval(object):
 
         iteration = 0
         if self._flags.MODEL_PATH:
+            # WEIGHT_PREFIX.latest points to the last checkpoint written
+            if os.path.isfile(self._flags.MODEL_PATH):
+                self._flags.MODEL_PATH = resolve_checkpoint(self._flags.MODEL_PATH)
             if not os.path.isfile(self._flags.MODEL_PATH):
                 sys.stderr.write('File not found: %s\n' % self._flags.MODEL_PATH)
                 raise ValueError
@@ -233,6 +343,14 @@ class trainval(object):
                     for g in self._optimizer.param_groups:
                         g['lr'] = self._flags.LEARNING_RATE
                 iteration = checkpoint['global_step'] + 1
+                self.io_state = checkpoint.get('io_state', None)
+                # Data positions are per shard, and shards depend on the number of ranks
+                io_states = checkpoint.get('io_states', None)
+                if (len(io_states) if io_states is not None else 1) != self._flags.WORLD_SIZE:
+                    print('Checkpoint data position is not for %d ranks, data restarts from the beginning' % self._flags.WORLD_SIZE)
+                    self.io_state = None
+                elif io_states is not None:
+                    self.io_state = io_states[self._flags.RANK]
             print('Done.')
     
         return iteration